@@ -2,8 +2,10 @@ import json
 import time
 import http.client
 import urllib.parse
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple
 import logging
+import threading
+import os
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -14,31 +16,120 @@ ZIMAGE_GENERATE_HOST = "zimage.run"
 ZIMAGE_GENERATE_PATH = "/api/z-image/generate"
 ZIMAGE_TASK_PATH = "/api/z-image/task"
 
+# 连接池配置（模块级实例在 serverless 热启动之间保留，连接也随之复用）
+POOL_MAX_PER_HOST = int(os.environ.get('ZIMAGE_POOL_SIZE', '8'))  # 每个主机最多保留的空闲连接
+POOL_IDLE_TIMEOUT = 60  # 空闲连接超过该秒数后不再复用
+
+# 复用的 keep-alive 连接被上游关闭时抛出的异常。发送阶段 (conn.request) 失败时请求没有发出，可以安全重试；
+# 已发出后才断开（如 RemoteDisconnected）时上游可能已经处理了请求，只重试幂等的 GET
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    ConnectionResetError,
+    BrokenPipeError
+)
+
 class ZImageProxy:
     def __init__(self):
         self.zimage_generate_host = ZIMAGE_GENERATE_HOST
         self.zimage_generate_path = ZIMAGE_GENERATE_PATH
         self.zimage_task_path = ZIMAGE_TASK_PATH
 
+        # 每个主机一个空闲连接栈: host -> [(conn, last_used)]
+        self.pool_size = POOL_MAX_PER_HOST
+        self._pool: Dict[str, List[Tuple[http.client.HTTPSConnection, float]]] = {}
+        self._pool_lock = threading.Lock()
+        self.pool_hits = 0
+        self.pool_misses = 0
+        self.pool_reconnects = 0
+
+    def _acquire_connection(self, host: str) -> Tuple[http.client.HTTPSConnection, bool]:
+        """Take an idle pooled connection for host, or open a new one"""
+        now = time.time()
+        expired = []
+
+        with self._pool_lock:
+            idle = self._pool.get(host, [])
+            conn = None
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used < POOL_IDLE_TIMEOUT:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+
+            if conn:
+                self.pool_hits += 1
+            else:
+                self.pool_misses += 1
+
+        for stale in expired:
+            stale.close()
+
+        if conn:
+            return conn, True
+        return http.client.HTTPSConnection(host, timeout=30), False
+
+    def _release_connection(self, host: str, conn: http.client.HTTPSConnection):
+        """Return a connection to the pool, closing it if the pool is full"""
+        with self._pool_lock:
+            idle = self._pool.setdefault(host, [])
+            if len(idle) < self.pool_size:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def pool_stats(self) -> Dict:
+        """Connection pool hit/miss counters"""
+        with self._pool_lock:
+            return {
+                "hits": self.pool_hits,
+                "misses": self.pool_misses,
+                "reconnects": self.pool_reconnects,
+                "max_per_host": self.pool_size,
+                "idle": {host: len(idle) for host, idle in self._pool.items()}
+            }
+
     def make_request(self, method: str, host: str, path: str, data: Optional[Dict] = None) -> Dict:
         """Make HTTP request to external API"""
         try:
-            conn = http.client.HTTPSConnection(host, timeout=30)
-
+            body = None
+            headers = {}
             if method == "POST" and data:
-                json_data = json.dumps(data)
+                body = json.dumps(data)
                 headers = {
                     'Content-Type': 'application/json',
-                    'Content-Length': str(len(json_data))
+                    'Content-Length': str(len(body))
                 }
-                conn.request("POST", path, body=json_data, headers=headers)
-            else:
-                conn.request("GET", path)
 
-            response = conn.getresponse()
-            response_data = response.read().decode('utf-8')
-
-            conn.close()
+            request_method = method if body else "GET"
+            for attempt in range(2):
+                conn, reused = self._acquire_connection(host)
+                sent = False
+                try:
+                    conn.request(request_method, path, body=body, headers=headers)
+                    sent = True
+                    response = conn.getresponse()
+                    response_data = response.read().decode('utf-8')
+                except STALE_CONNECTION_ERRORS:
+                    conn.close()
+                    # 请求已发出的 POST 不重试，否则一次提交可能在上游生成两个任务
+                    if reused and attempt == 0 and (not sent or request_method == "GET"):
+                        # 上游已关闭空闲连接，换一条新连接重试一次
+                        with self._pool_lock:
+                            self.pool_reconnects += 1
+                        logger.info(f"Pooled connection to {host} was stale, reconnecting")
+                        continue
+                    raise
+                except Exception:
+                    conn.close()
+                    raise
+                break
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release_connection(host, conn)
 
             return {
                 'status': response.status,
@@ -305,7 +396,8 @@ def handle_health_check():
         'body': json.dumps({
             "status": "healthy",
             "service": "zimage-proxy",
-            "timestamp": int(time.time())
+            "timestamp": int(time.time()),
+            "connection_pool": zimage_proxy.pool_stats()
         })
     }
 
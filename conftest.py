@@ -0,0 +1,2 @@
+# test_client.py 是连接运行中服务器的演示客户端，不是单元测试
+collect_ignore = ["test_client.py"]
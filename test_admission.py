@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+zimage_admission 单元测试：响应中的排队位置和预计等待
+"""
+
+from zimage_admission import AdmissionController
+
+
+def test_free_ticket_reports_no_wait():
+    ticket = AdmissionController(max_in_flight=1, track=lambda uuid: None).enter()
+    assert ticket.granted
+    info = ticket.info()
+    assert (info['position'], info['eta_seconds']) == (0, 0)
+    assert info['waited_ms'] >= 0
+
+
+def test_queued_ticket_reports_eta_after_admission():
+    controller = AdmissionController(max_in_flight=1, queue_size=10, track=lambda uuid: None)
+    first = controller.enter()
+    queued = controller.enter()
+    assert not queued.granted
+    first.bind("up-1")
+    controller.finished("up-1")
+    assert queued.wait(1)
+    info = queued.info()
+    # 放行后的响应与被拒绝时的 503 响应使用同一个预计等待
+    assert info['eta_seconds'] == queued.rejection()['eta_seconds'] > 0
+    assert info['position'] == queued.rejection()['queue_position']
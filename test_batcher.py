@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+zimage_batcher 单元测试：成员 ID、成员结果投影，以及合并提交只占一个准入名额
+上游提交用替身代替，不需要运行中的服务
+"""
+
+import threading
+
+import pytest
+
+import zimage_batcher
+from zimage_admission import AdmissionController, AdmissionRejected
+from zimage_batcher import MicroBatcher, member_id, member_result, project_member, split_member_id
+
+
+def status_result(task):
+    return {"success": True, "data": {"uuid": "up", "task": task}}
+
+
+@pytest.mark.parametrize("uuid, expected", [
+    (member_id("up", 2), ("up", 2)),
+    ("a~b~3", ("a~b", 3)),
+    ("plain-uuid", None),
+    ("~1", None),
+    ("up~x", None),
+])
+def test_split_member_id(uuid, expected):
+    assert split_member_id(uuid) == expected
+
+
+def test_project_member_keeps_own_image():
+    result = status_result({"taskStatus": "completed", "resultUrls": ["a", "b", "c"], "resultUrl": "a"})
+    task = project_member(result, 1)['data']['task']
+    assert task['resultUrls'] == ["b"]
+    assert task['resultUrl'] == "b"
+    # 原结果不被修改，其他成员还要用
+    assert result['data']['task']['resultUrls'] == ["a", "b", "c"]
+
+
+def test_project_member_missing_image_fails():
+    result = status_result({"taskStatus": "completed", "resultUrls": ["a"]})
+    task = project_member(result, 2)['data']['task']
+    assert task['taskStatus'] == 'failed'
+    assert task['resultUrls'] == []
+    assert "image #2 missing" in task['errorMessage']
+
+
+def test_project_member_running_and_malformed():
+    running = status_result({"taskStatus": "running", "progress": 40})
+    assert project_member(running, 3)['data']['task'] == {"taskStatus": "running", "progress": 40}
+    malformed = {"success": False, "error": "not found"}
+    assert project_member(malformed, 0) is malformed
+
+
+def test_member_result():
+    result = {"success": True, "data": {"uuid": "up", "queue": 2}}
+    assert member_result(result, "up", 3) == {"success": True, "data": {"uuid": "up~3", "queue": 2}}
+
+
+class FakeUpstream:
+    def __init__(self):
+        self.payloads = []
+        self._lock = threading.Lock()
+
+    def __call__(self, payload, timeout=None):
+        with self._lock:
+            self.payloads.append(payload)
+            return 200, {"success": True, "data": {"uuid": f"up-{len(self.payloads)}"}}
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    fake = FakeUpstream()
+    monkeypatch.setattr(zimage_batcher, 'submit_generation', fake)
+    return fake
+
+
+def test_disabled_batcher_submits_directly(upstream):
+    batcher = MicroBatcher(window_ms=0)
+    assert batcher.submit({"prompt": "cat", "batch_size": 1}) == (200, {"success": True, "data": {"uuid": "up-1"}})
+    assert upstream.payloads == [{"prompt": "cat", "batch_size": 1}]
+
+
+def test_merged_submissions_take_one_admission_slot(upstream):
+    controller = AdmissionController(max_in_flight=1, queue_size=0, track=lambda uuid: None)
+    batcher = MicroBatcher(window_ms=500, max_size=4)
+    payload = {"prompt": "cat", "batch_size": 1}
+    start = threading.Barrier(4)
+    uuids = []
+
+    def client():
+        start.wait()
+        with controller.ticket() as ticket:
+            _, result = batcher.submit(payload, ticket)
+            ticket.bind(result['data']['uuid'])
+            uuids.append(result['data']['uuid'])
+
+    threads = [threading.Thread(target=client) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert upstream.payloads == [dict(payload, batch_size=4)]
+    assert sorted(uuids) == [member_id("up-1", index) for index in range(4)]
+    assert controller.queue_status()['in_flight'] == 1
+    assert batcher.stats()['submits_saved'] == 3
+
+    # 名额被占满时，不同参数的提交被拒绝，且不提交到上游
+    with controller.ticket() as ticket:
+        with pytest.raises(AdmissionRejected):
+            batcher.submit({"prompt": "dog", "batch_size": 1}, ticket)
+    assert len(upstream.payloads) == 1
+
+    controller.finished(member_id("up-1", 0))
+    assert controller.queue_status()['in_flight'] == 0
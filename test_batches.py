@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+zimage_batches 单元测试：输入行解析、续传参数，以及每一行的频率限制和使用日志
+上游提交和任务等待用替身代替，不需要运行中的服务
+"""
+
+import itertools
+import json
+import time
+import uuid as uuid_lib
+
+import pytest
+
+import zimage_batches
+import zimage_submit
+import zimage_usage
+from zimage_admission import AdmissionRejected
+from zimage_batches import BatchJob, BatchRunner, parse_after, parse_batch_line
+
+
+def line(**fields) -> bytes:
+    return (json.dumps(fields) + '\n').encode()
+
+
+def test_parse_batch_line_defaults():
+    custom_id, payload, error = parse_batch_line(line(custom_id="a", prompt="cat"))
+    assert (custom_id, error) == ("a", None)
+    assert payload == {
+        "prompt": "cat",
+        "model": "turbo",
+        "negative_prompt": "",
+        "batch_size": 1,
+        "width": 1024,
+        "height": 1024,
+        "steps": 8,
+        "cfg_scale": 7
+    }
+
+
+def test_parse_batch_line_coerces_numbers():
+    _, payload, error = parse_batch_line(line(prompt="cat", model="zimage-base", width="512", steps=4.0, cfg_scale=5.5))
+    assert error is None
+    assert (payload["model"], payload["width"], payload["steps"], payload["cfg_scale"]) == ("base", 512, 4, 5.5)
+
+
+@pytest.mark.parametrize("raw", [b'', b'   \n'])
+def test_parse_batch_line_skips_blank_lines(raw):
+    assert parse_batch_line(raw) == (None, None, None)
+
+
+@pytest.mark.parametrize("raw, message", [
+    (b'not json', "Invalid JSON"),
+    (b'[1, 2]', "Each line must be a JSON object"),
+    (line(custom_id="x"), "Prompt is required"),
+    (line(custom_id="x", prompt="cat", batch_size=5), "batch_size must be between"),
+    (line(custom_id="x", prompt="cat", width=0), "width must be between"),
+    (line(custom_id="x", prompt="cat", height=-512), "height must be between"),
+    (line(custom_id="x", prompt="cat", steps="many"), "steps must be a number"),
+    (line(custom_id="x", prompt="cat", cfg_scale=100), "cfg_scale must be between"),
+])
+def test_parse_batch_line_errors(raw, message):
+    _, payload, error = parse_batch_line(raw)
+    assert payload is None
+    assert error.startswith(message)
+
+
+@pytest.mark.parametrize("value, expected", [(None, 0), ("", 0), ("5", 5), ("-3", 0), ("abc", 0)])
+def test_parse_after(value, expected):
+    assert parse_after(value) == expected
+
+
+class FakeSubmitter:
+    """
+    代替微批提交器：每次提交返回新的 UUID，prompt 以 fail 开头时返回上游错误，
+    以 busy 开头时前 rejections 次提交被准入拒绝
+    """
+
+    def __init__(self, rejections=0):
+        self._ids = itertools.count()
+        self.submitted = []
+        self.rejections = rejections
+
+    def submit(self, payload, ticket=None, timeout=None):
+        self.submitted.append(payload)
+        if payload['prompt'].startswith('busy') and self.submitted.count(payload) <= self.rejections:
+            raise AdmissionRejected(ticket)
+        if payload['prompt'].startswith('fail'):
+            return 200, {"success": False, "error": "boom"}
+        return 200, {"success": True, "data": {"uuid": f"task-{next(self._ids)}"}}
+
+
+class FakePoller:
+    def wait_for_completion(self, uuid, timeout=None):
+        return {"status": "completed", "task": {"taskStatus": "completed", "resultUrls": [f"http://img/{uuid}.png"]}}
+
+
+@pytest.fixture
+def submitter(monkeypatch):
+    fake = FakeSubmitter()
+    monkeypatch.setattr(zimage_submit, 'micro_batcher', fake)
+    monkeypatch.setattr(zimage_batches, 'task_poller', FakePoller())
+    return fake
+
+
+def run_job(lines, client_ip):
+    job = BatchJob("batch_test")
+    runner = BatchRunner(job, concurrency=3, client_ip=client_ip)
+    for raw in lines:
+        runner.add(raw)
+    runner.close()
+    results, done = [], False
+    while not done:
+        batch, done = job.wait(len(results), 5)
+        results.extend(batch)
+    return job, results
+
+
+def usage_entries(ip):
+    return [entry for entry in zimage_usage.usage_logs if entry['ip'] == ip]
+
+
+def test_batch_items_count_against_rate_limit(submitter):
+    ip = f"test-{uuid_lib.uuid4().hex}"
+    total = zimage_usage.RATE_LIMIT_REQUESTS + 2
+    job, results = run_job([line(custom_id=str(i), prompt=f"cat {i}") for i in range(total)], ip)
+
+    assert job.counts == {"completed": zimage_usage.RATE_LIMIT_REQUESTS, "rate_limited": 2}
+    assert len(submitter.submitted) == zimage_usage.RATE_LIMIT_REQUESTS
+    assert all(result['error'].startswith("Rate limit exceeded")
+               for result in results if result['status'] == 'rate_limited')
+    assert zimage_usage.get_rate_limit_status(ip)["rate_limit_remaining"] == 0
+    entries = usage_entries(ip)
+    assert len(entries) == zimage_usage.RATE_LIMIT_REQUESTS
+    assert all(entry['success'] and entry['task_uuid'] for entry in entries)
+
+
+def test_batch_failed_submission_is_logged(submitter):
+    ip = f"test-{uuid_lib.uuid4().hex}"
+    job, results = run_job([line(prompt="fail me"), line(prompt="cat", steps=0)], ip)
+
+    assert job.counts == {"error": 2}
+    # 参数不合法的行不提交，也不计入频率限制
+    assert len(submitter.submitted) == 1
+    assert zimage_usage.get_rate_limit_status(ip)["current_requests"] == 1
+    [entry] = usage_entries(ip)
+    assert (entry['success'], entry['error']) == (False, "boom")
+
+
+def test_batch_without_client_ip_skips_accounting(submitter):
+    before = len(zimage_usage.usage_logs)
+    job, _ = run_job([line(prompt=f"cat {i}") for i in range(zimage_usage.RATE_LIMIT_REQUESTS + 2)], None)
+    assert job.counts == {"completed": zimage_usage.RATE_LIMIT_REQUESTS + 2}
+    assert len(zimage_usage.usage_logs) == before
+
+
+def test_peek_rate_limit_does_not_charge():
+    ip = f"test-{uuid_lib.uuid4().hex}"
+    for _ in range(3):
+        assert zimage_usage.peek_rate_limit(ip) == (True, "")
+    assert zimage_usage.get_rate_limit_status(ip)["current_requests"] == 0
+
+
+class FakeClock:
+    """代替 zimage_batches 中的 time 模块：sleep 只推进时钟"""
+
+    def __init__(self):
+        self.offset = 0
+        self.sleeps = []
+
+    def time(self):
+        return time.time() + self.offset
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.offset += seconds
+
+
+def test_batch_admission_retries_then_rejects(submitter, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(zimage_batches, 'time', clock)
+    monkeypatch.setattr(zimage_batches, 'BATCH_ADMISSION_WAIT', 2.5)
+    submitter.rejections = 1
+    ip = f"test-{uuid_lib.uuid4().hex}"
+    job, results = run_job([line(prompt="busy once")], ip)
+    # 被拒绝后按 Retry-After 退避，重试成功
+    assert job.counts == {"completed": 1}
+    assert len(submitter.submitted) == 2 and clock.sleeps == [1]
+
+    submitter.rejections = 10 ** 6
+    clock.sleeps = []
+    job, [result] = run_job([line(prompt="busy always")], ip)
+    # 重试时间用完后不再等待，记为 rejected 并带上拒绝原因
+    assert job.counts == {"rejected": 1}
+    assert result['error'].startswith("Server busy: ") and result['uuid'] is None
+    assert clock.sleeps == [1, 1]
+    assert usage_entries(ip)[-1]['success'] is False
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+zimage_images 单元测试：增量 base64 编码和请求参数校验
+"""
+
+import base64
+import json
+
+import pytest
+
+from zimage_images import (
+    B64_ITEM_END, B64_JSON_TAIL, Base64Stream, b64_item_start, b64_json_head, images_payload, numeric_param
+)
+
+
+@pytest.mark.parametrize("sizes", [[], [1], [2], [3], [1, 1, 1], [5, 7, 11], [3, 3, 3], [4096, 1, 2]])
+def test_base64_stream_matches_one_shot_encoding(sizes):
+    data = bytes(range(256)) * 20
+    encoder, chunks, start = Base64Stream(), [], 0
+    for size in sizes:
+        chunks.append(encoder.feed(data[start:start + size]))
+        start += size
+    chunks.append(encoder.flush())
+    assert b''.join(chunks) == base64.b64encode(data[:start])
+
+
+def test_base64_stream_only_emits_whole_groups():
+    encoder = Base64Stream()
+    assert encoder.feed(b'ab') == b''
+    assert encoder.feed(b'cd') == base64.b64encode(b'abc')
+    assert encoder.flush() == base64.b64encode(b'd')
+    assert encoder.flush() == b''
+
+
+def test_b64_json_fragments_form_valid_json():
+    body = b64_json_head(123) + b64_item_start(0) + b'QUJD' + B64_ITEM_END \
+        + b64_item_start(1) + b'REVG' + B64_ITEM_END + B64_JSON_TAIL
+    assert json.loads(body) == {"created": 123, "data": [{"b64_json": "QUJD"}, {"b64_json": "REVG"}]}
+
+
+def test_images_payload_defaults():
+    payload, error = images_payload({"prompt": "cat"})
+    assert error is None
+    assert payload == {
+        "prompt": "cat",
+        "negative_prompt": "",
+        "model": "turbo",
+        "batch_size": 1,
+        "width": 1024,
+        "height": 1024,
+        "steps": 8,
+        "cfg_scale": 7
+    }
+
+
+def test_images_payload_coerces_numbers():
+    payload, error = images_payload({"prompt": "cat", "n": "2", "size": "768x512", "steps": "4", "cfg_scale": 6.5})
+    assert error is None
+    assert (payload["batch_size"], payload["width"], payload["height"]) == (2, 768, 512)
+    assert payload["steps"] == 4 and isinstance(payload["steps"], int)
+    assert payload["cfg_scale"] == 6.5
+
+
+@pytest.mark.parametrize("data, message", [
+    ({}, "Prompt is required"),
+    ({"n": 5}, "n must be between"),
+    ({"size": "big"}, "size must be formatted"),
+    ({"size": "0x512"}, "width must be between"),
+    ({"steps": 0}, "steps must be between"),
+    ({"steps": 7.5}, "steps must be an integer"),
+    ({"steps": None}, "steps must be a number"),
+    ({"cfg_scale": "high"}, "cfg_scale must be a number"),
+    ({"cfg_scale": -1}, "cfg_scale must be between"),
+    ({"cfg_scale": float('nan')}, "cfg_scale must be between"),
+    ({"response_format": "png"}, "response_format must be one of"),
+])
+def test_images_payload_rejects_invalid_fields(data, message):
+    payload, error = images_payload(dict({"prompt": "cat"}, **data) if data else {})
+    assert payload is None
+    assert error.startswith(message)
+
+
+def test_numeric_param_keeps_integral_cfg_scale_as_int():
+    assert numeric_param('cfg_scale', 7.0) == (7, None)
+    assert numeric_param('cfg_scale', '7.5') == (7.5, None)
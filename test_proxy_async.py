@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+zimage_proxy_async 路由测试：/v1/fast-generate 与 Flask 版本一样复用已完成的相同任务、合并进行中的相同提交
+微批提交器、订阅中心和状态查询用替身代替，不需要运行中的服务
+"""
+
+import asyncio
+import uuid as uuid_lib
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import zimage_proxy_async
+from zimage_dedup import SubmissionDedup
+from zimage_gencache import CACHE_HEADER, GenerationCache
+from zimage_results import result_cache
+
+
+def completed(uuid):
+    return {"success": True, "data": {"uuid": uuid, "task": {"taskStatus": "completed",
+                                                             "resultUrls": [f"http://img/{uuid}.png"]}}}
+
+
+class FakeBatcher:
+    """代替协程版微批提交器：提交耗时 0.1 秒，每次返回新的 UUID"""
+
+    def __init__(self):
+        self.submitted = []
+
+    async def submit(self, payload, ticket=None):
+        self.submitted.append(payload)
+        await asyncio.sleep(0.1)
+        return 200, {"success": True, "data": {"uuid": str(uuid_lib.uuid4())}}
+
+
+@pytest.fixture
+def batcher(monkeypatch):
+    fake = FakeBatcher()
+
+    async def wait_for_change(uuid, timeout):
+        return None
+
+    async def get(uuid, timeout=None):
+        return completed(uuid)
+
+    monkeypatch.setattr(zimage_proxy_async, 'micro_batcher', fake)
+    monkeypatch.setattr(zimage_proxy_async, 'generation_cache', GenerationCache(enabled=True))
+    monkeypatch.setattr(zimage_proxy_async, 'submission_dedup', SubmissionDedup(window=30))
+    monkeypatch.setattr(zimage_proxy_async.subscription_hub, 'wait_for_change', wait_for_change)
+    monkeypatch.setattr(zimage_proxy_async.task_status, 'get', get)
+    return fake
+
+
+def fast_generate(*bodies):
+    """并发发出 /v1/fast-generate 请求，返回 [(状态码, 响应头, 响应体)]"""
+    async def run():
+        app = web.Application()
+        app.router.add_post('/v1/fast-generate', zimage_proxy_async.fast_generate)
+        async with TestClient(TestServer(app)) as client:
+            async def post(body):
+                response = await client.post('/v1/fast-generate', json=body)
+                return response.status, response.headers, await response.json()
+            return await asyncio.gather(*(post(body) for body in bodies))
+    return asyncio.run(run())
+
+
+def test_fast_generate_merges_identical_submissions(batcher):
+    prompt = f"cat {uuid_lib.uuid4()}"
+    results = fast_generate({"prompt": prompt}, {"prompt": prompt})
+    assert len(batcher.submitted) == 1
+    assert [status for status, _, _ in results] == [200, 200]
+    assert results[0][2]['uuid'] == results[1][2]['uuid']
+    assert results[0][2]['status'] == 'completed'
+
+
+def test_fast_generate_reuses_completed_task(batcher):
+    prompt = f"cat {uuid_lib.uuid4()}"
+    [(_, _, first)] = fast_generate({"prompt": prompt})
+    result_cache.put(first['uuid'], completed(first['uuid']))
+
+    [(status, headers, body)] = fast_generate({"prompt": prompt})
+    assert status == 200 and len(batcher.submitted) == 1
+    assert body == {"uuid": first['uuid'], "status": "completed", "image_urls": [f"http://img/{first['uuid']}.png"],
+                    "fast_mode": True, "cached": True}
+    assert headers[CACHE_HEADER] == 'HIT'
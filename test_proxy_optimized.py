@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+zimage_proxy_optimized 路由测试：/v1/fast-generate 与其他端点走同一个提交流程（任务日志、登记表、准入拒绝）
+微批提交器和轮询器用替身代替，不需要运行中的服务
+"""
+
+import uuid as uuid_lib
+
+import pytest
+
+import zimage_proxy_optimized
+import zimage_submit
+from zimage_admission import AdmissionController, AdmissionRejected
+from zimage_journal import task_journal
+from zimage_registry import task_registry
+
+
+class FakeBatcher:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, payload, ticket=None, timeout=None):
+        self.submitted.append(payload)
+        if payload['prompt'] == 'busy':
+            raise AdmissionRejected(ticket)
+        return 200, {"success": True, "data": {"uuid": str(uuid_lib.uuid4())}}
+
+
+class FakePoller:
+    def wait_for_completion(self, uuid, timeout=None):
+        return {"status": "completed", "task": {"taskStatus": "completed", "resultUrls": [f"http://img/{uuid}.png"]}}
+
+
+@pytest.fixture
+def batcher(monkeypatch):
+    fake = FakeBatcher()
+    monkeypatch.setattr(zimage_submit, 'micro_batcher', fake)
+    monkeypatch.setattr(zimage_proxy_optimized, 'task_poller', FakePoller())
+    return fake
+
+
+@pytest.fixture
+def client():
+    return zimage_proxy_optimized.app.test_client()
+
+
+def test_fast_generate_records_journal_and_registry(client, batcher, monkeypatch):
+    journaled = []
+    monkeypatch.setattr(task_journal, 'record_submit', lambda uuid, params, callback_url=None: journaled.append(uuid))
+    response = client.post('/v1/fast-generate', json={"prompt": "cat"})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['status'] == 'completed' and body['image_urls'] == [f"http://img/{body['uuid']}.png"]
+    assert [payload['steps'] for payload in batcher.submitted] == [4]
+    assert journaled == [body['uuid']]
+    assert task_registry.get(body['uuid']).tag == 'fast'
+
+
+def test_fast_generate_admission_rejected(client, batcher, monkeypatch):
+    monkeypatch.setattr(zimage_submit, 'admission', AdmissionController(max_in_flight=1, track=lambda uuid: None))
+    response = client.post('/v1/fast-generate', json={"prompt": "busy"})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(response.get_json()['retry_after'])
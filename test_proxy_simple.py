@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+zimage_proxy_simple 路由测试：微批成员 ID 只拿到属于自己的那张图
+上游状态查询用替身代替，不需要运行中的服务
+"""
+
+import uuid as uuid_lib
+
+import pytest
+
+import zimage_proxy_simple
+from zimage_batcher import member_id
+from zimage_coalesce import task_status
+
+
+@pytest.fixture
+def parent_uuid(monkeypatch):
+    """上游合并提交的任务：已完成，三个成员各一张图"""
+    parent = str(uuid_lib.uuid4())
+    urls = [f"https://img.example/{parent}/{index}.png" for index in range(3)]
+
+    def fetch(uuid, timeout=None):
+        assert uuid == parent
+        return {"success": True, "data": {"uuid": parent, "task": {"taskStatus": "completed", "resultUrls": urls}}}
+
+    monkeypatch.setattr(task_status, 'fetch', fetch)
+    return parent
+
+
+@pytest.fixture
+def client():
+    return zimage_proxy_simple.app.test_client()
+
+
+def test_extract_task_id_keeps_member_suffix(parent_uuid):
+    assert zimage_proxy_simple.extract_task_id(member_id(parent_uuid, 2)) == member_id(parent_uuid, 2)
+    assert zimage_proxy_simple.extract_task_id(parent_uuid) == parent_uuid
+    assert zimage_proxy_simple.extract_task_id("not-a-task~1") is None
+
+
+def test_image_results_for_member(client, parent_uuid):
+    response = client.get(f"/v1/images/{member_id(parent_uuid, 1)}")
+    assert response.status_code == 200
+    assert response.get_json()["data"]["images"] == [f"https://img.example/{parent_uuid}/1.png"]
+
+
+def test_task_status_for_member(client, parent_uuid):
+    response = client.get(f"/v1/tasks/{member_id(parent_uuid, 2)}")
+    assert response.status_code == 200
+    assert response.get_json()["data"]["task"]["resultUrls"] == [f"https://img.example/{parent_uuid}/2.png"]
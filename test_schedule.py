@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+zimage_schedule 单元测试：由完成耗时历史计算轮询间隔
+"""
+
+import time
+
+import pytest
+
+from zimage_schedule import (
+    EXPLORE_EVERY, FAST_INTERVAL, HISTORY_MIN_SAMPLES, MAX_INTERVAL, MIN_INTERVAL, CompletionHistory, fixed_interval
+)
+
+PARAMS = {"model": "turbo", "width": 1024, "height": 1024, "steps": 8, "batch_size": 1}
+FAST_PARAMS = {"model": "turbo", "width": 512, "height": 512, "steps": 4, "batch_size": 1}
+DURATIONS = [10, 11, 12, 13, 14]  # p10 = 10, p90 = 13
+
+
+@pytest.fixture
+def history():
+    """已按 PARAMS 记录 DURATIONS 的历史"""
+    history = CompletionHistory()
+    base = time.time()
+    for index, duration in enumerate(DURATIONS):
+        uuid = f"sample-{index}"
+        history.register(uuid, PARAMS, submitted_at=base)
+        history.record(uuid, base + duration - 0.1, base + duration + 0.1)
+    assert history.recorded == len(DURATIONS) >= HISTORY_MIN_SAMPLES
+    return history
+
+
+def registered(history, uuid, params=PARAMS):
+    submitted_at = time.time()
+    history.register(uuid, params, submitted_at=submitted_at)
+    return submitted_at
+
+
+@pytest.mark.parametrize("elapsed, expected", [
+    (2, MAX_INTERVAL),  # 离 p10 还远：等到 p10，但不超过 MAX_INTERVAL
+    (9, 1),  # 等到 p10
+    (11, MIN_INTERVAL),  # p10~p90 之间密集轮询：(13 - 10) / 8，不低于 MIN_INTERVAL
+    (20, MIN_INTERVAL + (20 - 13) / 2),  # 超过 p90 后逐步放缓
+    (100, MAX_INTERVAL),
+])
+def test_next_interval_follows_quantiles(history, elapsed, expected):
+    submitted_at = registered(history, "task")
+    assert history.next_interval("task", 1, 0, now=submitted_at + elapsed) == pytest.approx(expected)
+    assert history.predicted_polls == 1
+
+
+def test_next_interval_backs_off_on_errors(history):
+    registered(history, "task")
+    assert [history.next_interval("task", 1, errors) for errors in (1, 2, 3, 4, 5)] == [2, 4, 8, 10, 10]
+
+
+def test_next_interval_without_history_uses_fixed_schedule():
+    history = CompletionHistory()
+    assert [history.next_interval("unknown", polls, 0) for polls in (0, 5, 20)] == [1, 2, 3]
+    assert history.fixed_polls == 3
+
+
+def test_next_interval_fast_profile_without_history():
+    history = CompletionHistory()
+    registered(history, "fast", FAST_PARAMS)
+    assert history.next_interval("fast", 0, 0) == FAST_INTERVAL
+    assert history.next_interval("fast", 20, 0) == fixed_interval(20)
+
+
+def test_explore_tasks_use_fixed_schedule(history):
+    # 每个参数组合每 EXPLORE_EVERY 个任务有一个按固定节奏轮询
+    for index in range(len(DURATIONS), EXPLORE_EVERY):
+        registered(history, f"filler-{index}")
+    submitted_at = registered(history, "explore")
+    assert history.next_interval("explore", 0, 0, now=submitted_at + 2) == fixed_interval(0)
+
+
+def test_record_skips_imprecise_samples():
+    history = CompletionHistory()
+    submitted_at = registered(history, "task")
+    # 两次轮询相隔太久，完成时刻不确定
+    history.record("task", submitted_at + 1, submitted_at + 10)
+    assert history.recorded == 0
+    # 只记录一次，之后的调用忽略
+    history.record("task", submitted_at + 9.9, submitted_at + 10)
+    assert history.recorded == 0
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+zimage_state 单元测试：shm 后端的共享哈希表（滑动窗口、每日限额、条带满、换日复用、文件格式校验）
+"""
+
+import itertools
+
+import pytest
+
+pytest.importorskip("fcntl")
+
+from zimage_state import ALLOWED, DAILY_LIMITED, RATE_LIMITED, ShmStateBackend, StateBackendError
+
+WINDOW = 60
+START = WINDOW * 1000.0  # 窗口起点
+DAY = "2026-01-01"
+NEXT_DAY = "2026-01-02"
+
+
+@pytest.fixture
+def table_path(tmp_path):
+    return str(tmp_path / "ratelimit")
+
+
+@pytest.fixture
+def backend(table_path):
+    return ShmStateBackend(table_path, slots=ShmStateBackend.STRIPES * ShmStateBackend.MAX_PROBE)
+
+
+def acquire(backend, ip, now=START, day=DAY, limit=3, daily_limit=100):
+    return backend.acquire(ip, now, day, WINDOW, limit, daily_limit)
+
+
+def test_window_limit(backend):
+    assert [acquire(backend, "1.1.1.1") for _ in range(4)] == [ALLOWED, ALLOWED, ALLOWED, RATE_LIMITED]
+    assert backend.usage("1.1.1.1", START + 1, DAY, WINDOW) == (3, 3)
+    assert backend.usage("2.2.2.2", START, DAY, WINDOW) == (0, 0)
+    # 其他 IP 不受影响
+    assert acquire(backend, "2.2.2.2") == ALLOWED
+
+
+def test_sliding_window_weights_previous_window(backend):
+    for _ in range(3):
+        acquire(backend, "1.1.1.1")
+    # 下一个窗口过半：上一窗口的 3 次按 50% 计入
+    middle = START + WINDOW * 1.5
+    assert [acquire(backend, "1.1.1.1", middle) for _ in range(3)] == [ALLOWED, ALLOWED, RATE_LIMITED]
+    # 两个窗口之后不再计入
+    assert acquire(backend, "1.1.1.1", START + WINDOW * 3) == ALLOWED
+
+
+def test_daily_limit(backend):
+    verdicts = [acquire(backend, "1.1.1.1", START + WINDOW * i, daily_limit=2) for i in range(3)]
+    assert verdicts == [ALLOWED, ALLOWED, DAILY_LIMITED]
+    assert backend.usage("1.1.1.1", START + WINDOW * 2, DAY, WINDOW)[1] == 2
+    # 换日后重新计数
+    assert acquire(backend, "1.1.1.1", START + WINDOW * 3, NEXT_DAY, daily_limit=2) == ALLOWED
+
+
+def test_instances_share_the_table(backend, table_path):
+    other = ShmStateBackend(table_path, slots=backend.slots)
+    acquire(backend, "1.1.1.1")
+    acquire(other, "1.1.1.1")
+    assert backend.usage("1.1.1.1", START, DAY, WINDOW) == (2, 2)
+    assert other.usage("1.1.1.1", START, DAY, WINDOW) == (2, 2)
+
+
+def test_layout_mismatch_is_refused(backend, table_path):
+    with pytest.raises(StateBackendError):
+        ShmStateBackend(table_path, slots=backend.slots * 2)
+
+
+def same_stripe_ips(backend, stripe, count):
+    ips = (f"10.0.{n // 256}.{n % 256}" for n in itertools.count())
+    return list(itertools.islice((ip for ip in ips if backend._hash(ip) % backend.STRIPES == stripe), count))
+
+
+def test_full_stripe_raises_and_is_reused_next_day(backend):
+    ips = same_stripe_ips(backend, 0, backend.MAX_PROBE + 1)
+    for ip in ips[:-1]:
+        assert acquire(backend, ip) == ALLOWED
+    with pytest.raises(StateBackendError):
+        acquire(backend, ips[-1])
+    assert backend.table_full == 1
+    # 其他条带不受影响
+    assert acquire(backend, same_stripe_ips(backend, 1, 1)[0]) == ALLOWED
+    # 换日且窗口已过期的槽位被复用
+    assert acquire(backend, ips[-1], START + WINDOW * 2, NEXT_DAY) == ALLOWED
+    assert backend.usage(ips[0], START + WINDOW * 2, NEXT_DAY, WINDOW) == (0, 0)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+zimage_submit 单元测试：共用提交流程的成功登记、准入拒绝、上游错误和登记表已满
+微批提交器用替身代替，不需要运行中的服务
+"""
+
+import uuid as uuid_lib
+
+import pytest
+
+import zimage_submit
+from zimage_admission import AdmissionController, AdmissionRejected
+from zimage_registry import task_registry
+from zimage_submit import REGISTRY_FULL_ERROR, submit_generation
+
+
+class FakeBatcher:
+    """代替微批提交器：按 prompt 返回成功、上游错误或准入拒绝"""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, payload, ticket=None, timeout=None):
+        self.submitted.append((payload, timeout))
+        if payload['prompt'] == 'busy':
+            raise AdmissionRejected(ticket)
+        if payload['prompt'] == 'fail':
+            return 200, {"success": False, "error": "boom"}
+        return 200, {"success": True, "data": {"uuid": str(uuid_lib.uuid4())}}
+
+
+@pytest.fixture
+def batcher(monkeypatch):
+    fake = FakeBatcher()
+    monkeypatch.setattr(zimage_submit, 'micro_batcher', fake)
+    return fake
+
+
+def payload(prompt):
+    return {"prompt": prompt, "model": "turbo", "batch_size": 1, "width": 512, "height": 512, "steps": 4}
+
+
+def test_submit_registers_task(batcher):
+    submission = submit_generation(payload("cat"), "1.2.3.4", register=True, tag='fast', timeout=60)
+    assert submission.ok and not submission.cached and not submission.deduplicated
+    assert batcher.submitted == [(payload("cat"), 60)]
+    assert task_registry.get(submission.uuid).tag == 'fast'
+    assert submission.queue['position'] == 0
+
+
+def test_submit_upstream_error(batcher):
+    submission = submit_generation(payload("fail"), "1.2.3.4")
+    assert not submission.ok and not submission.rejected
+    assert submission.upstream_error == "boom"
+    assert (submission.body, submission.status_code, submission.headers) == ({"error": "boom"}, 200, {})
+    assert submission.uuid is None
+
+
+def test_submit_admission_rejected(batcher, monkeypatch):
+    controller = AdmissionController(max_in_flight=1, queue_size=0, track=lambda uuid: None)
+    monkeypatch.setattr(zimage_submit, 'admission', controller)
+    submission = submit_generation(payload("busy"), "1.2.3.4")
+    assert submission.rejected and submission.upstream_error is None
+    assert submission.status_code == 503
+    assert submission.body['error'] == "Server busy"
+    assert submission.headers == {'Retry-After': str(submission.retry_after)}
+
+
+def test_submit_registry_full(batcher, monkeypatch):
+    monkeypatch.setattr(task_registry, 'has_capacity', lambda: False)
+    submission = submit_generation(payload("cat"), "1.2.3.4", register=True)
+    assert (submission.body, submission.status_code) == ({"error": REGISTRY_FULL_ERROR}, 503)
+    assert batcher.submitted == []
+    # 不登记的调用方（批量作业、主服务）不检查登记表容量
+    assert submit_generation(payload("cat"), "1.2.3.4").ok
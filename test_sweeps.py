@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+zimage_sweeps 单元测试：网格展开、参数校验、并发数，以及每个格子的频率限制
+"""
+
+import uuid as uuid_lib
+
+import pytest
+
+import zimage_batches
+import zimage_submit
+import zimage_usage
+from test_batches import FakePoller, FakeSubmitter
+from zimage_batches import BatchJob, BatchRunner
+from zimage_presets import PRESETS
+from zimage_sweeps import DEFAULT_CELL, SWEEP_CONCURRENCY, SWEEP_MAX_CELLS, expand_sweep, sweep_concurrency
+
+
+def test_expand_sweep_defaults_to_one_cell():
+    cells, error = expand_sweep({"prompt": "cat"})
+    assert error is None
+    [(params, payload)] = cells
+    assert params == {"preset": None, "width": DEFAULT_CELL['width'], "height": DEFAULT_CELL['height'],
+                      "steps": DEFAULT_CELL['steps'], "cfg_scale": DEFAULT_CELL['cfg_scale'], "model": "zimage-turbo"}
+    assert payload['batch_size'] == 1
+
+
+def test_expand_sweep_cartesian_product():
+    cells, error = expand_sweep({"prompt": "cat", "presets": ["fast", "quality"], "sizes": ["768x1024", [512, 512]],
+                                 "steps": [4, 8], "cfg_scale": 5, "model": ["zimage-turbo", "zimage-base"]})
+    assert error is None
+    assert len(cells) == 2 * 2 * 2 * 1 * 2
+    params, payload = cells[0]
+    assert params == {"preset": "fast", "width": 768, "height": 1024, "steps": 4, "cfg_scale": 5, "model": "zimage-turbo"}
+    assert payload['negative_prompt'] == PRESETS['fast']['negative_prompt']
+    assert {payload['model'] for _, payload in cells} == {"turbo", "base"}
+
+
+def test_expand_sweep_width_height_axes():
+    cells, error = expand_sweep({"prompt": "cat", "preset": "balanced", "width": [512, 768], "height": 1024})
+    assert error is None
+    assert [(params['width'], params['height']) for params, _ in cells] == [(512, 1024), (768, 1024)]
+
+
+def test_expand_sweep_presets_never_batch():
+    """预设里的 batch_size 只用于 chat completions，每个格子固定一张图"""
+    cells, error = expand_sweep({"prompt": "cat", "presets": list(PRESETS)})
+    assert error is None
+    assert {payload['batch_size'] for _, payload in cells} == {1}
+    assert [params['width'] for params, _ in cells] == [preset['width'] for preset in PRESETS.values()]
+
+
+@pytest.mark.parametrize("data, message", [
+    ([], "Request body must be a JSON object"),
+    ("cat", "Request body must be a JSON object"),
+    ({}, "Prompt is required"),
+    ({"prompt": "cat", "preset": "turbo"}, "Unknown preset: turbo"),
+    ({"prompt": "cat", "preset": {"x": 1}}, "Unknown preset"),
+    ({"prompt": "cat", "sizes": ["big"]}, "Invalid size"),
+    ({"prompt": "cat", "sizes": ["0x512"]}, "width must be between"),
+    ({"prompt": "cat", "width": 0}, "width must be between"),
+    ({"prompt": "cat", "height": [512, -1]}, "height must be between"),
+    ({"prompt": "cat", "steps": [4, 0]}, "steps must be between"),
+    ({"prompt": "cat", "cfg_scale": "high"}, "cfg_scale must be a number"),
+])
+def test_expand_sweep_errors(data, message):
+    cells, error = expand_sweep(data)
+    assert cells == []
+    assert error.startswith(message)
+
+
+def test_expand_sweep_cell_limit():
+    models = [f"model-{i}" for i in range(SWEEP_MAX_CELLS + 1)]
+    cells, error = expand_sweep({"prompt": "cat", "model": models})
+    assert cells == []
+    assert error == f"Sweep expands to {SWEEP_MAX_CELLS + 1} combinations, the limit is {SWEEP_MAX_CELLS}"
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, SWEEP_CONCURRENCY),
+    ("x", SWEEP_CONCURRENCY),
+    (0, 1),
+    (-5, 1),
+    (2, min(2, SWEEP_CONCURRENCY)),
+    (SWEEP_CONCURRENCY + 10, SWEEP_CONCURRENCY),
+])
+def test_sweep_concurrency(value, expected):
+    assert sweep_concurrency(value) == expected
+
+
+def test_sweep_cells_count_against_rate_limit(monkeypatch):
+    submitter = FakeSubmitter()
+    monkeypatch.setattr(zimage_submit, 'micro_batcher', submitter)
+    monkeypatch.setattr(zimage_batches, 'task_poller', FakePoller())
+    ip = f"test-{uuid_lib.uuid4().hex}"
+    cells, error = expand_sweep({"prompt": "cat", "steps": list(range(1, zimage_usage.RATE_LIMIT_REQUESTS + 3))})
+    assert error is None
+
+    job = BatchJob("batch_sweep_test")
+    job.cells = [params for params, _ in cells]
+    runner = BatchRunner(job, concurrency=sweep_concurrency(4), client_ip=ip)
+    for _, payload in cells:
+        runner.add_item(None, payload)
+    runner.close()
+    finished, done = 0, False
+    while not done:
+        results, done = job.wait(finished, 5)
+        finished += len(results)
+
+    assert job.counts == {"completed": zimage_usage.RATE_LIMIT_REQUESTS, "rate_limited": 2}
+    assert len(submitter.submitted) == zimage_usage.RATE_LIMIT_REQUESTS
+    grid = job.summary()['grid']
+    assert [cell['steps'] for cell in grid] == list(range(1, zimage_usage.RATE_LIMIT_REQUESTS + 3))
+    assert sum(1 for cell in grid if cell['status'] == 'rate_limited') == 2
@@ -1,6 +1,7 @@
 // 全局变量
 let currentTaskId = null;
 let generationInterval = null;
+let taskEventSource = null;
 let startTime = null;
 let elapsedTimeInterval = null;
 let isGenerating = false;
@@ -303,6 +304,67 @@ async function generateImage() {
 }
 
 function startTaskPolling() {
+    // 更新时间显示
+    elapsedTimeInterval = setInterval(() => {
+        const elapsed = Math.floor((Date.now() - startTime) / 1000);
+        document.getElementById('progressTime').textContent = `${elapsed}s`;
+    }, 1000);
+
+    // 优先使用事件流（一个长连接），浏览器或服务器不支持时回退到定时轮询
+    if (window.EventSource) {
+        startTaskEvents();
+    } else {
+        startIntervalPolling();
+    }
+}
+
+function startTaskEvents() {
+    taskEventSource = new EventSource(`${API_CONFIG.baseUrl}/v1/tasks/${currentTaskId}/events`);
+
+    taskEventSource.addEventListener('status', (event) => {
+        const data = JSON.parse(event.data);
+        updateProgress(data.progress || 0, Math.floor((Date.now() - startTime) / 1000));
+    });
+
+    taskEventSource.addEventListener('completed', async (event) => {
+        closeTaskEvents();
+        await handleTaskCompleted(JSON.parse(event.data).task);
+    });
+
+    taskEventSource.addEventListener('failed', () => {
+        closeTaskEvents();
+        handleTaskFailed();
+    });
+
+    taskEventSource.addEventListener('task_error', (event) => {
+        closeTaskEvents();
+        addLog(`❌ 任务查询失败：${JSON.parse(event.data).error}`, 'error');
+        handleTaskFailed();
+    });
+
+    taskEventSource.addEventListener('timeout', () => {
+        closeTaskEvents();
+        handleTaskTimeout();
+    });
+
+    taskEventSource.onerror = () => {
+        // 连接失败或中途断开：改为定时轮询
+        closeTaskEvents();
+        if (isGenerating && currentTaskId) {
+            addLog('⚠️ 事件流不可用，改为定时轮询', 'warning');
+            startIntervalPolling();
+        }
+    };
+}
+
+function closeTaskEvents() {
+    if (taskEventSource) {
+        taskEventSource.close();
+        taskEventSource = null;
+    }
+}
+
+function startIntervalPolling() {
     let attempt = 0;
     const maxAttempts = 60; // 最多轮询60次（5分钟）
 
@@ -351,12 +413,6 @@ function startTaskPolling() {
             addLog(`⚠️ 状态检查失败：${error.message}`, 'warning');
         }
     }, 2000); // 每2秒检查一次
-
-    // 更新时间显示
-    elapsedTimeInterval = setInterval(() => {
-        const elapsed = Math.floor((Date.now() - startTime) / 1000);
-        document.getElementById('progressTime').textContent = `${elapsed}s`;
-    }, 1000);
 }
 
 function updateProgress(progress, elapsed) {
@@ -461,6 +517,7 @@ function updateGeneratingUI(generating) {
 }
 
 function cancelGeneration() {
+    closeTaskEvents();
     if (generationInterval) {
         clearInterval(generationInterval);
     }
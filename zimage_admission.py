@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Z-Image 准入控制（ZIMAGE_MAX_IN_FLIGHT > 0 开启）
+限制同时在上游生成中的任务数：提交前先占一个名额，任务完成或失败后归还。
+名额用完时请求按优先级排队（fast 小图少步数优先于 quality），队列满或排队超时
+直接返回 503 + Retry-After，突发流量下已接收的请求不至于一起超时。
+排队位置和预计等待时间由名额的平均占用时长估算
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, Optional
+
+from zimage_poller import task_poller
+
+logger = logging.getLogger(__name__)
+
+MAX_IN_FLIGHT = int(os.environ.get('ZIMAGE_MAX_IN_FLIGHT', '0'))  # 同时在上游生成的任务上限，0 不限制
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ZIMAGE_ADMISSION_QUEUE_SIZE', '100'))  # 排队请求上限，超出直接 503
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ZIMAGE_ADMISSION_QUEUE_TIMEOUT', '20'))  # 最长排队时间（秒）
+ADMISSION_HOLD_MAX = 300  # 一直没观察到结束的任务，占用名额的最长时间（秒）
+DEFAULT_HOLD_SECONDS = 10.0  # 还没有完成样本时假定的名额占用时长
+
+PRIORITY_FAST = 0
+PRIORITY_QUALITY = 1
+PRIORITY_NAMES = {PRIORITY_FAST: 'fast', PRIORITY_QUALITY: 'quality'}
+FAST_MAX_WORK = 512 * 512 * 8  # 像素数 × 步数 × 张数不超过该值的请求按 fast 排队
+
+
+def priority_for(payload: Dict[str, Any]) -> int:
+    """按生成工作量划分优先级：小图、少步数的请求完成快，优先放行"""
+    try:
+        work = int(payload.get('width', 1024)) * int(payload.get('height', 1024)) \
+            * int(payload.get('steps', 8)) * int(payload.get('batch_size', 1))
+    except (TypeError, ValueError):
+        return PRIORITY_QUALITY
+    return PRIORITY_FAST if work <= FAST_MAX_WORK else PRIORITY_QUALITY
+
+
+class AdmissionRejected(Exception):
+    """排队已满或排队超时；调用方用自己的凭证的 rejection() / retry_after 构造 503 响应"""
+
+    def __init__(self, ticket: 'AdmissionTicket'):
+        super().__init__(ticket.rejected or "Admission queue timeout")
+        self.ticket = ticket
+
+
+class AdmissionTicket:
+    """
+    一次提交的准入凭证，作为上下文管理器包住提交过程：
+    enter() 排队、wait() 放行后提交（或交给微批处理器调用 admit()），成功拿到任务 UUID 时 bind(uuid)，
+    名额在任务结束时归还；未 bind 就退出（提交失败、提前返回）时立即归还或退出队列。
+    不带 controller 的凭证不做任何限制（缓存命中、复用进行中的任务、未开启准入控制）
+    """
+
+    def __init__(self, controller: Optional['AdmissionController'] = None, priority: int = PRIORITY_QUALITY):
+        self._controller = controller
+        self.priority = priority
+        self.enqueued_at = time.time()
+        self.granted_at: Optional[float] = None
+        self.bound_at: Optional[float] = None
+        self.position = 0  # 进入队列时前面的请求数
+        self.eta = 0.0  # 进入队列时的预计等待（秒）
+        self.rejected: Optional[str] = None
+        self.uuid: Optional[str] = None
+        self._granted = threading.Event()
+        self._on_grant: Optional[Callable[[], None]] = None
+        self._running = False  # 占着名额但还没拿到任务 UUID
+        self._entered = controller is None
+        if controller is None:
+            self.granted_at = self.enqueued_at
+            self._granted.set()
+
+    @property
+    def granted(self) -> bool:
+        return self._granted.is_set()
+
+    def enter(self) -> 'AdmissionTicket':
+        """进入排队，有空余名额时立即放行；重复调用无效"""
+        if not self._entered:
+            self._entered = True
+            self._controller._enter(self)
+        return self
+
+    def admit(self, timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        """enter() + wait()，被拒绝或排队超时抛出 AdmissionRejected"""
+        if not self.enter().wait(timeout):
+            raise AdmissionRejected(self)
+
+    def follow(self, leader: Optional['AdmissionTicket']):
+        """
+        微批成员：合并进别人的上游提交，不占名额（一次上游提交只占一个名额，由代表整批提交的凭证持有）；
+        排队信息和拒绝原因沿用该凭证
+        """
+        self._controller = None
+        if leader is not None:
+            self.position, self.eta, self.rejected = leader.position, leader.eta, leader.rejected
+            self.enqueued_at, self.granted_at = leader.enqueued_at, leader.granted_at
+        if self.granted_at is not None:
+            self._granted.set()
+
+    def wait(self, timeout: float = ADMISSION_QUEUE_TIMEOUT) -> bool:
+        """阻塞到放行；被拒绝或排队超时返回 False（超时会退出队列）"""
+        if self.rejected:
+            return False
+        if not self._granted.wait(timeout) and self._controller.withdraw(self):
+            return False
+        # 超时的同时被放行也算放行
+        return True
+
+    def bind(self, uuid: str):
+        if self.uuid is not None:
+            return
+        self.uuid = uuid
+        if self._controller is not None:
+            self._controller.bind(self, uuid)
+
+    def info(self) -> Dict[str, Any]:
+        """响应体中的排队信息；eta_seconds 为进入队列时的预计等待，与 rejection() 相同"""
+        waited = (self.granted_at or time.time()) - self.enqueued_at
+        return {
+            "position": self.position,
+            "eta_seconds": round(self.eta, 1),
+            "waited_ms": int(waited * 1000)
+        }
+
+    def rejection(self) -> Dict[str, Any]:
+        """503 响应体；Retry-After 取 retry_after"""
+        return {
+            "error": "Server busy",
+            "message": self.rejected or "Too many generations in progress, please retry later",
+            "queue_position": self.position,
+            "eta_seconds": round(self.eta, 1),
+            "retry_after": self.retry_after
+        }
+
+    @property
+    def retry_after(self) -> int:
+        return max(1, int(math.ceil(self.eta)))
+
+    def __enter__(self) -> 'AdmissionTicket':
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._controller is not None and self.uuid is None:
+            self._controller.cancel(self)
+        return False
+
+
+class AdmissionController:
+    """有界的上游生成名额 + 按优先级排队"""
+
+    def __init__(self, max_in_flight: int = MAX_IN_FLIGHT, queue_size: int = ADMISSION_QUEUE_SIZE,
+                 track: Optional[Callable[[str], None]] = None):
+        self.max_in_flight = max_in_flight
+        self.queue_size = max(0, queue_size)
+        self._track = track  # 开始跟踪已提交任务，结束时需调用 finished(uuid)；默认使用集中式轮询器
+        self._lock = threading.Lock()
+        self._queues: Dict[int, Deque[AdmissionTicket]] = {priority: deque() for priority in PRIORITY_NAMES}
+        self._running = 0  # 已放行、还没拿到任务 UUID 的提交
+        self._held: "OrderedDict[str, AdmissionTicket]" = OrderedDict()  # uuid -> 凭证，按提交顺序
+        self._hold_seconds = DEFAULT_HOLD_SECONDS  # 名额平均占用时长（指数滑动平均）
+        self._listening = False
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.expired = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_in_flight > 0
+
+    def ticket(self, priority: int = PRIORITY_QUALITY) -> AdmissionTicket:
+        """还没排队的凭证：经微批提交时由代表整批提交的请求 enter()，合并进来的请求不占名额"""
+        return AdmissionTicket(self, priority) if self.enabled else AdmissionTicket(priority=priority)
+
+    def enter(self, priority: int = PRIORITY_QUALITY) -> AdmissionTicket:
+        """申请名额：有空余时立即放行，否则排队；队列已满时返回已拒绝的凭证"""
+        return self.ticket(priority).enter()
+
+    def _enter(self, ticket: AdmissionTicket):
+        ticket.enqueued_at = time.time()
+        with self._lock:
+            self._expire(ticket.enqueued_at)
+            if self._in_flight() < self.max_in_flight and not any(self._queues.values()):
+                self._grant(ticket)
+                return
+            ticket.position = self._position(ticket.priority)
+            ticket.eta = self._estimate(ticket.position)
+            if sum(len(queue) for queue in self._queues.values()) >= self.queue_size:
+                ticket.rejected = "Generation queue is full, please retry later"
+                self.rejected += 1
+                return
+            self._queues[ticket.priority].append(ticket)
+            self.queued += 1
+
+    def on_grant(self, ticket: AdmissionTicket, callback: Callable[[], None]) -> bool:
+        """注册放行回调（asyncio 版本用来唤醒事件循环）；已放行时返回 True 且不注册"""
+        with self._lock:
+            if ticket.granted:
+                return True
+            ticket._on_grant = callback
+            return False
+
+    def withdraw(self, ticket: AdmissionTicket) -> bool:
+        """排队超时：退出队列；已被放行时返回 False"""
+        with self._lock:
+            queue = self._queues[ticket.priority]
+            if ticket not in queue:
+                return False
+            queue.remove(ticket)
+            self.timed_out += 1
+            ticket.eta = self._estimate(self._position(ticket.priority))
+            return True
+
+    def cancel(self, ticket: AdmissionTicket):
+        """退出队列，或归还已放行但没有提交成功的名额"""
+        with self._lock:
+            queue = self._queues[ticket.priority]
+            if ticket in queue:
+                queue.remove(ticket)
+            elif ticket._running:
+                ticket._running = False
+                self._running -= 1
+                self._dispatch()
+
+    def bind(self, ticket: AdmissionTicket, uuid: str):
+        """提交成功：名额转给该任务，直到观察到任务结束"""
+        with self._lock:
+            if ticket._running:
+                ticket._running = False
+                self._running -= 1
+            self._held[uuid] = ticket
+            ticket.bound_at = time.time()
+        self._start_tracking(uuid)
+
+    def finished(self, uuid: str):
+        """任务结束（完成或失败），归还名额"""
+        with self._lock:
+            ticket = self._held.pop(uuid, None)
+            if ticket is None:
+                return
+            hold = time.time() - ticket.bound_at
+            self._hold_seconds = self._hold_seconds * 0.9 + hold * 0.1
+            self._dispatch()
+
+    def queue_status(self) -> Dict[str, Any]:
+        """当前排队情况，以及新请求各优先级的预计等待"""
+        with self._lock:
+            self._expire(time.time())
+            in_flight = self._in_flight()
+            queued = {PRIORITY_NAMES[priority]: len(queue) for priority, queue in self._queues.items()}
+            estimates = {}
+            for priority, name in PRIORITY_NAMES.items():
+                position = self._position(priority)
+                free = in_flight < self.max_in_flight and position == 0
+                estimates[name] = 0.0 if free or not self.enabled else round(self._estimate(position), 1)
+            return {
+                "enabled": self.enabled,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": in_flight,
+                "queued": queued,
+                "queue_size": self.queue_size,
+                "avg_hold_seconds": round(self._hold_seconds, 2),
+                "eta_seconds": estimates
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        status = self.queue_status()
+        with self._lock:
+            status.update({
+                "admitted": self.admitted,
+                "queued_total": self.queued,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "expired": self.expired
+            })
+        return status
+
+    # ---- 内部实现（调用方需持有 self._lock） ----
+
+    def _in_flight(self) -> int:
+        return self._running + len(self._held)
+
+    def _position(self, priority: int) -> int:
+        """该优先级的新请求前面排着的请求数"""
+        return sum(len(queue) for queue_priority, queue in self._queues.items() if queue_priority <= priority)
+
+    def _estimate(self, position: int) -> float:
+        """前面有 position 个请求时的预计等待：每轮放行 max_in_flight 个，每轮约一个平均占用时长"""
+        rounds = position // max(1, self.max_in_flight) + 1
+        return rounds * self._hold_seconds
+
+    def _grant(self, ticket: AdmissionTicket):
+        ticket.granted_at = time.time()
+        ticket._running = True
+        self._running += 1
+        self.admitted += 1
+        ticket._granted.set()
+        if ticket._on_grant is not None:
+            ticket._on_grant()
+
+    def _dispatch(self):
+        """有空余名额时按优先级放行排队的请求"""
+        for priority in sorted(self._queues):
+            queue = self._queues[priority]
+            while queue and self._in_flight() < self.max_in_flight:
+                self._grant(queue.popleft())
+
+    def _expire(self, now: float):
+        """一直没观察到结束的任务（无人查询、跟踪中断）超过 ADMISSION_HOLD_MAX 后归还名额"""
+        released = False
+        while self._held:
+            uuid, ticket = next(iter(self._held.items()))
+            if now - ticket.bound_at <= ADMISSION_HOLD_MAX:
+                break
+            del self._held[uuid]
+            self.expired += 1
+            released = True
+        if released:
+            self._dispatch()
+
+    def _start_tracking(self, uuid: str):
+        if self._track is not None:
+            self._track(uuid)
+            return
+        if not self._listening:
+            with self._lock:
+                if not self._listening:
+                    task_poller.add_listener(lambda snapshot: self.finished(snapshot['uuid']))
+                    self._listening = True
+        task_poller.watch(uuid)
+
+
+# 进程级共享实例
+admission = AdmissionController()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Z-Image 提交微批处理（可选，ZIMAGE_MICROBATCH_WINDOW_MS > 0 开启）
+几毫秒窗口内参数完全相同、batch_size=1 的并发提交合并为一次 batch_size=N 的上游提交，
+上游的排队和提交开销由多个调用方分摊，准入名额也按上游提交计：只有代表整批提交的请求排队占名额，
+排队期间到达的相同请求继续并入这一批。每个调用方拿到自己的任务 ID（<上游 UUID>~<序号>），
+查询状态时由 task_status 查询上游任务并只返回 resultUrls 中属于该调用方的那一张图。
+任务 ID 本身携带上游 UUID 和序号，多进程部署下任一进程都能解析
+"""
+
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from zimage_upstream import upstream, ZIMAGE_GENERATE
+from zimage_gencache import payload_key
+
+logger = logging.getLogger(__name__)
+
+MICROBATCH_WINDOW_MS = float(os.environ.get('ZIMAGE_MICROBATCH_WINDOW_MS', '0'))  # 合并窗口（毫秒），0 关闭
+MICROBATCH_MAX_SIZE = int(os.environ.get('ZIMAGE_MICROBATCH_MAX_SIZE', '4'))  # 单次上游提交最多合并的请求数（上游 batch_size 上限）
+SUBMIT_TIMEOUT = 30  # 上游提交超时（秒）
+
+MEMBER_SEPARATOR = '~'
+
+
+def member_id(parent_uuid: str, index: int) -> str:
+    return f"{parent_uuid}{MEMBER_SEPARATOR}{index}"
+
+
+def split_member_id(uuid: str) -> Optional[Tuple[str, int]]:
+    """微批成员 ID 返回 (上游 UUID, 序号)，普通任务 UUID 返回 None"""
+    parent, separator, index = uuid.rpartition(MEMBER_SEPARATOR)
+    if not separator or not parent or not index.isdigit():
+        return None
+    return parent, int(index)
+
+
+def project_member(result: Dict, index: int) -> Dict:
+    """上游批量任务的状态结果 -> 单个成员的结果：resultUrls 只保留第 index 张"""
+    task = result.get('data', {}).get('task')
+    if not isinstance(task, dict):
+        return result
+    urls = task.get('resultUrls') or ([task['resultUrl']] if task.get('resultUrl') else [])
+    member_task = dict(task)
+    if task.get('taskStatus') == 'completed' and index >= len(urls):
+        # 上游返回的图片少于合并的请求数
+        member_task['taskStatus'] = 'failed'
+        member_task['errorMessage'] = f"Upstream batch returned {len(urls)} images, image #{index} missing"
+        member_task['resultUrls'] = []
+        member_task.pop('resultUrl', None)
+    elif urls:
+        member_task['resultUrls'] = [urls[index]] if index < len(urls) else []
+        if 'resultUrl' in task:
+            member_task['resultUrl'] = urls[index] if index < len(urls) else None
+    return dict(result, data=dict(result['data'], task=member_task))
+
+
+def submit_generation(payload: Dict[str, Any], timeout: float = SUBMIT_TIMEOUT) -> Tuple[int, Dict]:
+    """直接向上游提交，返回 (HTTP 状态码, 响应 JSON)；网络错误和 HTTP 错误抛出 requests 异常"""
+    response = upstream.post(ZIMAGE_GENERATE, json=payload, timeout=timeout)
+    response.raise_for_status()
+    return response.status_code, response.json()
+
+
+def batch_eligible(payload: Dict[str, Any]) -> bool:
+    try:
+        return int(payload.get('batch_size', 1)) == 1
+    except (TypeError, ValueError):
+        return False
+
+
+def member_result(result: Dict, parent_uuid: str, index: int) -> Dict:
+    """上游提交响应 -> 某个成员看到的提交响应"""
+    return dict(result, data=dict(result['data'], uuid=member_id(parent_uuid, index)))
+
+
+class _Batch:
+    """一个收集中 / 提交中的微批"""
+
+    __slots__ = ('size', 'full', 'done', 'status_code', 'result', 'error', 'ticket')
+
+    def __init__(self, ticket=None):
+        self.ticket = ticket  # 代表整批提交的请求的准入凭证
+        self.size = 1
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.status_code = None
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """窗口期内相同参数的 batch_size=1 提交合并为一次上游批量提交"""
+
+    def __init__(self, window_ms: float = MICROBATCH_WINDOW_MS, max_size: int = MICROBATCH_MAX_SIZE):
+        self.window = max(0.0, window_ms) / 1000
+        self.max_size = max(1, max_size)
+        self._lock = threading.Lock()
+        self._open: Dict[str, _Batch] = {}  # 参数哈希 -> 还在收集成员的批
+
+        self.requests = 0
+        self.upstream_submits = 0
+        self.batched_requests = 0
+        self.largest_batch = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 and self.max_size > 1
+
+    def submit(self, payload: Dict[str, Any], ticket=None, timeout: float = SUBMIT_TIMEOUT) -> Tuple[int, Dict]:
+        """
+        提交生成任务，返回 (HTTP 状态码, 上游响应 JSON)；合并提交时 data.uuid 为该调用方的成员 ID。
+        ticket 为调用方还没排队的准入凭证（AdmissionController.ticket）：第一个到达的请求先申请名额，
+        放行后再等待窗口结束（或批已满），代表整批提交；其余请求不占名额，等待它的结果。
+        上游错误、网络异常和准入拒绝 (AdmissionRejected) 由整批共享
+        """
+        if not self.enabled or not batch_eligible(payload):
+            if ticket is not None:
+                ticket.admit()
+            with self._lock:
+                self.requests += 1
+                self.upstream_submits += 1
+            return submit_generation(payload, timeout)
+
+        key = payload_key(payload)
+        with self._lock:
+            self.requests += 1
+            batch = self._open.get(key)
+            if batch is not None:
+                index = batch.size
+                batch.size += 1
+                if batch.size >= self.max_size:
+                    del self._open[key]
+                    batch.full.set()
+                leader = False
+            else:
+                batch = _Batch(ticket)
+                self._open[key] = batch
+                index = 0
+                leader = True
+
+        if leader:
+            try:
+                if ticket is not None:
+                    ticket.admit()
+                batch.full.wait(self.window)
+            except Exception as e:
+                batch.error = e
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+                size = batch.size
+                if batch.error is None:
+                    self.upstream_submits += 1
+                    if size > 1:
+                        self.batched_requests += size
+                    self.largest_batch = max(self.largest_batch, size)
+            try:
+                if batch.error is None:
+                    batch.status_code, batch.result = submit_generation(dict(payload, batch_size=size), timeout)
+                    if size > 1:
+                        logger.info(f"Micro-batched {size} identical submissions into one upstream task")
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+            if ticket is not None:
+                ticket.follow(batch.ticket)
+
+        if batch.error is not None:
+            raise batch.error
+        result = batch.result
+        if batch.size == 1 or not result.get('success') or not result.get('data', {}).get('uuid'):
+            return batch.status_code, result
+        return batch.status_code, member_result(result, result['data']['uuid'], index)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "window_ms": self.window * 1000,
+                "max_size": self.max_size,
+                "collecting": len(self._open),
+                "requests": self.requests,
+                "upstream_submits": self.upstream_submits,
+                "batched_requests": self.batched_requests,
+                "submits_saved": self.requests - self.upstream_submits,
+                "largest_batch": self.largest_batch
+            }
+
+
+# 进程级共享实例
+micro_batcher = MicroBatcher()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Z-Image 批量生成作业（POST /v1/batches）
+请求体是 NDJSON，每行一组生成参数；请求体边读边解析，解析出的参数交给作业的工作线程，
+每个工作线程一次只处理一个任务（频率限制 → 申请准入名额 → 提交 → 等待完成），单个作业同时在生成的任务数
+不超过 ZIMAGE_BATCH_CONCURRENCY。任务结束的顺序即结果行的输出顺序。
+每一行都和单次请求一样计入客户端 IP 的频率限制和使用日志，超出限额的行记为 rate_limited；
+上游生成名额持续用满、重试 BATCH_ADMISSION_WAIT 秒仍被拒绝的行记为 rejected。
+
+结果行带递增的 seq，作业在内存中保留 BATCH_RETAIN_SECONDS 秒：
+连接断开后用 GET /v1/batches/<batch_id>?after=<最后收到的 seq> 继续接收，作业本身不受连接影响
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid as uuid_lib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from zimage_admission import PRIORITY_QUALITY
+from zimage_events import extract_image_urls
+from zimage_images import NUMERIC_LIMITS, numeric_param
+from zimage_poller import MAX_TRACK_SECONDS, task_poller
+from zimage_submit import Submission, submit_generation
+from zimage_usage import check_rate_limit, log_usage
+
+logger = logging.getLogger(__name__)
+
+BATCH_CONCURRENCY = int(os.environ.get('ZIMAGE_BATCH_CONCURRENCY', '4'))  # 单个作业同时在生成的任务数
+BATCH_MAX_ITEMS = int(os.environ.get('ZIMAGE_BATCH_MAX_ITEMS', '1000'))  # 单个作业最多接收的行数，超出部分忽略
+BATCH_RETAIN_SECONDS = float(os.environ.get('ZIMAGE_BATCH_RETAIN', '3600'))  # 作业结束后保留结果的时间（秒），用于续传
+MAX_BATCHES = 100  # 同时保留的作业数，满了且都未结束时拒绝新作业
+BATCH_TASK_TIMEOUT = MAX_TRACK_SECONDS  # 单个任务最长等待时间，与轮询器最长跟踪时间一致
+BATCH_ADMISSION_WAIT = MAX_TRACK_SECONDS  # 准入被拒时按 Retry-After 重试的最长时间（秒），超过后该行记为 rejected
+BATCH_WAIT_SLICE = 15  # 结果流每次等待新结果的时间（秒）
+
+BATCH_ID_HEADER = 'X-ZImage-Batch-Id'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+PAYLOAD_DEFAULTS = {
+    "negative_prompt": "",
+    "batch_size": 1,
+    "width": 1024,
+    "height": 1024,
+    "steps": 8,
+    "cfg_scale": 7
+}
+
+
+def parse_batch_line(line: bytes) -> Tuple[Optional[str], Optional[Dict[str, Any]], Optional[str]]:
+    """
+    一行输入 -> (custom_id, 上游生成参数, 错误信息)；空行返回三个 None。
+    字段与 chat completions 的 extra_body 相同，另外可带 custom_id 用于对应结果
+    """
+    line = line.strip()
+    if not line:
+        return None, None, None
+    try:
+        item = json.loads(line)
+    except ValueError:
+        return None, None, "Invalid JSON"
+    if not isinstance(item, dict):
+        return None, None, "Each line must be a JSON object"
+    custom_id = item.get('custom_id')
+    prompt = item.get('prompt')
+    if not prompt or not isinstance(prompt, str):
+        return custom_id, None, "Prompt is required and must be a string"
+    payload = {"prompt": prompt, "model": "turbo" if "turbo" in item.get('model', 'zimage-turbo') else "base"}
+    for field, default in PAYLOAD_DEFAULTS.items():
+        value = item.get(field, default)
+        if field in NUMERIC_LIMITS:
+            value, error = numeric_param(field, value)
+            if error:
+                return custom_id, None, error
+        payload[field] = value
+    return custom_id, payload, None
+
+
+def batch_result(index: int, custom_id: Optional[str], uuid: Optional[str], status: str,
+                 image_urls: Optional[List[str]] = None, error: Optional[str] = None) -> Dict[str, Any]:
+    """结果行；line 是输入行号（从 0 开始，不计空行）"""
+    return {
+        "line": index,
+        "custom_id": custom_id,
+        "uuid": uuid,
+        "status": status,
+        "image_urls": image_urls or [],
+        "error": error
+    }
+
+
+class BatchJob:
+    """一个批量作业：已接收的行数和按完成顺序排列的结果"""
+
+    def __init__(self, batch_id: str):
+        self.id = batch_id
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.total = 0  # 已接收的输入行数
+        self.input_closed = False
+        self.truncated = False  # 超出 BATCH_MAX_ITEMS，其余行被忽略
+        self.counts: Dict[str, int] = {}
+        self.cells: List[Dict[str, Any]] = []  # 参数扫描作业每一行（格子）的参数，按行号
+        self._results: List[Dict[str, Any]] = []
+        self._condition = threading.Condition()
+        self._listeners: List[Callable[[], None]] = []
+
+    @property
+    def done(self) -> bool:
+        return self.input_closed and len(self._results) >= self.total
+
+    def accept(self) -> int:
+        """登记一行输入，返回行号"""
+        with self._condition:
+            index = self.total
+            self.total += 1
+            return index
+
+    def close_input(self):
+        with self._condition:
+            self.input_closed = True
+            self._update_finished()
+        self._notify()
+
+    def record(self, result: Dict[str, Any]):
+        with self._condition:
+            result['seq'] = len(self._results) + 1
+            if self.cells:
+                result['params'] = self.cells[result['line']]
+            self._results.append(result)
+            self.counts[result['status']] = self.counts.get(result['status'], 0) + 1
+            self._update_finished()
+        self._notify()
+
+    def results_after(self, after: int) -> Tuple[List[Dict[str, Any]], bool]:
+        """seq 大于 after 的结果，以及作业是否已结束"""
+        with self._condition:
+            return self._results[max(0, after):], self.done
+
+    def wait(self, after: int, timeout: float) -> Tuple[List[Dict[str, Any]], bool]:
+        """阻塞到有 seq 大于 after 的结果、作业结束或超时"""
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._results) > after or self.done, timeout)
+            return self._results[max(0, after):], self.done
+
+    def add_listener(self, callback: Callable[[], None]):
+        """有新结果或作业结束时回调（asyncio 版本用来唤醒事件循环）"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[], None]):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def summary(self) -> Dict[str, Any]:
+        """结果流的最后一行"""
+        with self._condition:
+            summary = {
+                "batch_id": self.id,
+                "status": "completed" if self.done else "running",
+                "total": self.total,
+                "finished": len(self._results),
+                "counts": dict(self.counts),
+                "truncated": self.truncated,
+                "created_at": int(self.created_at),
+                "finished_at": int(self.finished_at) if self.finished_at else None
+            }
+            if self.cells:
+                # 参数扫描：按格子顺序汇总每个格子的结果
+                by_line = {result['line']: result for result in self._results}
+                summary['grid'] = [
+                    dict(params, uuid=by_line.get(line, {}).get('uuid'),
+                         status=by_line.get(line, {}).get('status', 'pending'),
+                         image_urls=by_line.get(line, {}).get('image_urls', []))
+                    for line, params in enumerate(self.cells)
+                ]
+            return summary
+
+    def _update_finished(self):
+        if self.finished_at is None and self.done:
+            self.finished_at = time.time()
+
+    def _notify(self):
+        with self._condition:
+            self._condition.notify_all()
+        for callback in list(self._listeners):
+            callback()
+
+
+class BatchStore:
+    """进程内的作业登记表：结束的作业保留 BATCH_RETAIN_SECONDS 秒供续传"""
+
+    def __init__(self, capacity: int = MAX_BATCHES, retain: float = BATCH_RETAIN_SECONDS):
+        self.capacity = max(1, capacity)
+        self.retain = retain
+        self._lock = threading.Lock()
+        self._jobs: "OrderedDict[str, BatchJob]" = OrderedDict()
+        self.created = 0
+        self.rejected = 0
+
+    def create(self) -> Optional[BatchJob]:
+        """新建作业；登记表已满且没有可清理的已结束作业时返回 None"""
+        with self._lock:
+            self._expire(time.time())
+            if len(self._jobs) >= self.capacity:
+                finished = [batch_id for batch_id, job in self._jobs.items() if job.done]
+                if not finished:
+                    self.rejected += 1
+                    return None
+                del self._jobs[finished[0]]
+            job = BatchJob(f"batch_{uuid_lib.uuid4().hex}")
+            self._jobs[job.id] = job
+            self.created += 1
+            return job
+
+    def get(self, batch_id: str) -> Optional[BatchJob]:
+        with self._lock:
+            self._expire(time.time())
+            return self._jobs.get(batch_id)
+
+    def _expire(self, now: float):
+        """调用方需持有 self._lock"""
+        for batch_id in [batch_id for batch_id, job in self._jobs.items()
+                         if job.finished_at is not None and now - job.finished_at > self.retain]:
+            del self._jobs[batch_id]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            running = sum(1 for job in self._jobs.values() if not job.done)
+            return {
+                "concurrency": BATCH_CONCURRENCY,
+                "max_items": BATCH_MAX_ITEMS,
+                "retained": len(self._jobs),
+                "running": running,
+                "created": self.created,
+                "rejected": self.rejected
+            }
+
+
+def batch_result_lines(job: BatchJob, after: int = 0) -> Iterator[str]:
+    """NDJSON 结果流：先输出 seq 大于 after 的已有结果，再跟随新结果，作业结束时输出汇总行"""
+    while True:
+        results, done = job.wait(after, BATCH_WAIT_SLICE)
+        for result in results:
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+            after = result['seq']
+        if done and not results:
+            yield json.dumps(job.summary(), ensure_ascii=False) + '\n'
+            return
+
+
+def parse_after(value: Optional[str]) -> int:
+    """续传参数 ?after=<seq>，无效值从头开始"""
+    try:
+        return max(0, int(value)) if value else 0
+    except ValueError:
+        return 0
+
+
+class BatchRunner:
+    """
+    线程版作业执行器：请求线程调用 add() 逐行交给工作线程，读完请求体后调用 close()。
+    工作线程在首次有任务时按需创建，最多 concurrency 个；asyncio 版本继承后改用工作协程。
+    client_ip 为提交作业的客户端，每一行计入它的频率限制；为 None 时不做频率限制（服务器本身不限流时）
+    """
+
+    def __init__(self, job: BatchJob, concurrency: int = BATCH_CONCURRENCY, max_items: int = BATCH_MAX_ITEMS,
+                 client_ip: Optional[str] = None):
+        self.job = job
+        self.client_ip = client_ip
+        self.concurrency = max(1, concurrency)
+        self.max_items = max_items
+        self._queue = queue.Queue()
+        self._workers: List[Any] = []
+
+    def add(self, line: bytes) -> bool:
+        """处理一行输入；达到行数上限时返回 False，调用方停止读取"""
+        custom_id, payload, error = parse_batch_line(line)
+        if payload is None and error is None:
+            return True
+        return self.add_item(custom_id, payload, error)
+
+    def add_item(self, custom_id: Optional[str], payload: Optional[Dict[str, Any]], error: Optional[str] = None) -> bool:
+        """交给工作线程一组已解析的参数；error 不为空时直接记为失败行"""
+        if self.job.total >= self.max_items:
+            self.job.truncated = True
+            return False
+        index = self.job.accept()
+        if error:
+            self.job.record(batch_result(index, custom_id, None, 'error', error=error))
+            return True
+        self._queue.put_nowait((index, custom_id, payload))
+        if len(self._workers) < self.concurrency:
+            self._workers.append(self._start_worker())
+        return True
+
+    def close(self):
+        self.job.close_input()
+        for _ in self._workers:
+            self._queue.put_nowait(None)
+
+    def _start_worker(self):
+        worker = threading.Thread(target=self._work, daemon=True)
+        worker.start()
+        return worker
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            index, custom_id, payload = item
+            try:
+                self.job.record(run_batch_item(index, custom_id, payload, self.client_ip))
+            except Exception as e:
+                logger.error(f"Batch {self.job.id} line {index} failed: {e}")
+                self.job.record(batch_result(index, custom_id, None, 'error', error=str(e)))
+
+
+def log_item_usage(client_ip: Optional[str], payload: Dict[str, Any], uuid: Optional[str], error: Optional[str] = None):
+    """每个提交的行记一条使用日志；client_ip 为 None 时不记录"""
+    if client_ip is not None:
+        log_usage(client_ip, payload['prompt'], uuid, payload['model'], payload, error is None, error)
+
+
+def submission_error(submission: Submission) -> str:
+    """提交失败的结果行错误信息；准入拒绝时带上拒绝原因"""
+    if submission.rejected:
+        return f"{submission.body['error']}: {submission.body['message']}"
+    return submission.body['error']
+
+
+def run_batch_item(index: int, custom_id: Optional[str], payload: Dict[str, Any],
+                   client_ip: Optional[str] = None) -> Dict[str, Any]:
+    """
+    提交一行并等待任务结束；准入排队满或超时时按 Retry-After 退避重试，批量作业不因瞬时繁忙失败，
+    重试超过 BATCH_ADMISSION_WAIT 仍被拒绝时记为 rejected。超出 client_ip 的频率限制时不提交，记为 rate_limited
+    """
+    if client_ip is not None:
+        allowed, limit_message = check_rate_limit(client_ip)
+        if not allowed:
+            return batch_result(index, custom_id, None, 'rate_limited', error=limit_message)
+
+    deadline = time.time() + BATCH_ADMISSION_WAIT
+    while True:
+        # 批量作业一律按 quality 排队，不抢交互请求的 fast 名额
+        try:
+            submission = submit_generation(payload, client_ip, priority=PRIORITY_QUALITY)
+        except requests.exceptions.RequestException as e:
+            log_item_usage(client_ip, payload, None, f"Network error: {e}")
+            return batch_result(index, custom_id, None, 'error', error=f"Network error: {e}")
+        if not submission.rejected or time.time() + submission.retry_after > deadline:
+            break
+        time.sleep(submission.retry_after)
+    if not submission.ok:
+        error = submission_error(submission)
+        log_item_usage(client_ip, payload, None, error)
+        return batch_result(index, custom_id, None, 'rejected' if submission.rejected else 'error', error=error)
+    uuid = submission.uuid
+    log_item_usage(client_ip, payload, uuid)
+
+    snapshot = task_poller.wait_for_completion(uuid, timeout=BATCH_TASK_TIMEOUT)
+    if snapshot['status'] == 'completed':
+        return batch_result(index, custom_id, uuid, 'completed', extract_image_urls(snapshot['task']))
+    if snapshot['status'] == 'failed':
+        return batch_result(index, custom_id, uuid, 'failed', error=snapshot.get('error') or "Task failed to complete")
+    return batch_result(index, custom_id, uuid, 'timeout', error="Task did not finish in time")
+
+
+# 进程级共享实例
+batch_store = BatchStore()
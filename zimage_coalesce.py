@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Z-Image 请求合并 (singleflight)
+同一任务 UUID 的并发状态查询共享一次上游请求及其结果；
+在允许的陈旧时间内，最近一次上游结果直接复用
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from zimage_upstream import upstream, ZIMAGE_TASK
+from zimage_results import result_cache
+from zimage_journal import task_journal
+from zimage_batcher import project_member, split_member_id
+
+logger = logging.getLogger(__name__)
+
+STATUS_MAX_AGE = float(os.environ.get('ZIMAGE_STATUS_MAX_AGE', '1.0'))  # 状态结果可复用的最长时间（秒）
+STATUS_RETAIN_SECONDS = 60  # 最近结果在内存中保留的时间
+STATUS_TIMEOUT = 15  # 上游状态查询超时（秒）
+
+# 批量查询配置
+BATCH_MAX_TASKS = 500  # 单次批量查询最多的任务数
+BATCH_PARALLELISM = int(os.environ.get('ZIMAGE_BATCH_PARALLELISM', '16'))  # 批量查询的上游并发数（全进程共享）
+BATCH_DEFAULT_TIMEOUT = 10  # 默认整体截止时间（秒）
+BATCH_MAX_TIMEOUT = 30
+
+
+def is_terminal(result: Dict) -> bool:
+    """上游结果是否已是终态（completed / failed），终态结果不会再变化，可直接复用"""
+    return result.get('data', {}).get('task', {}).get('taskStatus') in ('completed', 'failed')
+
+
+class _Call:
+    """一次进行中的上游调用"""
+
+    __slots__ = ('done', 'result', 'error', 'followers')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """同一 key 的并发调用只执行一次，其余调用者等待并共享结果（包括异常）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self.origin_calls = 0
+        self.coalesced_calls = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.followers += 1
+                self.coalesced_calls += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.origin_calls += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+
+def fetch_task_upstream(uuid: str, timeout: float = STATUS_TIMEOUT) -> Dict:
+    """直接查询上游任务状态，网络错误抛出 requests 异常"""
+    response = upstream.get(f"{ZIMAGE_TASK}/{uuid}", timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+class TaskStatusFetcher:
+    """带陈旧预算和请求合并的任务状态查询"""
+
+    def __init__(self, fetch: Callable[..., Dict] = fetch_task_upstream, max_age: float = STATUS_MAX_AGE):
+        self.fetch = fetch
+        self.max_age = max_age
+        self.flight = SingleFlight()
+        self._lock = threading.Lock()
+        self._recent: Dict[str, tuple] = {}  # uuid -> (fetched_at, result)
+        self._last_prune = time.time()
+        self._executor = None
+        self._executor_pid = None
+        self.fresh_hits = 0
+
+    def get(self, uuid: str, max_age: Optional[float] = None, timeout: float = STATUS_TIMEOUT) -> Dict:
+        """
+        返回任务状态 JSON：
+        - 已结束的任务直接返回缓存的终态结果
+        - 最近结果未超过 max_age 时直接返回
+        - 否则加入（或发起）该 UUID 正在进行的上游查询
+        - 微批成员 ID 查询合并提交的上游任务后截取自己的那一张图
+        """
+        cached = result_cache.get(uuid)
+        if cached is not None:
+            return cached
+
+        member = split_member_id(uuid)
+        if member is not None:
+            # 微批成员：查询合并提交的上游任务，只取属于该成员的图片
+            result = project_member(self.get(member[0], max_age, timeout), member[1])
+            if result_cache.put(uuid, result):
+                task_journal.record_result(uuid, result)
+            return result
+
+        max_age = self.max_age if max_age is None else max_age
+        if max_age > 0:
+            with self._lock:
+                recent = self._recent.get(uuid)
+                if recent and time.time() - recent[0] <= max_age:
+                    self.fresh_hits += 1
+                    return recent[1]
+
+        return self.flight.do(uuid, lambda: self._fetch_and_store(uuid, timeout))
+
+    def get_many(self, uuids: List[str], timeout: float) -> Tuple[Dict[str, Dict], Dict[str, str], Dict[str, int]]:
+        """
+        批量查询：本地已有的终态或新鲜结果直接返回，其余并发查询上游（全进程共享的有界线程池），
+        整体不超过 timeout 秒。返回 (结果, 错误, 计数)
+        """
+        deadline = time.time() + timeout
+        found: Dict[str, Dict] = {}
+        errors: Dict[str, str] = {}
+        missing = []
+
+        now = time.time()
+        with self._lock:
+            for uuid in uuids:
+                recent = self._recent.get(uuid)
+                if recent and (is_terminal(recent[1]) or now - recent[0] <= self.max_age):
+                    found[uuid] = recent[1]
+                    continue
+                cached = result_cache.get(uuid)
+                if cached is not None:
+                    found[uuid] = cached
+                else:
+                    missing.append(uuid)
+            self.fresh_hits += len(found)
+        local = len(found)
+
+        executor = self._batch_executor()
+        futures = {executor.submit(self.get, uuid, 0, min(STATUS_TIMEOUT, timeout)): uuid for uuid in missing}
+        done, not_done = wait(futures, timeout=max(0.0, deadline - time.time()))
+        for future in done:
+            try:
+                found[futures[future]] = future.result()
+            except Exception as e:
+                errors[futures[future]] = str(e)
+        for future in not_done:
+            # 未完成的查询继续在后台执行，结果留在 _recent 里供下次复用
+            errors[futures[future]] = f"Deadline exceeded ({timeout}s)"
+
+        results = {uuid: found[uuid] for uuid in uuids if uuid in found}
+        ordered_errors = {uuid: errors[uuid] for uuid in uuids if uuid in errors}
+        counts = {
+            "requested": len(uuids),
+            "local": local,
+            "fetched": len(results) - local,
+            "failed": len(ordered_errors)
+        }
+        return results, ordered_errors, counts
+
+    def _batch_executor(self) -> ThreadPoolExecutor:
+        """懒创建批量查询线程池；fork 后的子进程重新创建"""
+        if self._executor is None or self._executor_pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._executor_pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=max(1, BATCH_PARALLELISM), thread_name_prefix='zimage-batch')
+                    self._executor_pid = os.getpid()
+        return self._executor
+
+    def peek(self, uuid: str) -> Optional[tuple]:
+        """返回 (fetched_at, result)，不触发查询"""
+        with self._lock:
+            return self._recent.get(uuid)
+
+    def _fetch_and_store(self, uuid: str, timeout: float) -> Dict:
+        result = self.fetch(uuid, timeout=timeout)
+        result_cache.put(uuid, result)
+        task_journal.record_result(uuid, result)
+        now = time.time()
+        with self._lock:
+            self._recent[uuid] = (now, result)
+            if now - self._last_prune > STATUS_RETAIN_SECONDS:
+                self._last_prune = now
+                cutoff = now - STATUS_RETAIN_SECONDS
+                for key in [key for key, (fetched_at, _) in self._recent.items() if fetched_at < cutoff]:
+                    del self._recent[key]
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            recent = len(self._recent)
+            fresh_hits = self.fresh_hits
+        return {
+            "max_age": self.max_age,
+            "origin_calls": self.flight.origin_calls,
+            "coalesced_calls": self.flight.coalesced_calls,
+            "fresh_hits": fresh_hits,
+            "in_flight": self.flight.in_flight(),
+            "recent_results": recent
+        }
+
+
+def parse_batch_request(payload: Any) -> Tuple[List[str], float, Optional[str]]:
+    """
+    解析批量查询请求体 {"uuids": [...], "timeout": 秒}。
+    返回 (去重后的 UUID 列表, 截止时间, 错误信息)
+    """
+    if not isinstance(payload, dict) or not isinstance(payload.get('uuids'), list):
+        return [], 0, "Request body must be a JSON object with a 'uuids' list"
+
+    uuids = list(dict.fromkeys(uuid for uuid in payload['uuids'] if isinstance(uuid, str) and uuid))
+    if not uuids:
+        return [], 0, "'uuids' must contain at least one task UUID"
+    if len(uuids) > BATCH_MAX_TASKS:
+        return [], 0, f"Too many task UUIDs (max {BATCH_MAX_TASKS} per request)"
+
+    try:
+        timeout = float(payload.get('timeout', BATCH_DEFAULT_TIMEOUT))
+    except (TypeError, ValueError):
+        return [], 0, "'timeout' must be a number of seconds"
+    return uuids, min(max(timeout, 0.1), BATCH_MAX_TIMEOUT), None
+
+
+def batch_response(results: Dict[str, Dict], errors: Dict[str, str], counts: Dict[str, int], started: float) -> Dict[str, Any]:
+    """批量查询响应体：tasks 为各任务的上游状态JSON，errors 为查询失败或超时的任务"""
+    return {
+        "tasks": results,
+        "errors": errors,
+        "stats": dict(counts, elapsed_ms=int((time.time() - started) * 1000))
+    }
+
+
+# 进程级共享实例
+task_status = TaskStatusFetcher()
+
+
+def handle_batch_request(payload: Any) -> Tuple[Dict[str, Any], int]:
+    """POST /v1/tasks:batch 的通用处理，返回 (响应体, HTTP 状态码)"""
+    started = time.time()
+    uuids, timeout, error = parse_batch_request(payload)
+    if error:
+        return {"error": error}, 400
+    results, errors, counts = task_status.get_many(uuids, timeout)
+    return batch_response(results, errors, counts, started), 200
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Z-Image 进行中任务去重
+客户端重试或重复点击时，窗口期内参数完全相同的提交直接挂到已在生成的任务上，不再向上游提交新任务。
+同时到达的相同提交只有第一个真正请求上游，其余等它拿到任务 UUID 后共用。
+设置 ZIMAGE_DEDUP_WINDOW 后开启；默认按调用方（客户端 IP）区分，ZIMAGE_DEDUP_SCOPE=global 时不同调用方之间也共用
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from zimage_gencache import payload_key
+from zimage_results import result_cache, result_status
+
+DEDUP_WINDOW = float(os.environ.get('ZIMAGE_DEDUP_WINDOW', '0'))  # 相同提交合并的时间窗口（秒），默认 0 关闭
+DEDUP_SCOPE = os.environ.get('ZIMAGE_DEDUP_SCOPE', 'client')  # client | global
+DEDUP_SUBMIT_WAIT = 30  # 等待同时到达的第一个提交完成的最长时间（秒），与上游提交超时一致
+
+_callbacks_lock = threading.Lock()
+
+
+class _Submission:
+    """一次真正发往上游的提交"""
+
+    __slots__ = ('started_at', 'uuid', 'done', '_callbacks')
+
+    def __init__(self, started_at: float):
+        self.started_at = started_at
+        self.uuid: Optional[str] = None
+        self.done = threading.Event()
+        self._callbacks = []
+
+    def on_done(self, callback: Callable[[], None]) -> bool:
+        """提交结束（拿到 UUID 或放弃）时在结束它的线程中调用 callback；已经结束时不登记并返回 False"""
+        with _callbacks_lock:
+            if self.done.is_set():
+                return False
+            self._callbacks.append(callback)
+            return True
+
+    def finish(self):
+        with _callbacks_lock:
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class DedupClaim:
+    """
+    claim() 的结果，作为上下文管理器使用：
+    uuid 不为空时直接复用该任务；否则由调用方提交，成功后调用 resolve(uuid)。
+    未 resolve 就退出（提交失败、提前返回错误）时释放登记，等待中的相同提交各自重新提交
+    """
+
+    def __init__(self, owner: Optional['SubmissionDedup'] = None, key: Optional[str] = None,
+                 submission: Optional[_Submission] = None, uuid: Optional[str] = None):
+        self._owner = owner
+        self._key = key
+        self._submission = submission
+        self.uuid = uuid
+
+    @property
+    def attached(self) -> bool:
+        return self.uuid is not None
+
+    def resolve(self, uuid: str):
+        if self._submission is not None:
+            self._submission.uuid = uuid
+            self._submission.finish()
+
+    def __enter__(self) -> 'DedupClaim':
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._submission is not None and self._submission.uuid is None:
+            self._owner._release(self._key, self._submission)
+        return False
+
+
+class SubmissionDedup:
+    """窗口期内相同参数的提交合并为一个上游任务"""
+
+    def __init__(self, window: float = DEDUP_WINDOW, scope: str = DEDUP_SCOPE):
+        self.window = window
+        self.scope = scope if scope in ('client', 'global') else 'client'
+        self._lock = threading.Lock()
+        self._submissions: "OrderedDict[str, _Submission]" = OrderedDict()  # 按提交开始时间排序
+
+        self.submitted = 0
+        self.attached = 0
+        self.waited = 0
+        self.released = 0
+
+    def claim(self, payload: Dict[str, Any], client: Optional[str] = None, mode: str = 'use') -> DedupClaim:
+        """
+        查找窗口期内相同的提交；正在提交中的会阻塞等待其结果（asyncio 版本用 begin / on_done / attach 等待）。
+        mode 与生成结果缓存的请求头一致：要求重新生成（refresh / bypass）时不合并
+        """
+        claim, key, submission = self.begin(payload, client, mode)
+        if claim is not None:
+            return claim
+        if not submission.done.wait(DEDUP_SUBMIT_WAIT):
+            return DedupClaim()
+        return self.attach(key, submission)
+
+    def begin(self, payload: Dict[str, Any], client: Optional[str] = None,
+              mode: str = 'use') -> Tuple[Optional[DedupClaim], Optional[str], Optional[_Submission]]:
+        """
+        claim() 中不阻塞的部分：返回 (结果, None, None)；
+        相同参数已有提交时返回 (None, key, 该提交)，由调用方等它结束后调用 attach()
+        """
+        if self.window <= 0 or mode != 'use':
+            return DedupClaim(), None, None
+        key = payload_key(payload)
+        if self.scope == 'client':
+            key = f"{key}:{client or ''}"
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            submission = self._submissions.get(key)
+            if submission is not None and submission.uuid is not None and now - submission.started_at > self.window:
+                del self._submissions[key]
+                submission = None
+            if submission is None:
+                submission = _Submission(now)
+                self._submissions[key] = submission
+                self.submitted += 1
+                return DedupClaim(self, key, submission), None, None
+            if submission.uuid is None:
+                self.waited += 1
+        return None, key, submission
+
+    def attach(self, key: str, submission: _Submission) -> DedupClaim:
+        """相同参数的提交结束后挂到它的任务上；提交失败或任务已失败时由调用方自己提交"""
+        if submission.uuid is None:
+            return DedupClaim()
+        cached = result_cache.get(submission.uuid)
+        if cached is not None and result_status(cached) == 'failed':
+            # 已失败的任务不复用
+            with self._lock:
+                if self._submissions.get(key) is submission:
+                    del self._submissions[key]
+            return DedupClaim()
+        with self._lock:
+            self.attached += 1
+        return DedupClaim(uuid=submission.uuid)
+
+    def _release(self, key: str, submission: _Submission):
+        with self._lock:
+            if self._submissions.get(key) is submission:
+                del self._submissions[key]
+            self.released += 1
+        submission.finish()
+
+    def _expire(self, now: float):
+        """从队首移除超出窗口的已完成提交；调用方需持有 self._lock"""
+        while self._submissions:
+            key, submission = next(iter(self._submissions.items()))
+            if now - submission.started_at <= self.window or submission.uuid is None:
+                break
+            del self._submissions[key]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "window": self.window,
+                "scope": self.scope,
+                "tracked": len(self._submissions),
+                "submitted": self.submitted,
+                "attached": self.attached,
+                "waited": self.waited,
+                "released": self.released
+            }
+
+
+# 进程级共享实例
+submission_dedup = SubmissionDedup()
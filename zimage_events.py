@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Z-Image 任务事件推送
+- Server-Sent Events: /v1/tasks/<uuid>/events 在一个长连接上推送状态/进度变化，
+  任务结束时推送图片URL并关闭，浏览器不再需要每隔几秒请求一次 /v1/tasks/<uuid>
+- 长轮询: /v1/tasks/<uuid>?wait=30&since=<status> 挂起到状态变化或超时，
+  适用于会剥离 SSE / WebSocket 的代理
+- 流式 chat completions: stream=true 时以 chat.completion.chunk 推送进度，最后一块是图片 markdown，
+  原生 OpenAI SDK 一次调用即可拿到图片
+"""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from zimage_poller import task_poller
+
+SSE_MAX_SECONDS = 300  # 单个事件流最长保持时间，与 /v1/images 的最长等待一致
+SSE_HEARTBEAT_SECONDS = 15  # 无变化时发送注释行，防止代理因空闲断开连接
+SSE_RETRY_MS = 3000  # 断线后浏览器重连间隔
+
+LONG_POLL_MAX_WAIT = 60  # 长轮询最长挂起时间（秒）
+FAST_GENERATE_WAIT = 10  # /v1/fast-generate 默认等待完成的时间（秒），超时返回任务 UUID
+LONG_POLL_PER_IP = int(os.environ.get('ZIMAGE_LONG_POLL_PER_IP', '4'))  # 每个IP同时挂起的长轮询数
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'  # 关闭 nginx 缓冲，事件才能立即到达
+}
+
+
+def format_sse(event: str, data: Dict[str, Any], event_id: Optional[int] = None) -> str:
+    """格式化一条 SSE 消息"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def extract_image_urls(task_data: Dict) -> list:
+    """从任务数据中取出图片URL"""
+    result_url = task_data.get('resultUrl')
+    return [result_url] if result_url else task_data.get('resultUrls', [])
+
+
+def task_event(uuid: str, status: str, progress: Any, task_data: Dict, error: Optional[str] = None):
+    """
+    把一次任务状态转换成 (事件名, 数据)：
+    status 事件只带进度，completed 事件带图片URL和完整任务信息，failed 事件带错误原因
+    """
+    if status == 'completed':
+        return 'completed', {
+            "uuid": uuid,
+            "status": status,
+            "progress": 100,
+            "image_urls": extract_image_urls(task_data),
+            "task": task_data
+        }
+    if status == 'failed':
+        return 'failed', {"uuid": uuid, "status": status, "error": error or "Task failed to complete"}
+    data = {"uuid": uuid, "status": status, "progress": progress}
+    if error:
+        data["error"] = error
+    return 'status', data
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[int]:
+    """浏览器重连时带回的 Last-Event-ID 就是上次收到的任务版本号"""
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def task_event_stream(uuid: str, since_version: Optional[int] = None, max_seconds: float = SSE_MAX_SECONDS) -> Iterator[str]:
+    """
+    阻塞式事件流生成器，由共享轮询器驱动（不额外访问上游）。
+    每次任务版本变化推送一条事件；completed / failed / 任务不存在 / 超时后结束。
+    """
+    yield f"retry: {SSE_RETRY_MS}\n\n"
+
+    deadline = time.time() + max_seconds
+    version = -1 if since_version is None else since_version
+
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            yield format_sse('timeout', {"uuid": uuid, "message": f"No result after {max_seconds} seconds"})
+            return
+
+        snapshot = task_poller.wait(uuid, min(SSE_HEARTBEAT_SECONDS, remaining), since_version=version)
+
+        if snapshot['version'] <= version and not snapshot['done']:
+            yield ": keep-alive\n\n"
+            continue
+
+        version = snapshot['version']
+        if snapshot['done'] and snapshot['status'] not in ('completed', 'failed'):
+            # 上游拒绝了该任务（如 UUID 不存在）
+            yield format_sse('task_error', {"uuid": uuid, "error": snapshot['error']}, version)
+            return
+
+        event, data = task_event(uuid, snapshot['status'], snapshot['progress'], snapshot['task'], snapshot['error'])
+        yield format_sse(event, data, version)
+        if snapshot['done']:
+            return
+
+
+CHAT_STREAM_DONE = "data: [DONE]\n\n"
+
+
+def chat_chunk(uuid: str, model: str, delta: Dict[str, Any], finish_reason: Optional[str] = None,
+               task: Optional[Dict[str, Any]] = None) -> str:
+    """
+    一条 chat.completion.chunk（只有 data 行，与 OpenAI 流式格式一致）。
+    进度放在扩展字段 task 里，delta 为空，不会混进客户端拼接的消息内容
+    """
+    chunk = {
+        "id": f"chatcmpl-{uuid}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+    if task is not None:
+        chunk["task"] = task
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+def chat_final_content(uuid: str, status: str, image_urls: list, error: Optional[str] = None) -> str:
+    """最后一块的消息内容：完成时是图片 markdown，否则是失败原因"""
+    if status == 'completed':
+        return "\n".join(f"![image {index + 1}]({url})" for index, url in enumerate(image_urls))
+    if status == 'timeout':
+        return f"Image generation is still running, check /v1/tasks/{uuid} for the result"
+    return f"Image generation failed: {error or 'Task failed to complete'}"
+
+
+def chat_completion_stream(uuid: str, model: str, extra: Optional[Dict[str, Any]] = None,
+                           max_seconds: float = SSE_MAX_SECONDS) -> Iterator[str]:
+    """
+    stream=true 的 chat completions 响应体，由共享轮询器驱动（不额外访问上游）：
+    第一块带 role 和任务信息（extra：缓存、去重、排队情况），每次进度变化一块空 delta，
+    结束时一块图片 markdown（finish_reason=stop），最后 [DONE]
+    """
+    yield chat_chunk(uuid, model, {"role": "assistant", "content": ""},
+                     task=dict({"uuid": uuid, "status": "queued", "progress": 0}, **(extra or {})))
+
+    deadline = time.time() + max_seconds
+    version = -1
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            content = chat_final_content(uuid, 'timeout', [])
+            yield chat_chunk(uuid, model, {"content": content}, 'stop', task={"uuid": uuid, "status": "timeout"})
+            break
+
+        snapshot = task_poller.wait(uuid, min(SSE_HEARTBEAT_SECONDS, remaining), since_version=version)
+        if snapshot['version'] <= version and not snapshot['done']:
+            yield ": keep-alive\n\n"
+            continue
+
+        version = snapshot['version']
+        task = {"uuid": uuid, "status": snapshot['status'], "progress": snapshot['progress']}
+        if snapshot['done']:
+            image_urls = extract_image_urls(snapshot['task']) if snapshot['status'] == 'completed' else []
+            content = chat_final_content(uuid, snapshot['status'], image_urls, snapshot['error'])
+            yield chat_chunk(uuid, model, {"content": content}, 'stop', task=dict(task, image_urls=image_urls))
+            break
+        yield chat_chunk(uuid, model, {}, task=task)
+    yield CHAT_STREAM_DONE
+
+
+class LongPollLimiter:
+    """限制每个IP同时挂起的长轮询请求数，避免单个客户端占满工作线程"""
+
+    def __init__(self, per_ip: int = LONG_POLL_PER_IP):
+        self.per_ip = max(1, per_ip)
+        self._lock = threading.Lock()
+        self._active = defaultdict(int)
+        self.rejected = 0
+
+    def acquire(self, ip: str) -> bool:
+        with self._lock:
+            if self._active[ip] >= self.per_ip:
+                self.rejected += 1
+                return False
+            self._active[ip] += 1
+            return True
+
+    def release(self, ip: str):
+        with self._lock:
+            self._active[ip] -= 1
+            if self._active[ip] <= 0:
+                del self._active[ip]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "per_ip_limit": self.per_ip,
+                "active": sum(self._active.values()),
+                "active_ips": len(self._active),
+                "rejected": self.rejected
+            }
+
+
+long_poll_limiter = LongPollLimiter()
+
+
+def parse_wait(value: Optional[str]) -> float:
+    """解析 ?wait= 参数，限制在 0..LONG_POLL_MAX_WAIT 秒，无效值视为不等待"""
+    try:
+        return min(max(float(value), 0.0), LONG_POLL_MAX_WAIT) if value else 0.0
+    except ValueError:
+        return 0.0
+
+
+def parse_deadline(value: Any, default: float = FAST_GENERATE_WAIT) -> float:
+    """请求体中客户端给定的等待秒数，限制在 0..LONG_POLL_MAX_WAIT 秒，缺省或无效时用 default"""
+    if value is None:
+        return default
+    try:
+        return min(max(float(value), 0.0), LONG_POLL_MAX_WAIT)
+    except (TypeError, ValueError):
+        return default
+
+
+def long_poll_rejected_response() -> Dict[str, Any]:
+    """超出每IP长轮询并发数时的 429 响应体"""
+    return {
+        "error": "Too many long-poll requests",
+        "message": f"Max {long_poll_limiter.per_ip} concurrent long-poll requests per IP",
+        "retry_after": 1
+    }
+
+
+def long_poll_task(uuid: str, ip: str, wait: float, since_status: Optional[str] = None) -> Tuple[bool, Optional[Dict]]:
+    """
+    挂起到任务状态不再是 since_status（未指定时等到任务结束）或超时，由共享轮询器的条件变量唤醒。
+    返回 (是否允许, 上游任务JSON)；JSON 为 None 表示还没有可用结果，调用方按普通查询处理
+    """
+    if not long_poll_limiter.acquire(ip):
+        return False, None
+    try:
+        snapshot = task_poller.wait(uuid, wait, since_status=since_status)
+    finally:
+        long_poll_limiter.release(ip)
+    return True, snapshot['result']
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Z-Image 生成结果缓存（可选，ZIMAGE_GENERATION_CACHE=true 开启）
+按规范化后的生成参数（提示词、负面提示词、模型、尺寸、步数、cfg_scale、数量）哈希，
+记住最近一次对应的任务；该任务已完成时，相同请求直接返回它，不再向上游提交新的生成。
+任务结果本身由终态结果缓存 (zimage_results) 提供，这里只保存参数 -> 任务 UUID 的映射。
+
+单个请求可以通过请求头跳过缓存：
+- Cache-Control: no-cache 或 X-ZImage-Cache: refresh  不读缓存，新任务完成后更新缓存
+- Cache-Control: no-store 或 X-ZImage-Cache: bypass   不读也不写
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from zimage_results import result_cache, result_status
+
+GENERATION_CACHE_ENABLED = os.environ.get('ZIMAGE_GENERATION_CACHE', 'false').lower() == 'true'
+GENERATION_CACHE_SIZE = int(os.environ.get('ZIMAGE_GENERATION_CACHE_SIZE', '10000'))  # 最多记住的参数组合数
+GENERATION_CACHE_TTL = float(os.environ.get('ZIMAGE_GENERATION_CACHE_TTL', '3600'))  # 复用已完成任务的最长时间（秒）
+
+CACHE_HEADER = 'X-ZImage-Cache'
+
+TEXT_FIELDS = ('prompt', 'negative_prompt')
+INT_FIELDS = ('width', 'height', 'steps', 'batch_size')
+
+
+def normalize_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """空白和数字写法不同但实际相同的参数得到同一个键；未知字段（如 seed）原样参与"""
+    normalized = dict(payload)
+    for field in TEXT_FIELDS:
+        if field in normalized:
+            normalized[field] = ' '.join(str(normalized[field] or '').split())
+    if 'model' in normalized:
+        normalized['model'] = str(normalized['model']).strip().lower()
+    for field in INT_FIELDS:
+        try:
+            normalized[field] = int(normalized[field])
+        except (KeyError, TypeError, ValueError):
+            pass
+    try:
+        normalized['cfg_scale'] = float(normalized['cfg_scale'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    return normalized
+
+
+def payload_key(payload: Dict[str, Any]) -> str:
+    canonical = json.dumps(normalize_payload(payload), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def request_cache_mode(headers: Mapping[str, str]) -> str:
+    """use: 正常读写; refresh: 只写; bypass: 不读不写"""
+    explicit = (headers.get(CACHE_HEADER) or '').strip().lower()
+    cache_control = (headers.get('Cache-Control') or '').lower()
+    if explicit == 'bypass' or 'no-store' in cache_control:
+        return 'bypass'
+    if explicit == 'refresh' or 'no-cache' in cache_control:
+        return 'refresh'
+    return 'use'
+
+
+class GenerationCache:
+    """参数哈希 -> 最近一次任务 UUID，LRU + TTL"""
+
+    def __init__(self, enabled: bool = GENERATION_CACHE_ENABLED, capacity: int = GENERATION_CACHE_SIZE,
+                 ttl: float = GENERATION_CACHE_TTL):
+        self.enabled = enabled
+        self.capacity = max(1, capacity)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()  # key -> (submitted_at, uuid)
+
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.evicted = 0
+
+    def lookup(self, payload: Dict[str, Any], mode: str = 'use') -> Optional[str]:
+        """返回可直接复用的已完成任务 UUID"""
+        if not self.enabled:
+            return None
+        if mode != 'use':
+            with self._lock:
+                self.bypassed += 1
+            return None
+        key = payload_key(payload)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                self.evicted += 1
+                entry = None
+        uuid = entry[1] if entry is not None else None
+        status = self._status(uuid) if uuid else None
+        with self._lock:
+            if status == 'completed':
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return uuid
+            if status == 'failed' and self._entries.get(key) == entry:
+                del self._entries[key]
+            self.misses += 1
+        return None
+
+    def store(self, payload: Dict[str, Any], uuid: str, mode: str = 'use'):
+        """记录新提交的任务；已有可复用的已完成任务时保留旧的"""
+        if not self.enabled or mode == 'bypass':
+            return
+        key = payload_key(payload)
+        with self._lock:
+            entry = self._entries.get(key)
+        if mode == 'use' and entry is not None and self._status(entry[1]) == 'completed':
+            return
+        now = time.time()
+        with self._lock:
+            self._entries[key] = (now, uuid)
+            self._entries.move_to_end(key)
+            self.stores += 1
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    @staticmethod
+    def _status(uuid: str) -> Optional[str]:
+        result = result_cache.get(uuid)
+        return result_status(result) if result is not None else None
+
+    def result(self, uuid: str) -> Optional[Dict]:
+        """命中任务的完整结果"""
+        return result_cache.get(uuid)
+
+    def clear(self) -> int:
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            return count
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "stores": self.stores,
+                "evicted": self.evicted
+            }
+
+
+def cache_status(mode: str, hit: bool) -> str:
+    """响应头 X-ZImage-Cache 的值"""
+    if hit:
+        return 'HIT'
+    return 'MISS' if mode == 'use' else 'BYPASS'
+
+
+# 进程级共享实例
+generation_cache = GenerationCache()
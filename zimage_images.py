@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Z-Image OpenAI Images API 兼容层（POST /v1/images/generations）
+请求参数转换为上游生成参数，提交后等待任务完成再返回图片。
+response_format=b64_json 时边从上游读取图片边编码写入响应体：
+每次只处理 B64_CHUNK_SIZE 字节，不会在内存中同时保留整张图片和它的 base64 副本
+"""
+
+import base64
+import json
+import re
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from zimage_upstream import upstream
+
+IMAGES_WAIT = 60  # 默认等待任务完成的时间（秒），超时返回任务 UUID 由客户端继续查询
+IMAGE_FETCH_TIMEOUT = 30  # 从上游读取结果图片的超时（秒，连接和单次读取）
+B64_CHUNK_SIZE = 3 * 16 * 1024  # 每次读取并编码的字节数，3 的倍数时中间块不需要补齐
+MAX_IMAGES = 4  # 上游 batch_size 上限
+MAX_DIMENSION = 4096  # 宽、高上限（像素）
+MAX_STEPS = 50  # 生成步数上限
+MAX_CFG_SCALE = 20  # 引导强度上限
+RESPONSE_FORMATS = ('url', 'b64_json')
+
+_SIZE_PATTERN = re.compile(r'^(\d+)x(\d+)$')
+
+# 数值生成参数的 (类型, 最小值, 最大值)；/v1/images、批量作业和参数扫描共用
+NUMERIC_LIMITS = {
+    'batch_size': (int, 1, MAX_IMAGES),
+    'width': (int, 1, MAX_DIMENSION),
+    'height': (int, 1, MAX_DIMENSION),
+    'steps': (int, 1, MAX_STEPS),
+    'cfg_scale': (float, 0, MAX_CFG_SCALE)
+}
+
+
+def numeric_param(field: str, value: Any) -> Tuple[Any, Optional[str]]:
+    """
+    数值参数 -> (值, 错误信息)：转换类型并检查 NUMERIC_LIMITS 中的范围。
+    整数值的 cfg_scale 保持为 int，与未校验时提交给上游的参数相同
+    """
+    cast, low, high = NUMERIC_LIMITS[field]
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None, f"{field} must be a number"
+    if not low <= number <= high:
+        return None, f"{field} must be between {low} and {high}"
+    if number.is_integer():
+        return int(number), None
+    if cast is int:
+        return None, f"{field} must be an integer"
+    return number, None
+
+
+def images_payload(data: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    OpenAI 请求体 -> (上游生成参数, 错误信息)。
+    除标准字段外也接受 negative_prompt / steps / cfg_scale（OpenAI SDK 的 extra_body 会合并到请求体顶层）
+    """
+    prompt = data.get('prompt')
+    if not prompt or not isinstance(prompt, str):
+        return None, "Prompt is required and must be a string"
+    if data.get('response_format', 'url') not in RESPONSE_FORMATS:
+        return None, f"response_format must be one of: {', '.join(RESPONSE_FORMATS)}"
+    try:
+        n = int(data.get('n', 1))
+    except (TypeError, ValueError):
+        n = 0
+    if not 1 <= n <= MAX_IMAGES:
+        return None, f"n must be between 1 and {MAX_IMAGES}"
+    match = _SIZE_PATTERN.match(str(data.get('size', '1024x1024')))
+    if not match:
+        return None, "size must be formatted as WIDTHxHEIGHT, e.g. 1024x1024"
+    numbers = {'width': match.group(1), 'height': match.group(2),
+               'steps': data.get('steps', 8), 'cfg_scale': data.get('cfg_scale', 7)}
+    for field, value in numbers.items():
+        numbers[field], error = numeric_param(field, value)
+        if error:
+            return None, error
+
+    return {
+        "prompt": prompt,
+        "negative_prompt": data.get('negative_prompt', ''),
+        "model": "turbo" if "turbo" in data.get('model', 'zimage-turbo') else "base",
+        "batch_size": n,
+        "width": numbers['width'],
+        "height": numbers['height'],
+        "steps": numbers['steps'],
+        "cfg_scale": numbers['cfg_scale']
+    }, None
+
+
+def url_response(created: int, image_urls: List[str]) -> Dict[str, Any]:
+    return {"created": created, "data": [{"url": url} for url in image_urls]}
+
+
+def processing_response(uuid: str) -> Dict[str, Any]:
+    """等待超时的 202 响应体"""
+    return {
+        "uuid": uuid,
+        "status": "processing",
+        "message": f"Image generation still running, fetch the result from /v1/images/{uuid}"
+    }
+
+
+class Base64Stream:
+    """增量 base64 编码：每次只编码 3 字节对齐的部分，余下的并入下一块，拼接结果与一次性编码相同"""
+
+    def __init__(self):
+        self._pending = b''
+
+    def feed(self, chunk: bytes) -> bytes:
+        data = self._pending + chunk if self._pending else chunk
+        cut = len(data) - len(data) % 3
+        self._pending = data[cut:]
+        return base64.b64encode(data[:cut]) if cut else b''
+
+    def flush(self) -> bytes:
+        tail, self._pending = self._pending, b''
+        return base64.b64encode(tail)
+
+
+# b64_json 响应体的固定片段；base64 字符不需要 JSON 转义，可以直接写进字符串
+def b64_json_head(created: int) -> bytes:
+    return ('{"created": %s, "data": [' % json.dumps(created)).encode()
+
+
+def b64_item_start(index: int) -> bytes:
+    return b'{"b64_json": "' if index == 0 else b', {"b64_json": "'
+
+
+B64_ITEM_END = b'"}'
+B64_JSON_TAIL = b']}\n'
+
+
+def open_images(image_urls: List[str]) -> List[requests.Response]:
+    """
+    先打开所有图片的连接（只读响应头），任一张失败时关闭已打开的连接并抛出 requests 异常，
+    这样错误还能以 502 返回，而不是在已经开始输出的 200 响应体中途断开
+    """
+    responses = []
+    try:
+        for url in image_urls:
+            response = upstream.get(url, stream=True, timeout=IMAGE_FETCH_TIMEOUT)
+            responses.append(response)
+            response.raise_for_status()
+    except requests.exceptions.RequestException:
+        for response in responses:
+            response.close()
+        raise
+    return responses
+
+
+def b64_json_body(created: int, responses: List[requests.Response]) -> Iterator[bytes]:
+    """流式响应体：逐块读取图片、编码、输出，读完一张关闭一张"""
+    try:
+        yield b64_json_head(created)
+        for index, response in enumerate(responses):
+            yield b64_item_start(index)
+            encoder = Base64Stream()
+            for chunk in response.iter_content(B64_CHUNK_SIZE):
+                encoded = encoder.feed(chunk)
+                if encoded:
+                    yield encoded
+            yield encoder.flush() + B64_ITEM_END
+            response.close()
+        yield B64_JSON_TAIL
+    finally:
+        for response in responses:
+            response.close()
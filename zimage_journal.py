@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Z-Image 任务日志 (SQLite WAL)
+可选：设置 ZIMAGE_JOURNAL_PATH 后，把本服务提交的任务、状态变化和最终结果写入磁盘。
+- 多进程 (FLASK_PROCESSES>1 / gunicorn 多 worker) 共享同一份任务状态，任一进程拿到的终态结果其他进程直接复用
+- 重启后恢复对未结束任务的后台轮询（以及完成回调）
+写入经队列由后台线程批量提交，不占请求路径
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from zimage_results import result_cache
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_PATH = os.environ.get('ZIMAGE_JOURNAL_PATH', '')  # 为空时不启用
+# 按请求 fork 子进程的服务器（FLASK_PROCESSES>1）里子进程处理完请求立即退出，队列里的写入会丢失，需同步写入
+JOURNAL_SYNC = os.environ.get('ZIMAGE_JOURNAL_SYNC', 'true' if int(os.environ.get('FLASK_PROCESSES', '1')) > 1 else 'false').lower() == 'true'
+JOURNAL_QUEUE_SIZE = 10000  # 待写入操作上限，满了丢弃（日志是加速和恢复手段，不是唯一数据源）
+JOURNAL_BATCH_SIZE = 500  # 每个事务最多提交的操作数
+JOURNAL_FLUSH_INTERVAL = 0.2  # 批量提交的最长等待时间（秒）
+JOURNAL_RETAIN_SECONDS = 7 * 86400  # 已结束任务的保留时间
+RECOVER_MAX_AGE = 600  # 只恢复这段时间内提交的未结束任务（与轮询器的最长跟踪时间一致）
+MISS_TTL = 5  # 查不到终态结果的任务在这段时间内不再查磁盘（进行中的任务每次轮询都会查缓存）
+MISS_CACHE_SIZE = 10000
+
+TERMINAL_STATUSES = ('completed', 'failed')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    uuid TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    params TEXT,
+    callback_url TEXT,
+    submitted_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, submitted_at);
+"""
+
+UPDATE_STATUS = """
+UPDATE tasks SET status = ?, progress = ?, updated_at = ?, result = COALESCE(?, result)
+WHERE uuid = ? AND status NOT IN ('completed', 'failed') AND (status != ? OR progress != ?)
+"""
+
+
+class TaskJournal:
+    """SQLite 任务日志；未配置路径时所有方法都是空操作"""
+
+    def __init__(self, path: str = JOURNAL_PATH, sync: bool = JOURNAL_SYNC):
+        self.path = path
+        self.enabled = bool(path)
+        self.sync = sync
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue(maxsize=JOURNAL_QUEUE_SIZE)
+        self._writer = None
+        self._pid = None
+        self._initialized = False
+        self._writing = False  # 写入线程手上有尚未提交的批次
+        self._counts: Dict[str, int] = {}  # 启动时的表统计加上之后本进程的写入：in_flight / completed / failed
+        self._misses: "OrderedDict[str, float]" = OrderedDict()  # uuid -> 最近一次查不到终态结果的时间
+        self._misses_lock = threading.Lock()
+
+        self.writes = 0
+        self.batches = 0
+        self.dropped = 0
+        self.lookups = 0
+        self.skipped_lookups = 0
+
+    # ---- 写入 ----
+
+    def record_submit(self, uuid: str, params: Dict[str, Any], callback_url: Optional[str] = None):
+        """任务提交成功"""
+        if self.enabled:
+            self._write(('submit', uuid, json.dumps(params, ensure_ascii=False), callback_url, time.time()))
+
+    def record_result(self, uuid: str, result: Dict):
+        """一次上游状态查询结果；只更新本服务提交过的任务，状态和进度都没变时不写"""
+        if not self.enabled or not result.get('success'):
+            return
+        task_data = result.get('data', {}).get('task', {})
+        status = task_data.get('taskStatus')
+        if not status:
+            return
+        final = json.dumps(result, ensure_ascii=False) if status in TERMINAL_STATUSES else None
+        self._write(('status', uuid, status, int(task_data.get('progress') or 0), final, time.time()))
+
+    def _write(self, op: tuple):
+        if self.sync:
+            try:
+                self._apply(self._connection(), [op])
+            except sqlite3.Error as e:
+                logger.warning(f"Task journal write failed: {e}")
+            return
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(op)
+        except queue.Full:
+            self.dropped += 1
+
+    def _apply(self, conn: sqlite3.Connection, ops: List[tuple]):
+        with conn:
+            for op in ops:
+                if op[0] == 'submit':
+                    _, uuid, params, callback_url, now = op
+                    conn.execute(
+                        "INSERT OR REPLACE INTO tasks (uuid, status, progress, params, callback_url, submitted_at, updated_at) "
+                        "VALUES (?, 'pending', 0, ?, ?, ?, ?)",
+                        (uuid, params, callback_url, now, now)
+                    )
+                    self._count('in_flight', 1)
+                else:
+                    _, uuid, status, progress, final, now = op
+                    updated = conn.execute(UPDATE_STATUS, (status, progress, now, final, uuid, status, progress)).rowcount
+                    if updated and status in TERMINAL_STATUSES:
+                        # UPDATE_STATUS 不会改已结束的行，所以每个任务只会在这里结束一次
+                        self._count('in_flight', -1)
+                        self._count(status, 1)
+        self.writes += len(ops)
+        self.batches += 1
+
+    def flush(self):
+        """把队列里尚未写入的操作立即提交（进程退出时调用）"""
+        if not self.enabled or self._pid != os.getpid():
+            return
+        # 先等写入线程提交手上的批次（批次收集最多 JOURNAL_FLUSH_INTERVAL 秒）
+        deadline = time.time() + 1
+        while self._writing and time.time() < deadline:
+            time.sleep(0.01)
+        ops = []
+        while True:
+            try:
+                ops.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if ops:
+            try:
+                self._apply(self._connection(), ops)
+            except sqlite3.Error as e:
+                logger.error(f"Task journal flush of {len(ops)} failed: {e}")
+
+    def _ensure_writer(self):
+        """懒启动写入线程；多进程模式下每个子进程各自启动"""
+        if self._writer and self._writer.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer and self._writer.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=JOURNAL_QUEUE_SIZE)
+            self._pid = os.getpid()
+            self._writer = threading.Thread(target=self._run, name='zimage-journal', daemon=True)
+            self._writer.start()
+
+    def _run(self):
+        conn = self._connection()
+        while True:
+            ops = [self._queue.get()]
+            self._writing = True
+            deadline = time.time() + JOURNAL_FLUSH_INTERVAL
+            while len(ops) < JOURNAL_BATCH_SIZE:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    ops.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._apply(conn, ops)
+            except sqlite3.Error as e:
+                logger.error(f"Task journal batch of {len(ops)} failed: {e}")
+            finally:
+                self._writing = False
+
+    def _count(self, key: str, delta: int):
+        self._counts[key] = max(0, self._counts.get(key, 0) + delta)
+
+    # ---- 读取 ----
+
+    def terminal_result(self, uuid: str) -> Optional[Dict]:
+        """
+        已结束任务的最终结果（可能由其他进程写入）。
+        进行中的任务每次轮询都会走到这里，最近 MISS_TTL 秒内查不到的直接返回 None，不再读磁盘
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._misses_lock:
+            missed_at = self._misses.get(uuid)
+            if missed_at is not None and now - missed_at <= MISS_TTL:
+                self.skipped_lookups += 1
+                return None
+        self.lookups += 1
+        try:
+            row = self._connection().execute(
+                "SELECT result FROM tasks WHERE uuid = ? AND status IN ('completed', 'failed')", (uuid,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Task journal lookup failed: {e}")
+            return None
+        if row and row[0]:
+            return json.loads(row[0])
+        with self._misses_lock:
+            self._misses[uuid] = now
+            self._misses.move_to_end(uuid)
+            while len(self._misses) > MISS_CACHE_SIZE:
+                self._misses.popitem(last=False)
+        return None
+
+    def in_flight(self, max_age: float = RECOVER_MAX_AGE) -> List[Dict[str, Any]]:
+        """最近提交、尚未结束的任务"""
+        if not self.enabled:
+            return []
+        rows = self._connection().execute(
+            "SELECT uuid, params, callback_url, submitted_at FROM tasks "
+            "WHERE status NOT IN ('completed', 'failed') AND submitted_at > ? ORDER BY submitted_at",
+            (time.time() - max_age,)
+        ).fetchall()
+        return [
+            {"uuid": uuid, "params": json.loads(params or '{}'), "callback_url": callback_url, "submitted_at": submitted_at}
+            for uuid, params, callback_url, submitted_at in rows
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        if not self.enabled:
+            return {"enabled": False}
+        self._connection()  # 首次调用时建表并读取启动时的统计
+        return {
+            "enabled": True,
+            "path": self.path,
+            "sync": self.sync,
+            "tasks": dict(self._counts),
+            "queued": self._queue.qsize(),
+            "writes": self.writes,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "lookups": self.lookups,
+            "skipped_lookups": self.skipped_lookups
+        }
+
+    # ---- 连接 ----
+
+    def _connection(self) -> sqlite3.Connection:
+        """每个线程一个连接；fork 后的子进程重新打开"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    conn.executescript(SCHEMA)
+                    conn.execute(
+                        "DELETE FROM tasks WHERE status IN ('completed', 'failed') AND updated_at < ?",
+                        (time.time() - JOURNAL_RETAIN_SECONDS,)
+                    )
+                    conn.commit()
+                    # 之后的计数由写入路径维护，/health 不再每次扫表
+                    for status, count in conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status"):
+                        self._count(status if status in TERMINAL_STATUSES else 'in_flight', count)
+                    self._initialized = True
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+
+# 进程级共享实例
+task_journal = TaskJournal()
+
+if task_journal.enabled:
+    # 本进程结果缓存未命中时，查找其他进程（或重启前）写入的终态结果
+    result_cache.set_loader(task_journal.terminal_result)
+    atexit.register(task_journal.flush)
+
+
+def recover_in_flight_tasks() -> int:
+    """
+    启动时恢复未结束任务的后台轮询和完成回调，返回恢复的任务数。
+    （在函数内导入，避免 zimage_coalesce -> zimage_journal -> zimage_poller 的循环导入）
+    """
+    if not task_journal.enabled:
+        return 0
+    from zimage_poller import task_poller
+    from zimage_schedule import completion_history
+    from zimage_webhooks import webhooks
+
+    tasks = task_journal.in_flight()
+    for task in tasks:
+        completion_history.register(task['uuid'], task['params'], task['submitted_at'])
+        if task['callback_url']:
+            webhooks.register(task['uuid'], task['callback_url'], task['params'], submitted_at=task['submitted_at'])
+        else:
+            task_poller.watch(task['uuid'])
+    if tasks:
+        logger.info(f"Recovered {len(tasks)} in-flight tasks from journal {task_journal.path}")
+    return len(tasks)
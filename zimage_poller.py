@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+Z-Image 集中式任务轮询器
+每个进行中的任务 UUID 只由一个调度线程轮询（每个 tick 一次上游请求），
+状态变化时唤醒所有等待该任务的请求，上游负载从 O(等待者) 变为 O(任务)
+"""
+
+import heapq
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+
+from zimage_coalesce import task_status
+from zimage_results import result_cache
+from zimage_schedule import completion_history
+
+logger = logging.getLogger(__name__)
+
+# 轮询配置
+POLL_QPS = float(os.environ.get('ZIMAGE_POLL_QPS', '10'))  # 全局上游轮询预算（次/秒）
+POLL_WORKERS = int(os.environ.get('ZIMAGE_POLL_WORKERS', '4'))  # 并发轮询线程数
+POLL_TIMEOUT = 15  # 单次状态查询超时（秒）
+MAX_TRACK_SECONDS = 600  # 任务最长跟踪时间
+TERMINAL_GRACE_SECONDS = 60  # 任务结束后保留结果的时间，方便稍后到达的等待者
+
+TERMINAL_STATUSES = ('completed', 'failed')
+
+
+def fetch_task(uuid: str) -> Dict:
+    """
+    查询上游任务状态，网络错误抛出 requests 异常。
+    经过请求合并层：与同时到达的 /v1/tasks 查询共用一次上游请求，结果也供其复用
+    """
+    return task_status.get(uuid, max_age=0, timeout=POLL_TIMEOUT)
+
+
+class TokenBucket:
+    """令牌桶，限制全局上游轮询速率"""
+
+    def __init__(self, rate: float):
+        self.rate = max(0.1, rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def acquire_delay(self) -> float:
+        """取一个令牌；返回需要等待的秒数（0 表示已取得）"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class TaskWatch:
+    """一个被轮询中的任务"""
+
+    __slots__ = (
+        'uuid', 'status', 'progress', 'result', 'error', 'version', 'created_at',
+        'updated_at', 'finished_at', 'next_poll', 'polls', 'errors', 'rejected',
+        'polling', 'last_running_at', 'waiters', 'condition'
+    )
+
+    def __init__(self, uuid: str, lock: threading.Lock):
+        now = time.time()
+        self.uuid = uuid
+        self.status = 'pending'
+        self.progress = 0
+        self.result = None  # 最近一次上游返回的完整 JSON
+        self.error = None
+        self.version = 0  # 每次状态/进度变化 +1，等待者据此判断是否有更新
+        self.created_at = now
+        self.updated_at = now
+        self.finished_at = None
+        self.next_poll = 0.0
+        self.polls = 0
+        self.errors = 0
+        self.rejected = False  # 上游返回 4xx（如任务不存在），不再轮询
+        self.polling = False
+        self.last_running_at = None  # 最近一次看到任务未完成的时间，用于估计完成耗时
+        self.waiters = 0
+        self.condition = threading.Condition(lock)
+
+    @property
+    def terminal(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    @property
+    def done(self) -> bool:
+        return self.terminal or self.rejected
+
+    def snapshot(self) -> Dict[str, Any]:
+        task_data = (self.result or {}).get('data', {}).get('task', {})
+        return {
+            "uuid": self.uuid,
+            "status": self.status,
+            "progress": self.progress,
+            "version": self.version,
+            "task": task_data,
+            "result": self.result,
+            "error": self.error,
+            "done": self.done,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
+
+
+class TaskPoller:
+    """集中式轮询调度器"""
+
+    def __init__(self, fetch: Callable[[str], Dict] = fetch_task, qps: float = POLL_QPS, workers: int = POLL_WORKERS):
+        self.fetch = fetch
+        self.qps = qps
+        self.workers = max(1, workers)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._tasks: Dict[str, TaskWatch] = {}
+        self._schedule: List = []  # (next_poll, seq, uuid) 小顶堆
+        self._seq = 0
+        self._bucket = TokenBucket(qps)
+        self._executor = None
+        self._thread = None
+        self._pid = None
+        self._listeners: List[Callable[[Dict], None]] = []
+        self._last_expire = 0.0
+
+        self.upstream_polls = 0
+        self.upstream_errors = 0
+        self.notifications = 0
+
+    # ---- 公共接口 ----
+
+    def watch(self, uuid: str) -> Dict[str, Any]:
+        """开始跟踪任务（已在跟踪则不变），返回当前快照"""
+        self._ensure_started()
+        cached = self._cached_result(uuid)
+        with self._lock:
+            return self._get_or_create(uuid, cached).snapshot()
+
+    def get(self, uuid: str) -> Optional[Dict[str, Any]]:
+        """返回已跟踪任务的快照，不触发轮询"""
+        with self._lock:
+            task = self._tasks.get(uuid)
+            return task.snapshot() if task else None
+
+    def wait(self, uuid: str, timeout: float, since_version: Optional[int] = None,
+             since_status: Optional[str] = None) -> Dict[str, Any]:
+        """
+        等待任务变化：默认等到任务结束；指定 since_version 时等到 version 超过它，
+        指定 since_status 时等到（上游确认的）状态不再是它。
+        超时返回当前快照，调用方根据 status 判断。
+        """
+        self._ensure_started()
+        deadline = time.time() + timeout
+        cached = self._cached_result(uuid)
+
+        with self._lock:
+            task = self._get_or_create(uuid, cached)
+            task.waiters += 1
+            try:
+                while True:
+                    if task.done:
+                        break
+                    if since_version is not None and task.version > since_version:
+                        break
+                    if since_status is not None and task.result is not None and task.status != since_status:
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    task.condition.wait(remaining)
+                return task.snapshot()
+            finally:
+                task.waiters -= 1
+
+    def wait_for_completion(self, uuid: str, timeout: float) -> Dict[str, Any]:
+        """等待任务完成或失败"""
+        return self.wait(uuid, timeout)
+
+    def add_listener(self, callback: Callable[[Dict], None]):
+        """注册任务结束回调（在轮询线程中调用，回调需快速返回）"""
+        self._listeners.append(callback)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            active = [task for task in self._tasks.values() if not task.done]
+            return {
+                "tracked_tasks": len(self._tasks),
+                "active_tasks": len(active),
+                "waiters": sum(task.waiters for task in self._tasks.values()),
+                "qps_budget": self.qps,
+                "workers": self.workers,
+                "upstream_polls": self.upstream_polls,
+                "upstream_errors": self.upstream_errors,
+                "notifications": self.notifications,
+                "schedule": completion_history.stats()
+            }
+
+    # ---- 内部实现 ----
+
+    def _ensure_started(self):
+        """懒启动调度线程；多进程模式下每个子进程各自启动"""
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                # fork 后父进程的任务和调度状态都不属于本进程
+                self._tasks.clear()
+                self._schedule.clear()
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='zimage-poll')
+            self._thread = threading.Thread(target=self._run, name='zimage-poller', daemon=True)
+            self._thread.start()
+            logger.info(f"Task poller started (budget {self.qps} polls/s, {self.workers} workers)")
+
+    def _cached_result(self, uuid: str) -> Optional[Dict]:
+        """未跟踪的任务先查终态缓存；缓存未命中时可能读任务日志，所以在取全局锁之前调用"""
+        return None if uuid in self._tasks else result_cache.get(uuid)
+
+    def _get_or_create(self, uuid: str, cached: Optional[Dict] = None) -> TaskWatch:
+        """调用方需持有 self._lock；cached 为 _cached_result 的结果"""
+        task = self._tasks.get(uuid)
+        if task is None:
+            task = TaskWatch(uuid, self._lock)
+            self._tasks[uuid] = task
+            if cached is not None:
+                # 已结束的任务直接由终态缓存恢复，不再轮询上游
+                task_data = cached.get('data', {}).get('task', {})
+                task.result = cached
+                task.status = task_data.get('taskStatus')
+                task.progress = task_data.get('progress', 100 if task.status == 'completed' else 0)
+                task.finished_at = task.created_at
+                task.version = 1
+            else:
+                self._schedule_poll(task, time.time() + completion_history.first_delay(uuid))
+        return task
+
+    def _schedule_poll(self, task: TaskWatch, when: float):
+        """调用方需持有 self._lock"""
+        task.next_poll = when
+        self._seq += 1
+        heapq.heappush(self._schedule, (when, self._seq, task.uuid))
+        self._wakeup.notify()
+
+    def _next_interval(self, task: TaskWatch) -> float:
+        """下一次轮询间隔：有同类任务的完成耗时历史时围绕预测完成时间安排，否则按固定节奏"""
+        return completion_history.next_interval(task.uuid, task.polls, task.errors)
+
+    def _run(self):
+        while True:
+            try:
+                self._tick()
+            except Exception as e:
+                logger.error(f"Task poller error: {e}")
+                time.sleep(1)
+
+    def _tick(self):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+
+            # 找到下一个到期的任务，跳过已被重新调度或已移除的旧堆条目
+            while self._schedule:
+                when, _, uuid = self._schedule[0]
+                task = self._tasks.get(uuid)
+                if task is None or task.done or task.polling or task.next_poll != when:
+                    heapq.heappop(self._schedule)
+                    continue
+                break
+
+            if not self._schedule:
+                self._wakeup.wait(1)
+                return
+
+            when = self._schedule[0][0]
+            if when > now:
+                self._wakeup.wait(min(when - now, 1))
+                return
+
+            delay = self._bucket.acquire_delay()
+            if delay > 0:
+                self._wakeup.wait(delay)
+                return
+
+            heapq.heappop(self._schedule)
+            task.polling = True
+            self.upstream_polls += 1
+
+        self._executor.submit(self._poll, uuid)
+
+    def _poll(self, uuid: str):
+        rejected = False
+        try:
+            result = self.fetch(uuid)
+            error = None
+        except Exception as e:
+            result = None
+            error = str(e)
+            response = getattr(e, 'response', None)
+            rejected = isinstance(e, requests.exceptions.HTTPError) and response is not None and 400 <= response.status_code < 500
+
+        finished = None
+        with self._lock:
+            task = self._tasks.get(uuid)
+            if task is None:
+                return
+            task.polling = False
+            task.polls += 1
+
+            if error is not None:
+                self.upstream_errors += 1
+                task.errors += 1
+                if rejected:
+                    task.rejected = True
+                    task.finished_at = time.time()
+                    completion_history.forget(uuid)
+                    # 监听者（准入名额、完成回调）按失败处理，否则名额和待投递回调一直占着
+                    finished = dict(task.snapshot(), status='failed',
+                                    task={"taskStatus": "failed", "errorMessage": error})
+                if task.error != error or rejected:
+                    task.error = error
+                    self._notify(task)
+                logger.warning(f"Polling task {uuid} failed: {error}")
+            else:
+                task.errors = 0
+                task.error = None
+                task_data = result.get('data', {}).get('task', {}) if result.get('success') else {}
+                status = task_data.get('taskStatus') or task.status
+                progress = task_data.get('progress', task.progress)
+                changed = status != task.status or progress != task.progress or task.result is None
+                task.result = result
+                now = time.time()
+                if changed:
+                    task.status = status
+                    task.progress = progress
+                    if task.terminal:
+                        task.finished_at = now
+                        finished = task.snapshot()
+                        if status == 'completed':
+                            completion_history.record(uuid, task.last_running_at, now)
+                        else:
+                            completion_history.forget(uuid)
+                    self._notify(task)
+                if not task.terminal:
+                    task.last_running_at = now
+
+            if not task.done:
+                self._schedule_poll(task, time.time() + self._next_interval(task))
+
+        if finished:
+            logger.info(f"Task {uuid} {finished['status']}")
+            for callback in list(self._listeners):
+                try:
+                    callback(finished)
+                except Exception as e:
+                    logger.error(f"Task listener error for {uuid}: {e}")
+
+    def _notify(self, task: TaskWatch):
+        """调用方需持有 self._lock"""
+        task.version += 1
+        task.updated_at = time.time()
+        self.notifications += 1
+        task.condition.notify_all()
+
+    def _expire(self, now: float):
+        """移除已结束过久或跟踪超时的任务（每秒最多扫描一次）；调用方需持有 self._lock"""
+        if now - self._last_expire < 1:
+            return
+        self._last_expire = now
+
+        expired = []
+        for uuid, task in self._tasks.items():
+            if task.waiters:
+                continue
+            if task.done and now - task.finished_at > TERMINAL_GRACE_SECONDS:
+                expired.append(uuid)
+            elif not task.done and now - task.created_at > MAX_TRACK_SECONDS:
+                expired.append(uuid)
+        for uuid in expired:
+            del self._tasks[uuid]
+
+
+# 进程级共享实例
+task_poller = TaskPoller()
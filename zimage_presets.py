@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Z-Image 生成参数预设（fast / balanced / quality）
+优化版 /v1/chat/completions 的 preset 字段按这里的值填充生成参数，参数扫描 (zimage_sweeps) 沿用其中的尺寸、步数等
+"""
+
+PRESETS = {
+    'fast': {
+        'batch_size': 1,
+        'width': 512,
+        'height': 512,
+        'steps': 4,
+        'cfg_scale': 5,
+        'negative_prompt': ''
+    },
+    'balanced': {
+        'batch_size': 2,
+        'width': 768,
+        'height': 768,
+        'steps': 6,
+        'cfg_scale': 7,
+        'negative_prompt': 'low quality, blurry'
+    },
+    'quality': {
+        'batch_size': 4,
+        'width': 1024,
+        'height': 1024,
+        'steps': 8,
+        'cfg_scale': 8,
+        'negative_prompt': 'low quality, blurry, deformed'
+    }
+}
@@ -1,41 +1,47 @@
-from flask import Flask, request, jsonify, send_from_directory, render_template
+from flask import Flask, Response, request, jsonify, send_from_directory, render_template
 from flask_cors import CORS
-from collections import defaultdict, deque
 import requests
 import time
 import logging
 import json
 import os
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Dict, Any, Optional, Tuple
 import threading
 
+from zimage_upstream import upstream
+from zimage_poller import task_poller
+from zimage_results import result_cache
+from zimage_journal import task_journal, recover_in_flight_tasks
+from zimage_webhooks import webhooks, validate_callback_url
+from zimage_gencache import CACHE_HEADER, generation_cache, request_cache_mode, cache_status
+from zimage_dedup import submission_dedup
+from zimage_batcher import micro_batcher
+from zimage_admission import admission
+from zimage_submit import submit_generation
+from zimage_batches import (
+    BATCH_ID_HEADER, NDJSON_MIMETYPE, BatchRunner, batch_result_lines, batch_store, parse_after
+)
+from zimage_sweeps import expand_sweep, sweep_concurrency
+from zimage_images import IMAGES_WAIT, b64_json_body, images_payload, open_images, processing_response, url_response
+from zimage_coalesce import task_status, handle_batch_request
+from zimage_events import (
+    SSE_HEADERS, chat_completion_stream, extract_image_urls, parse_last_event_id, task_event_stream,
+    parse_deadline, parse_wait, long_poll_task, long_poll_limiter, long_poll_rejected_response
+)
+from zimage_usage import (
+    RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW, DAILY_REQUEST_LIMIT,
+    check_rate_limit, get_rate_limit_status, peek_rate_limit, log_usage, get_usage_stats, get_system_stats,
+    get_usage_logs, get_prompt_stats, clear_old_usage
+)
+
 app = Flask(__name__)
-CORS(app)  # 启用 CORS 支持
+CORS(app, expose_headers=[CACHE_HEADER, BATCH_ID_HEADER])  # 启用 CORS 支持
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Z-Image API endpoints
-ZIMAGE_GENERATE = "https://zimage.run/api/z-image/generate"
-ZIMAGE_TASK = "https://zimage.run/api/z-image/task"
-
-# 配置参数
-RATE_LIMIT_REQUESTS = 10  # 每分钟最多请求数
-RATE_LIMIT_WINDOW = 60    # 时间窗口（秒）
-DAILY_REQUEST_LIMIT = 100  # 每日请求限制
-
-# 内存中的数据存储
-user_requests = defaultdict(lambda: deque())  # 用于频率限制
-daily_usage = defaultdict(int)  # 每日使用量
-usage_logs = []  # 详细使用日志
-prompt_stats = defaultdict(int)  # 提示词统计
-ip_stats = defaultdict(int)  # IP访问统计
-
-# 锁对象，用于线程安全
-stats_lock = threading.Lock()
-
 def get_client_ip():
     """获取客户端真实IP"""
     # 检查代理头
@@ -46,97 +52,6 @@ def get_client_ip():
     else:
         return request.remote_addr
 
-def check_rate_limit(ip: str) -> Tuple[bool, str]:
-    """检查频率限制"""
-    now = time.time()
-
-    # 清理过期的请求记录
-    with stats_lock:
-        while user_requests[ip] and user_requests[ip][0] < now - RATE_LIMIT_WINDOW:
-            user_requests[ip].popleft()
-
-        # 检查当前窗口内的请求数
-        if len(user_requests[ip]) >= RATE_LIMIT_REQUESTS:
-            return False, f"Rate limit exceeded. Max {RATE_LIMIT_REQUESTS} requests per {RATE_LIMIT_WINDOW} seconds"
-
-        # 记录当前请求
-        user_requests[ip].append(now)
-
-        # 检查每日限制
-        today = datetime.now().strftime('%Y-%m-%d')
-        daily_key = f"{ip}:{today}"
-        if daily_usage[daily_key] >= DAILY_REQUEST_LIMIT:
-            return False, f"Daily limit exceeded. Max {DAILY_REQUEST_LIMIT} requests per day"
-
-        daily_usage[daily_key] += 1
-        return True, ""
-
-def log_usage(ip: str, prompt: str, task_uuid: str, model: str, parameters: dict, success: bool = True, error: str = None):
-    """记录使用情况"""
-    with stats_lock:
-        # 记录到详细日志
-        log_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "ip": ip,
-            "prompt": prompt[:100] + "..." if len(prompt) > 100 else prompt,  # 截断长提示
-            "task_uuid": task_uuid,
-            "model": model,
-            "parameters": parameters,
-            "success": success,
-            "error": error,
-            "date": datetime.now().strftime('%Y-%m-%d'),
-            "hour": datetime.now().hour
-        }
-        usage_logs.append(log_entry)
-
-        # 更新统计信息
-        if success:
-            prompt_stats[prompt[:50]] += 1  # 使用前50个字符作为统计键
-            ip_stats[ip] += 1
-
-        # 保持日志文件在合理大小（最多10000条记录）
-        if len(usage_logs) > 10000:
-            usage_logs[:] = usage_logs[-5000:]
-
-def get_usage_stats():
-    """获取使用统计"""
-    with stats_lock:
-        today = datetime.now().strftime('%Y-%m-%d')
-        today_requests = [log for log in usage_logs if log["date"] == today]
-
-        # 按小时统计
-        hourly_stats = defaultdict(int)
-        successful_requests = 0
-        failed_requests = 0
-
-        for log in today_requests:
-            hourly_stats[log["hour"]] += 1
-            if log["success"]:
-                successful_requests += 1
-            else:
-                failed_requests += 1
-
-        # 最受欢迎的提示词
-        top_prompts = sorted(prompt_stats.items(), key=lambda x: x[1], reverse=True)[:5]
-
-        # 活跃IP统计
-        active_ips = len(ip_stats)
-
-        return {
-            "today": {
-                "total_requests": len(today_requests),
-                "successful": successful_requests,
-                "failed": failed_requests,
-                "hourly_distribution": dict(hourly_stats)
-            },
-            "top_prompts": [{"prompt": k, "count": v} for k, v in top_prompts],
-            "active_users": active_ips,
-            "rate_limits": {
-                "requests_per_minute": RATE_LIMIT_REQUESTS,
-                "daily_limit": DAILY_REQUEST_LIMIT
-            }
-        }
-
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
     """
@@ -171,6 +86,13 @@ def chat_completions():
         # Extract parameters from extra_body or use defaults
         extra_body = data.get('extra_body', {})
 
+        # 可选的完成回调地址，提交前校验，避免任务已生成却无法回调
+        callback_url = extra_body.get('callback_url')
+        if callback_url is not None:
+            callback_error = validate_callback_url(callback_url)
+            if callback_error:
+                return jsonify({"error": callback_error}), 400
+
         # Translate to Z-Image payload format
         zimage_payload = {
             "prompt": prompt,
@@ -183,29 +105,36 @@ def chat_completions():
             "cfg_scale": extra_body.get('cfg_scale', 7)
         }
 
-        logger.info(f"[{client_ip}] Forwarding request to Z-Image: {zimage_payload}")
-
-        # Submit to Z-Image API
-        response = requests.post(ZIMAGE_GENERATE, json=zimage_payload, timeout=30)
-        response.raise_for_status()
-
-        result = response.json()
-        if not result.get('success'):
-            error_msg = result.get('error', 'Unknown error from Z-Image')
-            logger.error(f"[{client_ip}] Z-Image API error: {error_msg}")
-            log_usage(client_ip, prompt, None, data.get('model', 'zimage-turbo'), zimage_payload, False, error_msg)
-            return jsonify({"error": error_msg}), response.status_code
-
-        task_uuid = result['data']['uuid']
-        processing_time = time.time() - start_time
-
-        logger.info(f"[{client_ip}] Task submitted successfully with UUID: {task_uuid} (took {processing_time:.2f}s)")
+        # 结果缓存 → 进行中任务去重 → 准入排队 → 微批提交（开启微批时与同时到达的相同请求合并提交）
+        cache_mode = request_cache_mode(request.headers)
+        submission = submit_generation(zimage_payload, client_ip, cache_mode, callback_url=callback_url)
+        if not submission.ok:
+            if submission.upstream_error:
+                log_usage(client_ip, prompt, None, data.get('model', 'zimage-turbo'), zimage_payload, False,
+                          submission.upstream_error)
+            return jsonify(submission.body), submission.status_code, submission.headers
+        task_uuid = submission.uuid
+        cached = submission.cached
+        logger.info(f"[{client_ip}] Task {task_uuid} ready (took {time.time() - start_time:.2f}s)")
+
+        if callback_url:
+            webhooks.register(task_uuid, callback_url, zimage_payload)
 
         # 记录成功的使用情况
         log_usage(client_ip, prompt, task_uuid, data.get('model', 'zimage-turbo'), zimage_payload, True)
 
+        if data.get('stream'):
+            # 流式响应：同一个连接内推送进度，最后一块是图片，客户端不必再轮询
+            extra = {"cached": cached, "deduplicated": submission.deduplicated, "queue": submission.queue}
+            response = Response(chat_completion_stream(task_uuid, data.get('model', 'zimage-turbo'), extra),
+                                mimetype='text/event-stream', headers=SSE_HEADERS)
+            if generation_cache.enabled:
+                response.headers[CACHE_HEADER] = cache_status(cache_mode, cached)
+            return response
+
         # Return OpenAI-compatible response
-        return jsonify({
+        rate_status = get_rate_limit_status(client_ip)
+        response = jsonify({
             "id": f"chatcmpl-{task_uuid}",
             "object": "chat.completion",
             "created": int(time.time()),
@@ -225,11 +154,17 @@ def chat_completions():
                 "total_tokens": 0
             },
             "rate_limit": {
-                "remaining": max(0, RATE_LIMIT_REQUESTS - len(user_requests[client_ip])),
+                "remaining": rate_status["rate_limit_remaining"],
                 "reset_time": int(start_time + RATE_LIMIT_WINDOW),
-                "daily_remaining": max(0, DAILY_REQUEST_LIMIT - daily_usage[f"{client_ip}:{datetime.now().strftime('%Y-%m-%d')}"])
-            }
+                "daily_remaining": rate_status["daily_limit_remaining"]
+            },
+            "cached": cached,  # 复用了参数相同的已完成任务
+            "deduplicated": submission.deduplicated,  # 挂到了参数相同、正在生成的任务上
+            "queue": submission.queue  # 等待上游生成名额的排队情况
         })
+        if generation_cache.enabled:
+            response.headers[CACHE_HEADER] = cache_status(cache_mode, cached)
+        return response
 
     except requests.exceptions.RequestException as e:
         error_msg = f"Network error: {str(e)}"
@@ -242,16 +177,179 @@ def chat_completions():
         log_usage(client_ip, prompt if 'prompt' in locals() else "Unknown", task_uuid, data.get('model', 'zimage-turbo') if 'data' in locals() else "unknown", {}, False, error_msg)
         return jsonify({"error": error_msg}), 500
 
+@app.route('/v1/images/generations', methods=['POST'])
+def images_generations():
+    """
+    OpenAI Images API 兼容端点：提交生成任务，等待完成后返回图片 URL 或 base64
+    """
+    client_ip = get_client_ip()
+    task_uuid = None
+    start_time = time.time()
+
+    try:
+        allowed, limit_message = check_rate_limit(client_ip)
+        if not allowed:
+            logger.warning(f"Rate limit exceeded for IP {client_ip}: {limit_message}")
+            return jsonify({
+                "error": "Rate limit exceeded",
+                "message": limit_message,
+                "retry_after": RATE_LIMIT_WINDOW
+            }), 429
+
+        data = request.get_json(silent=True) or {}
+        zimage_payload, error = images_payload(data)
+        if error:
+            return jsonify({"error": error}), 400
+        prompt = zimage_payload['prompt']
+        model = data.get('model', 'zimage-turbo')
+        wait = parse_deadline(data.get('timeout'), IMAGES_WAIT)
+
+        # 与 chat completions 相同的提交流程：结果缓存、进行中任务去重、准入排队、微批
+        cache_mode = request_cache_mode(request.headers)
+        submission = submit_generation(zimage_payload, client_ip, cache_mode)
+        if not submission.ok:
+            if submission.upstream_error:
+                log_usage(client_ip, prompt, None, model, zimage_payload, False, submission.upstream_error)
+            return jsonify(submission.body), submission.status_code, submission.headers
+        task_uuid = submission.uuid
+        cached = submission.cached
+
+        log_usage(client_ip, prompt, task_uuid, model, zimage_payload, True)
+
+        snapshot = task_poller.wait_for_completion(task_uuid, timeout=wait)
+        if snapshot['status'] == 'failed':
+            return jsonify({"uuid": task_uuid, "error": snapshot.get('error') or "Task failed to complete"}), 500
+        if snapshot['status'] != 'completed':
+            return jsonify(processing_response(task_uuid)), 202
+
+        image_urls = extract_image_urls(snapshot['task'])
+        created = int(time.time())
+        if data.get('response_format') == 'b64_json':
+            # 逐块读取上游图片并编码输出，不在内存中保留整张图片
+            response = Response(b64_json_body(created, open_images(image_urls)), mimetype='application/json')
+        else:
+            response = jsonify(url_response(created, image_urls))
+        if generation_cache.enabled:
+            response.headers[CACHE_HEADER] = cache_status(cache_mode, cached)
+        logger.info(f"[{client_ip}] Images for {task_uuid} returned (took {time.time() - start_time:.2f}s)")
+        return response
+
+    except requests.exceptions.RequestException as e:
+        error_msg = f"Network error: {str(e)}"
+        logger.error(f"[{client_ip}] {error_msg}")
+        return jsonify({"error": error_msg}), 502 if task_uuid else 500
+    except Exception as e:
+        error_msg = f"Internal server error: {str(e)}"
+        logger.error(f"[{client_ip}] Unexpected error: {str(e)}")
+        return jsonify({"error": error_msg}), 500
+
+@app.route('/v1/batches', methods=['POST'])
+def create_batch():
+    """
+    批量生成作业：请求体为 NDJSON（每行一组参数），边读边提交，
+    响应为 NDJSON 结果流（任务结束一条输出一条），最后一行是作业汇总
+    """
+    client_ip = get_client_ip()
+    # 只检查是否还有额度，不计数：每一行提交时再各自计入频率限制
+    allowed, limit_message = peek_rate_limit(client_ip)
+    if not allowed:
+        logger.warning(f"Rate limit exceeded for IP {client_ip}: {limit_message}")
+        return jsonify({
+            "error": "Rate limit exceeded",
+            "message": limit_message,
+            "retry_after": RATE_LIMIT_WINDOW
+        }), 429
+
+    job = batch_store.create()
+    if job is None:
+        return jsonify({"error": "Too many batches in progress, please retry later"}), 503
+
+    # 逐行读取请求体，不把整个请求体读进内存；解析出的参数立即交给作业的工作线程
+    runner = BatchRunner(job, client_ip=client_ip)
+    try:
+        for line in request.stream:
+            if not runner.add(line):
+                logger.warning(f"Batch {job.id} reached the item limit, remaining lines ignored")
+                break
+    finally:
+        runner.close()
+    logger.info(f"Batch {job.id} accepted {job.total} items")
+
+    return Response(batch_result_lines(job), mimetype=NDJSON_MIMETYPE,
+                    headers={BATCH_ID_HEADER: job.id, 'Location': f"/v1/batches/{job.id}"})
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+def batch_results(batch_id: str):
+    """
+    续传批量作业的结果：?after=<最后收到的 seq>，作业未结束时继续跟随新结果
+    """
+    job = batch_store.get(batch_id)
+    if job is None:
+        return jsonify({"error": "Batch not found or expired"}), 404
+    return Response(batch_result_lines(job, parse_after(request.args.get('after'))), mimetype=NDJSON_MIMETYPE,
+                    headers={BATCH_ID_HEADER: job.id})
+
+@app.route('/v1/sweeps', methods=['POST'])
+def create_sweep():
+    """
+    参数扫描：一个提示词 × 参数网格的笛卡尔积并发生成（并发数受 concurrency 限制），
+    响应为 NDJSON 结果流（每行带格子参数），最后一行的 grid 是按格子顺序的完整网格；
+    作业 ID 与批量作业共用，可用 /v1/batches/<batch_id> 续传
+    """
+    client_ip = get_client_ip()
+    # 只检查是否还有额度，不计数：每个格子提交时再各自计入频率限制
+    allowed, limit_message = peek_rate_limit(client_ip)
+    if not allowed:
+        logger.warning(f"Rate limit exceeded for IP {client_ip}: {limit_message}")
+        return jsonify({
+            "error": "Rate limit exceeded",
+            "message": limit_message,
+            "retry_after": RATE_LIMIT_WINDOW
+        }), 429
+
+    data = request.get_json(silent=True) or {}
+    cells, error = expand_sweep(data)
+    if error:
+        return jsonify({"error": error}), 400
+    job = batch_store.create()
+    if job is None:
+        return jsonify({"error": "Too many batches in progress, please retry later"}), 503
+
+    job.cells = [params for params, _ in cells]
+    runner = BatchRunner(job, concurrency=sweep_concurrency(data.get('concurrency')), client_ip=client_ip)
+    for _, payload in cells:
+        runner.add_item(None, payload)
+    runner.close()
+    logger.info(f"Sweep {job.id} started with {len(cells)} combinations")
+
+    return Response(batch_result_lines(job), mimetype=NDJSON_MIMETYPE,
+                    headers={BATCH_ID_HEADER: job.id, 'Location': f"/v1/batches/{job.id}"})
+
+@app.route('/v1/tasks:batch', methods=['POST'])
+def batch_task_status():
+    """
+    批量查询任务状态：请求体 {"uuids": [...], "timeout": 10}
+    """
+    body, status_code = handle_batch_request(request.get_json(silent=True))
+    return jsonify(body), status_code
+
 @app.route('/v1/tasks/<uuid>', methods=['GET'])
 def get_task_status(uuid: str):
     """
     Get the status of a Z-Image generation task
     """
     try:
-        response = requests.get(f"{ZIMAGE_TASK}/{uuid}", timeout=30)
-        response.raise_for_status()
-
-        result = response.json()
+        # 长轮询：?wait=秒&since=状态，挂起到状态变化或超时
+        wait = parse_wait(request.args.get('wait'))
+        if wait:
+            allowed, result = long_poll_task(uuid, get_client_ip(), wait, request.args.get('since'))
+            if not allowed:
+                return jsonify(long_poll_rejected_response()), 429
+            if result is not None:
+                return jsonify(result)
+
+        # 同一 UUID 的并发查询合并为一次上游请求
+        result = task_status.get(uuid, timeout=30)
         logger.info(f"Task status for {uuid}: {result}")
 
         return jsonify(result)
@@ -263,6 +361,14 @@ def get_task_status(uuid: str):
         logger.error(f"Unexpected error when checking task status: {str(e)}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+@app.route('/v1/tasks/<uuid>/events', methods=['GET'])
+def task_events(uuid):
+    """
+    任务进度事件流 (SSE)：推送状态/进度变化，完成后推送图片URL并关闭
+    """
+    since_version = parse_last_event_id(request.headers.get('Last-Event-ID'))
+    return Response(task_event_stream(uuid, since_version), mimetype='text/event-stream', headers=SSE_HEADERS)
+
 @app.route('/v1/images/<uuid>', methods=['GET'])
 def get_image_results(uuid: str):
     """
@@ -276,59 +382,57 @@ def get_image_results(uuid: str):
         }), 400
 
     try:
-        max_attempts = 60  # Maximum polling attempts (5 minutes with 5-second intervals)
-        attempt = 0
-
-        while attempt < max_attempts:
-            response = requests.get(f"{ZIMAGE_TASK}/{uuid}", timeout=30)
-            response.raise_for_status()
-
-            result = response.json()
-
-            if result.get('success') and result.get('data', {}).get('task', {}).get('taskStatus') == 'completed':
-                task_data = result['data']['task']
-                # 检查是否有图片结果
-                result_url = task_data.get('resultUrl')
-                image_urls = [result_url] if result_url else task_data.get('resultUrls', [])
-
-                logger.info(f"Task {uuid} completed with {len(image_urls)} images")
-
-                return jsonify({
-                    "uuid": uuid,
-                    "status": "completed",
-                    "image_urls": image_urls,
-                    "task_info": task_data
-                })
-
-            # If task failed
-            if result.get('success') and result.get('data', {}).get('task', {}).get('taskStatus') == 'failed':
-                logger.error(f"Task {uuid} failed")
-                return jsonify({
-                    "uuid": uuid,
-                    "status": "failed",
-                    "error": "Task failed to complete"
-                }), 500
-
-            # Task still processing, wait and retry
-            logger.info(f"Task {uuid} still processing, attempt {attempt + 1}/{max_attempts}")
-            time.sleep(5)
-            attempt += 1
+        # 上游轮询由集中式轮询器负责，等待同一任务的多个请求共享同一次查询
+        snapshot = task_poller.wait_for_completion(uuid, timeout=300)  # 最多等待5分钟
+        task_data = snapshot['task']
+
+        if snapshot['status'] == 'completed':
+            # 检查是否有图片结果
+            result_url = task_data.get('resultUrl')
+            image_urls = [result_url] if result_url else task_data.get('resultUrls', [])
+
+            logger.info(f"Task {uuid} completed with {len(image_urls)} images")
+
+            return jsonify({
+                "uuid": uuid,
+                "status": "completed",
+                "image_urls": image_urls,
+                "task_info": task_data
+            })
+
+        # If task failed
+        if snapshot['status'] == 'failed':
+            logger.error(f"Task {uuid} failed")
+            return jsonify({
+                "uuid": uuid,
+                "status": "failed",
+                "error": "Task failed to complete"
+            }), 500
+
+        # 上游一直不可用
+        if snapshot['error']:
+            logger.error(f"Network error when polling for images: {snapshot['error']}")
+            return jsonify({"error": f"Network error: {snapshot['error']}"}), 500
 
         # Timeout reached
-        logger.error(f"Task {uuid} timed out after {max_attempts} attempts")
+        logger.error(f"Task {uuid} timed out waiting for completion")
         return jsonify({
             "uuid": uuid,
             "status": "timeout",
             "error": "Task took too long to complete"
         }), 408
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Network error when polling for images: {str(e)}")
-        return jsonify({"error": f"Network error: {str(e)}"}), 500
     except Exception as e:
         logger.error(f"Unexpected error when polling for images: {str(e)}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+@app.route('/v1/queue', methods=['GET'])
+def queue_status():
+    """
+    准入队列：上游生成中的任务数、排队数和新请求的预计等待
+    """
+    return jsonify(admission.queue_status())
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """
@@ -337,7 +441,19 @@ def health_check():
     return jsonify({
         "status": "healthy",
         "service": "zimage-proxy",
-        "timestamp": int(time.time())
+        "timestamp": int(time.time()),
+        "upstream": upstream.stats(),
+        "poller": task_poller.stats(),
+        "task_status": task_status.stats(),
+        "long_poll": long_poll_limiter.stats(),
+        "webhooks": webhooks.stats(),
+        "result_cache": result_cache.stats(),
+        "generation_cache": generation_cache.stats(),
+        "dedup": submission_dedup.stats(),
+        "microbatch": micro_batcher.stats(),
+        "admission": admission.stats(),
+        "batches": batch_store.stats(),
+        "journal": task_journal.stats()
     })
 
 @app.route('/')
@@ -356,7 +472,10 @@ def index():
             "endpoints": {
                 "chat_completions": "/v1/chat/completions (POST)",
                 "task_status": "/v1/tasks/<uuid> (GET)",
+                "task_events": "/v1/tasks/<uuid>/events (GET, SSE)",
+                "task_batch": "/v1/tasks:batch (POST)",
                 "image_results": "/v1/images/<uuid> (GET)",
+                "image_generations": "/v1/images/generations (POST, OpenAI Images API)",
                 "health": "/health (GET)",
                 "web_interface": "/"
             },
@@ -382,7 +501,12 @@ def api_info():
         "endpoints": {
             "chat_completions": "/v1/chat/completions (POST)",
             "task_status": "/v1/tasks/<uuid> (GET)",
+            "task_events": "/v1/tasks/<uuid>/events (GET, SSE)",
+            "task_batch": "/v1/tasks:batch (POST)",
             "image_results": "/v1/images/<uuid> (GET)",
+            "image_generations": "/v1/images/generations (POST, OpenAI Images API)",
+            "batches": "/v1/batches (POST, NDJSON)",
+            "sweeps": "/v1/sweeps (POST, NDJSON)",
             "health": "/health (GET)",
             "api_info": "/api",
             "web_interface": "/"
@@ -404,23 +528,11 @@ def admin_stats():
 
         # 添加系统信息
         client_ip = get_client_ip()
-        with stats_lock:
-            current_user_requests = len(user_requests[client_ip])
-            user_daily_requests = daily_usage.get(f"{client_ip}:{datetime.now().strftime('%Y-%m-%d')}", 0)
-
-        stats['current_user'] = {
-            "ip": client_ip,
-            "current_requests": current_user_requests,
-            "daily_requests": user_daily_requests,
-            "rate_limit_remaining": max(0, RATE_LIMIT_REQUESTS - current_user_requests),
-            "daily_limit_remaining": max(0, DAILY_REQUEST_LIMIT - user_daily_requests)
-        }
+        stats['current_user'] = {"ip": client_ip, **get_rate_limit_status(client_ip)}
 
         # 添加系统性能指标
-        total_memory_usage = len(usage_logs)
         stats['system'] = {
-            "total_logs": total_memory_usage,
-            "active_ips_tracked": len(user_requests),
+            **get_system_stats(),
             "uptime": "Available if you add uptime tracking",
             "rate_limits_enabled": True
         }
@@ -448,28 +560,12 @@ def admin_logs():
         if limit < 1:
             limit = 50
 
-        with stats_lock:
-            # 过滤日志
-            filtered_logs = usage_logs
-            if success_only:
-                filtered_logs = [log for log in usage_logs if log.get('success', False)]
-
-            # 应用分页
-            total = len(filtered_logs)
-            paginated_logs = filtered_logs[offset:offset + limit]
+        result = get_usage_logs(limit, offset, success_only)
+        result["filters"] = {
+            "success_only": success_only
+        }
 
-        return jsonify({
-            "logs": paginated_logs,
-            "pagination": {
-                "total": total,
-                "offset": offset,
-                "limit": limit,
-                "has_more": offset + limit < total
-            },
-            "filters": {
-                "success_only": success_only
-            }
-        })
+        return jsonify(result)
 
     except Exception as e:
         logger.error(f"Error getting admin logs: {str(e)}")
@@ -485,30 +581,49 @@ def admin_prompts():
         min_count = request.args.get('min_count', 1, type=int)
         limit = request.args.get('limit', 20, type=int)
 
-        with stats_lock:
-            # 按使用次数排序
-            sorted_prompts = sorted(prompt_stats.items(), key=lambda x: x[1], reverse=True)
-
-            # 过滤和限制
-            filtered_prompts = [
-                {"prompt": prompt, "count": count}
-                for prompt, count in sorted_prompts
-                if count >= min_count
-            ][:limit]
+        result = get_prompt_stats(min_count, limit)
+        result["filters"] = {
+            "min_count": min_count,
+            "limit": limit
+        }
 
-        return jsonify({
-            "top_prompts": filtered_prompts,
-            "total_unique_prompts": len(prompt_stats),
-            "filters": {
-                "min_count": min_count,
-                "limit": limit
-            }
-        })
+        return jsonify(result)
 
     except Exception as e:
         logger.error(f"Error getting prompt stats: {str(e)}")
         return jsonify({"error": "Failed to get prompt statistics"}), 500
 
+@app.route('/admin/upstream', methods=['GET'])
+def admin_upstream():
+    """
+    管理员上游连接池接口 - 查看连接复用情况
+    """
+    return jsonify(upstream.stats())
+
+@app.route('/admin/results', methods=['GET', 'DELETE'])
+def admin_results():
+    """
+    管理员终态结果缓存接口 - GET 查看统计和最近条目（?uuid= 查看单个任务的完整结果），
+    DELETE 清空缓存（?uuid= 只移除单个任务）
+    """
+    uuid = request.args.get('uuid')
+    if request.method == 'DELETE':
+        if uuid:
+            return jsonify({"uuid": uuid, "removed": result_cache.remove(uuid)})
+        return jsonify({"removed": result_cache.clear()})
+
+    if uuid:
+        result = result_cache.get(uuid)
+        if result is None:
+            return jsonify({"error": "Task not in result cache", "uuid": uuid}), 404
+        return jsonify({"uuid": uuid, "result": result})
+
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({
+        "stats": result_cache.stats(),
+        "entries": result_cache.entries(limit)
+    })
+
 @app.route('/admin/clear-cache', methods=['POST'])
 def admin_clear_cache():
     """
@@ -518,28 +633,12 @@ def admin_clear_cache():
         # 获取清理天数参数
         days = request.args.get('days', 7, type=int)
 
-        cutoff_date = datetime.now() - timedelta(days=days)
-
-        with stats_lock:
-            # 清理旧的日志记录
-            original_count = len(usage_logs)
-            usage_logs[:] = [
-                log for log in usage_logs
-                if datetime.fromisoformat(log['timestamp'].replace('Z', '+00:00')) > cutoff_date
-            ]
-
-            # 清理旧的每日使用记录
-            old_daily_keys = [
-                key for key in daily_usage.keys()
-                if datetime.strptime(key.split(':')[1], '%Y-%m-%d') < cutoff_date.date()
-            ]
-            for key in old_daily_keys:
-                del daily_usage[key]
+        result = clear_old_usage(days)
 
         return jsonify({
             "message": "Cache cleared successfully",
-            "removed_logs": original_count - len(usage_logs),
-            "remaining_logs": len(usage_logs),
+            "removed_logs": result["removed_logs"],
+            "remaining_logs": result["remaining_logs"],
             "cutoff_days": days
         })
 
@@ -574,5 +673,11 @@ if __name__ == '__main__':
     logger.info("  GET /admin/stats - Usage statistics")
     logger.info("  GET /admin/logs - Request logs")
     logger.info("  GET /admin/prompts - Popular prompts")
+    logger.info("  GET /admin/upstream - Upstream connection pool")
+    logger.info("  GET/DELETE /admin/results - Terminal result cache")
     logger.info("  POST /admin/clear-cache - Clear old data")
+    upstream.warm()
+
+    # 从任务日志恢复重启前未结束的任务
+    recover_in_flight_tasks()
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
@@ -0,0 +1,1780 @@
+#!/usr/bin/env python3
+"""
+Z-Image asyncio 代理服务
+与 Flask 版本提供相同的路由，但上游请求和轮询都是非阻塞的：
+每个等待中的 /v1/images/<uuid> 只占用一个协程，而不是一个线程
+
+运行: python zimage_proxy_async.py
+或:   gunicorn zimage_proxy_async:create_app --worker-class aiohttp.GunicornWebWorker
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import DefaultResolver
+
+from zimage_upstream import UPSTREAM_POOL_SIZE, ZIMAGE_GENERATE, ZIMAGE_TASK
+from zimage_schedule import completion_history
+from zimage_results import result_cache
+from zimage_journal import task_journal
+from zimage_admission import (
+    ADMISSION_HOLD_MAX, ADMISSION_QUEUE_TIMEOUT, PRIORITY_QUALITY, AdmissionController, AdmissionRejected, AdmissionTicket,
+    priority_for
+)
+from zimage_gencache import CACHE_HEADER, generation_cache, payload_key, request_cache_mode, cache_status
+from zimage_dedup import DEDUP_SUBMIT_WAIT, DedupClaim, submission_dedup
+from zimage_batcher import (
+    MICROBATCH_MAX_SIZE, MICROBATCH_WINDOW_MS, SUBMIT_TIMEOUT,
+    batch_eligible, member_result, project_member, split_member_id
+)
+from zimage_submit import Submission, record_submission
+from zimage_batches import (
+    BATCH_ADMISSION_WAIT, BATCH_ID_HEADER, BATCH_TASK_TIMEOUT, NDJSON_MIMETYPE, BatchJob, BatchRunner,
+    batch_result, batch_store, log_item_usage, parse_after, submission_error
+)
+from zimage_sweeps import expand_sweep, sweep_concurrency
+from zimage_images import (
+    B64_CHUNK_SIZE, B64_ITEM_END, B64_JSON_TAIL, IMAGE_FETCH_TIMEOUT, IMAGES_WAIT, Base64Stream,
+    b64_item_start, b64_json_head, images_payload, processing_response, url_response
+)
+from zimage_coalesce import (
+    BATCH_PARALLELISM, STATUS_MAX_AGE, STATUS_RETAIN_SECONDS, STATUS_TIMEOUT,
+    batch_response, is_terminal, parse_batch_request
+)
+from zimage_events import (
+    CHAT_STREAM_DONE, SSE_HEADERS, SSE_HEARTBEAT_SECONDS, SSE_MAX_SECONDS, SSE_RETRY_MS,
+    chat_chunk, chat_final_content, format_sse, task_event,
+    long_poll_limiter, long_poll_rejected_response, parse_deadline, parse_wait
+)
+from zimage_webhooks import (
+    WEBHOOK_ALLOW_PRIVATE, WEBHOOK_MAX_ATTEMPTS, WEBHOOK_QUEUE_SIZE, WEBHOOK_TIMEOUT, WEBHOOK_WORKERS, WebhookDelivery,
+    CallbackAddressError, build_webhook_payload, delivery_headers, is_private_address, retry_delay, should_retry,
+    validate_callback_url
+)
+from zimage_usage import (
+    RATE_LIMIT_REQUESTS, RATE_LIMIT_WINDOW, DAILY_REQUEST_LIMIT,
+    check_rate_limit, get_rate_limit_status, peek_rate_limit, log_usage, get_usage_stats, get_system_stats,
+    get_usage_logs, get_prompt_stats, clear_old_usage
+)
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+WEB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web')
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, Cache-Control, X-ZImage-Cache',
+    'Access-Control-Expose-Headers': 'X-ZImage-Cache, X-ZImage-Batch-Id'
+}
+
+
+async def run_blocking(func, *args):
+    """同步调用放到线程池执行：限流、使用日志（Redis / 共享内存后端）、结果缓存的磁盘后备都可能阻塞事件循环"""
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+async def cached_result(uuid: str) -> Optional[Dict]:
+    """终态结果缓存查询：内存命中直接返回，未命中时到线程池里查后备来源（任务日志）"""
+    result = result_cache.get(uuid, load=False)
+    if result is None and result_cache.has_loader:
+        result = await run_blocking(result_cache.load, uuid)
+    return result
+
+
+class AsyncUpstreamClient:
+    """aiohttp 上游客户端，所有协程共享一个 keep-alive 连接池"""
+
+    def __init__(self, pool_size: int = UPSTREAM_POOL_SIZE):
+        self.pool_size = max(1, pool_size)
+        self.session = None
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    async def start(self, app=None):
+        # limit 是同时打开的连接上限，超出的请求在事件循环里排队，不占线程
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=30)
+        self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self, app=None):
+        if self.session:
+            await self.session.close()
+
+    async def request_json(self, method: str, url: str, timeout: float, **kwargs) -> Tuple[int, Dict]:
+        """发送请求并解析 JSON，HTTP 错误抛出 aiohttp.ClientResponseError"""
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            async with self.session.request(method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as response:
+                response.raise_for_status()
+                return response.status, await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pool_size": self.pool_size,
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight
+        }
+
+
+upstream = AsyncUpstreamClient()
+
+
+class AsyncTaskStatus:
+    """任务状态查询合并：同一 UUID 的并发查询共享一个进行中的上游请求，max_age 内复用最近结果"""
+
+    def __init__(self, max_age: float = STATUS_MAX_AGE):
+        self.max_age = max_age
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._recent: Dict[str, Tuple[float, Dict]] = {}  # uuid -> (fetched_at, result)
+        self._last_prune = time.time()
+        self._batch_semaphore = None
+        self.origin_calls = 0
+        self.coalesced_calls = 0
+        self.fresh_hits = 0
+
+    async def get(self, uuid: str, timeout: float = 15) -> Dict:
+        cached = await cached_result(uuid)
+        if cached is not None:
+            return cached
+
+        member = split_member_id(uuid)
+        if member is not None:
+            # 微批成员：查询合并提交的上游任务，只取属于该成员的图片
+            result = project_member(await self.get(member[0], timeout), member[1])
+            if result_cache.put(uuid, result):
+                task_journal.record_result(uuid, result)
+            return result
+
+        recent = self._recent.get(uuid)
+        if recent and time.time() - recent[0] <= self.max_age:
+            self.fresh_hits += 1
+            return recent[1]
+
+        fetch = self._in_flight.get(uuid)
+        if fetch is not None:
+            self.coalesced_calls += 1
+        else:
+            self.origin_calls += 1
+            fetch = asyncio.ensure_future(self._fetch(uuid, timeout))
+            self._in_flight[uuid] = fetch
+        # shield: 任一调用者被取消（客户端断开）都不会取消共享的上游请求
+        return await asyncio.shield(fetch)
+
+    async def get_many(self, uuids: list, timeout: float) -> Tuple[Dict[str, Dict], Dict[str, str], Dict[str, int]]:
+        """批量查询：本地终态或新鲜结果直接返回，其余并发查询上游（有界并发），整体不超过 timeout 秒"""
+        if self._batch_semaphore is None:
+            # 在事件循环内创建，兼容 Python 3.9 的 loop 绑定
+            self._batch_semaphore = asyncio.Semaphore(max(1, BATCH_PARALLELISM))
+
+        found: Dict[str, Dict] = {}
+        errors: Dict[str, str] = {}
+        missing = []
+        now = time.time()
+        for uuid in uuids:
+            recent = self._recent.get(uuid)
+            if recent and (is_terminal(recent[1]) or now - recent[0] <= self.max_age):
+                found[uuid] = recent[1]
+                continue
+            cached = await cached_result(uuid)
+            if cached is not None:
+                found[uuid] = cached
+            else:
+                missing.append(uuid)
+        local = len(found)
+        self.fresh_hits += local
+
+        async def fetch(uuid: str) -> Dict:
+            async with self._batch_semaphore:
+                return await self.get(uuid, timeout=min(STATUS_TIMEOUT, timeout))
+
+        fetches = {asyncio.ensure_future(fetch(uuid)): uuid for uuid in missing}
+        if fetches:
+            done, not_done = await asyncio.wait(fetches, timeout=timeout)
+            for fetch_task in done:
+                try:
+                    found[fetches[fetch_task]] = fetch_task.result()
+                except Exception as e:
+                    errors[fetches[fetch_task]] = str(e)
+            for fetch_task in not_done:
+                # 只取消等待，已发出的上游请求被 shield 保护，结果仍会写入 _recent
+                fetch_task.cancel()
+                errors[fetches[fetch_task]] = f"Deadline exceeded ({timeout}s)"
+
+        results = {uuid: found[uuid] for uuid in uuids if uuid in found}
+        ordered_errors = {uuid: errors[uuid] for uuid in uuids if uuid in errors}
+        counts = {
+            "requested": len(uuids),
+            "local": local,
+            "fetched": len(results) - local,
+            "failed": len(ordered_errors)
+        }
+        return results, ordered_errors, counts
+
+    async def _fetch(self, uuid: str, timeout: float) -> Dict:
+        try:
+            _, result = await upstream.request_json('GET', f"{ZIMAGE_TASK}/{uuid}", timeout=timeout)
+            self._store(uuid, result)
+            return result
+        finally:
+            del self._in_flight[uuid]
+
+    def _store(self, uuid: str, result: Dict):
+        result_cache.put(uuid, result)
+        task_journal.record_result(uuid, result)
+        now = time.time()
+        self._recent[uuid] = (now, result)
+        if now - self._last_prune > STATUS_RETAIN_SECONDS:
+            self._last_prune = now
+            cutoff = now - STATUS_RETAIN_SECONDS
+            for key in [key for key, (fetched_at, _) in self._recent.items() if fetched_at < cutoff]:
+                del self._recent[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_age": self.max_age,
+            "origin_calls": self.origin_calls,
+            "coalesced_calls": self.coalesced_calls,
+            "fresh_hits": self.fresh_hits,
+            "in_flight": len(self._in_flight),
+            "recent_results": len(self._recent)
+        }
+
+
+task_status = AsyncTaskStatus()
+
+
+class _AsyncBatch:
+    """一个收集中 / 提交中的微批"""
+
+    __slots__ = ('size', 'full', 'submit', 'ticket')
+
+    def __init__(self, ticket: Optional[AdmissionTicket] = None):
+        self.ticket = ticket  # 代表整批提交的请求的准入凭证
+        self.size = 1
+        self.full = asyncio.Event()
+        self.submit: Optional[asyncio.Future] = None
+
+
+class AsyncMicroBatcher:
+    """zimage_batcher.MicroBatcher 的协程版本：窗口期内相同参数的 batch_size=1 提交合并为一次上游批量提交"""
+
+    def __init__(self, window_ms: float = MICROBATCH_WINDOW_MS, max_size: int = MICROBATCH_MAX_SIZE):
+        self.window = max(0.0, window_ms) / 1000
+        self.max_size = max(1, max_size)
+        self._open: Dict[str, _AsyncBatch] = {}  # 参数哈希 -> 还在收集成员的批
+        self.requests = 0
+        self.upstream_submits = 0
+        self.batched_requests = 0
+        self.largest_batch = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 and self.max_size > 1
+
+    async def submit(self, payload: Dict[str, Any], ticket: Optional[AdmissionTicket] = None) -> Tuple[int, Dict]:
+        """
+        返回 (HTTP 状态码, 上游响应 JSON)；合并提交时 data.uuid 为该调用方的成员 ID。
+        准入与 Flask 版本一致：只有代表整批提交的请求排队占名额，准入拒绝 (AdmissionRejected) 由整批共享
+        """
+        self.requests += 1
+        if not self.enabled or not batch_eligible(payload):
+            if ticket is not None:
+                await admit(ticket)
+            self.upstream_submits += 1
+            return await upstream.request_json('POST', ZIMAGE_GENERATE, timeout=SUBMIT_TIMEOUT, json=payload)
+
+        key = payload_key(payload)
+        batch = self._open.get(key)
+        if batch is not None:
+            index = batch.size
+            batch.size += 1
+            if batch.size >= self.max_size:
+                del self._open[key]
+                batch.full.set()
+        else:
+            index = 0
+            batch = _AsyncBatch(ticket)
+            self._open[key] = batch
+            # 提交放在独立任务里，第一个请求的客户端断开不会影响同批的其他请求
+            batch.submit = asyncio.ensure_future(self._submit_batch(key, batch, payload))
+
+        try:
+            status, result = await asyncio.shield(batch.submit)
+        finally:
+            if ticket is not None and index > 0:
+                ticket.follow(batch.ticket)
+        if batch.size == 1 or not result.get('success') or not result.get('data', {}).get('uuid'):
+            return status, result
+        return status, member_result(result, result['data']['uuid'], index)
+
+    async def _submit_batch(self, key: str, batch: _AsyncBatch, payload: Dict[str, Any]) -> Tuple[int, Dict]:
+        try:
+            if batch.ticket is not None:
+                # 排队期间到达的相同请求继续并入这一批
+                await admit(batch.ticket)
+            await asyncio.wait_for(batch.full.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if self._open.get(key) is batch:
+                del self._open[key]
+        size = batch.size
+        self.upstream_submits += 1
+        if size > 1:
+            self.batched_requests += size
+            logger.info(f"Micro-batched {size} identical submissions into one upstream task")
+        self.largest_batch = max(self.largest_batch, size)
+        return await upstream.request_json('POST', ZIMAGE_GENERATE, timeout=SUBMIT_TIMEOUT, json=dict(payload, batch_size=size))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "window_ms": self.window * 1000,
+            "max_size": self.max_size,
+            "collecting": len(self._open),
+            "requests": self.requests,
+            "upstream_submits": self.upstream_submits,
+            "batched_requests": self.batched_requests,
+            "submits_saved": self.requests - self.upstream_submits,
+            "largest_batch": self.largest_batch
+        }
+
+
+micro_batcher = AsyncMicroBatcher()
+
+# WebSocket 订阅配置
+WS_MAX_SUBSCRIPTIONS = 1000  # 每个连接最多同时订阅的任务数
+WS_MAX_TRACK_SECONDS = 600  # 单个任务最长跟踪时间
+WS_FLUSH_INTERVAL = 0.1  # 同一连接的增量合并发送的时间窗口（秒）
+WS_FINAL_STATUSES = ('completed', 'failed', 'error', 'timeout')  # 推送后自动取消订阅
+IMAGE_RESULTS_WAIT = 300  # /v1/images/<uuid> 等待任务结束的最长时间（秒）
+
+
+class TaskSubscriptionHub:
+    """
+    多路复用任务订阅：每个被订阅的任务只有一个监视协程（经 task_status 查询，与其他查询合并），
+    状态变化以紧凑增量推送给所有订阅它的 WebSocket 连接
+    增量格式: {"t": uuid, "s": 状态, "p": 进度, "u": [图片URL], "e": 错误}，只包含变化的字段
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, set] = {}  # uuid -> {queue}
+        self._state: Dict[str, Dict] = {}  # uuid -> 最近一次完整状态
+        self._watchers: Dict[str, asyncio.Task] = {}
+        self.deltas_sent = 0
+
+    def subscribe(self, queue: asyncio.Queue, uuid: str):
+        self._subscribers.setdefault(uuid, set()).add(queue)
+        state = self._state.get(uuid)
+        if state:
+            # 中途加入的订阅者先收到一次完整状态
+            queue.put_nowait(dict(state, t=uuid))
+        if uuid not in self._watchers:
+            self._watchers[uuid] = asyncio.ensure_future(self._watch(uuid))
+
+    def unsubscribe(self, queue: asyncio.Queue, uuid: str):
+        subscribers = self._subscribers.get(uuid)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[uuid]
+
+    async def wait_for_change(self, uuid: str, timeout: float, since_status: Optional[str] = None):
+        """长轮询：挂起到任务状态不再是 since_status（未指定时等到任务结束）或超时"""
+        queue = asyncio.Queue()
+        self.subscribe(queue, uuid)
+        deadline = time.time() + timeout
+        status = None
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                try:
+                    delta = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    return
+                status = delta.get('s', status)
+                if status in WS_FINAL_STATUSES:
+                    return
+                if since_status is not None and status is not None and status != since_status:
+                    return
+        finally:
+            self.unsubscribe(queue, uuid)
+
+    def _publish(self, uuid: str, delta: Dict, final: bool = False):
+        self._state[uuid] = dict(self._state.get(uuid, {}), **delta)
+        message = dict(delta, t=uuid)
+        subscribers = self._subscribers.pop(uuid, set()) if final else self._subscribers.get(uuid, set())
+        for queue in subscribers:
+            queue.put_nowait(message)
+            self.deltas_sent += 1
+
+    async def _watch(self, uuid: str):
+        started = time.time()
+        polls = 0
+        errors = 0
+        last_running_at = None
+        try:
+            # 与集中式轮询器一致：刚提交的任务按预测（或极速预设）节奏推迟第一次查询
+            await asyncio.sleep(completion_history.first_delay(uuid))
+            while uuid in self._subscribers:
+                if time.time() - started > WS_MAX_TRACK_SECONDS:
+                    self._publish(uuid, {"s": "timeout"}, final=True)
+                    return
+                try:
+                    result = await task_status.get(uuid, timeout=15)
+                    errors = 0
+                except aiohttp.ClientResponseError as e:
+                    if 400 <= e.status < 500:
+                        # 上游拒绝了该任务（如 UUID 不存在）
+                        self._publish(uuid, {"s": "error", "e": str(e)}, final=True)
+                        completion_history.forget(uuid)
+                        return
+                    result = None
+                    errors += 1
+                except UPSTREAM_ERRORS:
+                    result = None
+                    errors += 1
+
+                polls += 1
+                if result is not None:
+                    task_data = result.get('data', {}).get('task', {}) if result.get('success') else {}
+                    current = {"s": task_data.get('taskStatus', 'pending'), "p": task_data.get('progress', 0)}
+                    if current["s"] == 'completed':
+                        current["p"] = 100
+                        current["u"] = extract_images(task_data)
+                    previous = self._state.get(uuid, {})
+                    delta = {key: value for key, value in current.items() if previous.get(key) != value}
+                    final = current["s"] in ('completed', 'failed')
+                    if delta or final:
+                        self._publish(uuid, delta, final=final)
+                    if current["s"] == 'completed':
+                        completion_history.record(uuid, last_running_at, time.time())
+                    elif current["s"] == 'failed':
+                        completion_history.forget(uuid)
+                    if final:
+                        return
+                    last_running_at = time.time()
+
+                # 与集中式轮询器相同的自适应节奏；出错时退避
+                await asyncio.sleep(completion_history.next_interval(uuid, polls, errors))
+        finally:
+            self._watchers.pop(uuid, None)
+            self._state.pop(uuid, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "subscribed_tasks": len(self._subscribers),
+            "subscriptions": sum(len(subscribers) for subscribers in self._subscribers.values()),
+            "watchers": len(self._watchers),
+            "deltas_sent": self.deltas_sent
+        }
+
+
+subscription_hub = TaskSubscriptionHub()
+
+
+def track_admission(uuid: str):
+    """准入名额随任务结束归还：由订阅中心跟踪任务（与其他订阅共用一个监视协程）"""
+    asyncio.ensure_future(_release_when_finished(uuid))
+
+
+async def _release_when_finished(uuid: str):
+    await subscription_hub.wait_for_change(uuid, ADMISSION_HOLD_MAX)
+    admission.finished(uuid)
+
+
+async def wait_for_admission(ticket: AdmissionTicket, timeout: float = ADMISSION_QUEUE_TIMEOUT) -> bool:
+    """AdmissionTicket.wait 的协程版本：排队时不占用线程"""
+    if ticket.rejected:
+        return False
+    loop = asyncio.get_event_loop()
+    granted = loop.create_future()
+
+    def wake():
+        loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+    if ticket.granted or admission.on_grant(ticket, wake):
+        return True
+    try:
+        await asyncio.wait_for(granted, timeout)
+        return True
+    except asyncio.TimeoutError:
+        # 超时的同时被放行也算放行
+        return not admission.withdraw(ticket)
+
+
+async def claim_submission(payload: Dict[str, Any], client_ip: str, cache_mode: str) -> DedupClaim:
+    """submission_dedup.claim 的协程版本：等待同时到达的相同提交时不占用线程"""
+    claim, key, submission = submission_dedup.begin(payload, client_ip, cache_mode)
+    if claim is not None:
+        return claim
+    loop = asyncio.get_event_loop()
+    finished = loop.create_future()
+
+    def wake():
+        loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(True))
+
+    if submission.on_done(wake):
+        try:
+            await asyncio.wait_for(finished, DEDUP_SUBMIT_WAIT)
+        except asyncio.TimeoutError:
+            return DedupClaim()
+    # attach 会查终态结果缓存（可能读任务日志）
+    return await run_blocking(submission_dedup.attach, key, submission)
+
+
+async def admit(ticket: AdmissionTicket):
+    """AdmissionTicket.admit 的协程版本"""
+    if not await wait_for_admission(ticket.enter()):
+        raise AdmissionRejected(ticket)
+
+
+# 名额的归还依赖订阅中心而不是线程轮询器，所以使用本模块自己的实例
+admission = AdmissionController(track=track_admission)
+
+# 上游网络错误（连接失败、HTTP 错误状态、超时）
+UPSTREAM_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+async def submit_generation_async(payload: Dict[str, Any], client_ip: Optional[str] = None, cache_mode: str = 'use',
+                                  priority: Optional[int] = None, callback_url: Optional[str] = None) -> Submission:
+    """zimage_submit.submit_generation 的协程版本：排队、等待同时到达的相同提交都不占用线程；上游网络错误照常抛出"""
+    submission = Submission()
+    uuid = await run_blocking(generation_cache.lookup, payload, cache_mode)
+    submission.cached = uuid is not None
+    claim = DedupClaim() if submission.cached else await claim_submission(payload, client_ip, cache_mode)
+    ticket = AdmissionTicket() if submission.cached or claim.attached \
+        else admission.ticket(priority_for(payload) if priority is None else priority)
+    with claim, ticket:
+        if submission.cached:
+            logger.info(f"[{client_ip}] Generation cache hit, reusing task {uuid}")
+        elif claim.attached:
+            uuid = claim.uuid
+            submission.deduplicated = True
+            logger.info(f"[{client_ip}] Identical submission in flight, attaching to task {uuid}")
+        else:
+            logger.info(f"[{client_ip}] Forwarding request to Z-Image: {payload}")
+            try:
+                status, result = await micro_batcher.submit(payload, ticket)
+            except AdmissionRejected:
+                logger.warning(f"[{client_ip}] Admission rejected ({ticket.rejection()['message']})")
+                submission.reject(ticket)
+                return submission
+            uuid = result.get('data', {}).get('uuid') if result.get('success') else None
+            if not uuid:
+                submission.upstream_error = result.get('error', 'Unknown error from Z-Image')
+                logger.error(f"[{client_ip}] Z-Image API error: {submission.upstream_error}")
+                submission.fail({"error": submission.upstream_error}, status)
+                return submission
+
+            record_submission(uuid, payload, claim, ticket, callback_url)
+            await run_blocking(generation_cache.store, payload, uuid, cache_mode)
+            logger.info(f"[{client_ip}] Task submitted successfully with UUID: {uuid}")
+
+    submission.uuid = uuid
+    submission.queue = ticket.info()
+    return submission
+
+
+class AsyncBatchRunner(BatchRunner):
+    """批量作业执行器的协程版本：工作协程代替工作线程，排队和等待任务结束都不占用线程"""
+
+    def __init__(self, job: BatchJob, **kwargs):
+        super().__init__(job, **kwargs)
+        self._queue = asyncio.Queue()
+
+    def _start_worker(self):
+        return asyncio.ensure_future(self._work())
+
+    async def _work(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            index, custom_id, payload = item
+            try:
+                self.job.record(await process_batch_item(index, custom_id, payload, self.client_ip))
+            except Exception as e:
+                logger.error(f"Batch {self.job.id} line {index} failed: {e}")
+                self.job.record(batch_result(index, custom_id, None, 'error', error=str(e)))
+
+
+async def process_batch_item(index: int, custom_id: Optional[str], payload: Dict[str, Any],
+                             client_ip: Optional[str] = None) -> Dict[str, Any]:
+    """zimage_batches.run_batch_item 的协程版本：经订阅中心等待任务结束"""
+    if client_ip is not None:
+        allowed, limit_message = await run_blocking(check_rate_limit, client_ip)
+        if not allowed:
+            return batch_result(index, custom_id, None, 'rate_limited', error=limit_message)
+
+    deadline = time.time() + BATCH_ADMISSION_WAIT
+    while True:
+        # 批量作业一律按 quality 排队，不抢交互请求的 fast 名额
+        try:
+            submission = await submit_generation_async(payload, client_ip, priority=PRIORITY_QUALITY)
+        except UPSTREAM_ERRORS as e:
+            await run_blocking(log_item_usage, client_ip, payload, None, f"Network error: {e}")
+            return batch_result(index, custom_id, None, 'error', error=f"Network error: {e}")
+        if not submission.rejected or time.time() + submission.retry_after > deadline:
+            break
+        await asyncio.sleep(submission.retry_after)
+    if not submission.ok:
+        error = submission_error(submission)
+        await run_blocking(log_item_usage, client_ip, payload, None, error)
+        return batch_result(index, custom_id, None, 'rejected' if submission.rejected else 'error', error=error)
+    uuid = submission.uuid
+    await run_blocking(log_item_usage, client_ip, payload, uuid)
+
+    await subscription_hub.wait_for_change(uuid, BATCH_TASK_TIMEOUT)
+    task_data = (await task_status.get(uuid, timeout=5)).get('data', {}).get('task', {})
+    if task_data.get('taskStatus') == 'completed':
+        return batch_result(index, custom_id, uuid, 'completed', extract_images(task_data))
+    if task_data.get('taskStatus') == 'failed':
+        return batch_result(index, custom_id, uuid, 'failed',
+                            error=task_data.get('errorMessage') or "Task failed to complete")
+    return batch_result(index, custom_id, uuid, 'timeout', error="Task did not finish in time")
+
+
+class CallbackResolver(AbstractResolver):
+    """
+    回调投递用的 DNS 解析：连接前检查解析出的地址，连接器随后连接的就是检查过的地址，
+    提交时校验过的主机名不会被 DNS rebinding 改指到内网（TLS 仍按主机名校验）
+    """
+
+    def __init__(self):
+        self._resolver = DefaultResolver()
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET):
+        hosts = await self._resolver.resolve(host, port, family)
+        if not WEBHOOK_ALLOW_PRIVATE and any(is_private_address(entry['host']) for entry in hosts):
+            raise CallbackAddressError("callback_url must not point to a private or local address")
+        return hosts
+
+    async def close(self):
+        await self._resolver.close()
+
+
+class AsyncWebhookDispatcher:
+    """
+    完成回调的协程版本：经订阅中心等待任务结束（与 WebSocket/长轮询共享监视协程），
+    结束后按与 Flask 版本相同的请求体、签名和退避规则投递
+    """
+
+    def __init__(self, queue_size: int = WEBHOOK_QUEUE_SIZE, workers: int = WEBHOOK_WORKERS):
+        self.queue_size = max(1, queue_size)
+        self.workers = max(1, workers)
+        self.session = None
+        self._semaphore = None
+        self._tasks = set()  # 持有后台协程的引用，防止被回收
+        self._tracking = 0
+        self._queued = 0
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+
+    async def close(self, app=None):
+        if self.session:
+            await self.session.close()
+
+    def register(self, uuid: str, callback_url: str, context: Dict[str, Any], submitted_at: Optional[float] = None):
+        task = asyncio.ensure_future(self._track(uuid, callback_url, context, submitted_at or time.time()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _track(self, uuid: str, callback_url: str, context: Dict[str, Any], submitted_at: float):
+        self._tracking += 1
+        try:
+            await subscription_hub.wait_for_change(uuid, WS_MAX_TRACK_SECONDS)
+            # 监视协程刚查询过，这里命中 task_status 的短期缓存
+            result = await task_status.get(uuid, timeout=STATUS_TIMEOUT)
+        except UPSTREAM_ERRORS as e:
+            logger.warning(f"Webhook for task {uuid} abandoned: {e}")
+            return
+        finally:
+            self._tracking -= 1
+
+        task_data = result.get('data', {}).get('task', {}) if result.get('success') else {}
+        status = task_data.get('taskStatus')
+        if status not in ('completed', 'failed'):
+            return
+        if self._queued >= self.queue_size:
+            self.dropped += 1
+            logger.warning(f"Webhook queue full, dropping callback for task {uuid}")
+            return
+
+        snapshot = {"uuid": uuid, "status": status, "task": task_data}
+        delivery = WebhookDelivery(callback_url, build_webhook_payload(snapshot, submitted_at, context))
+        self._queued += 1
+        try:
+            await self._deliver(delivery)
+        finally:
+            self._queued -= 1
+
+    async def _deliver(self, delivery: WebhookDelivery):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=WEBHOOK_TIMEOUT),
+                                                 connector=aiohttp.TCPConnector(resolver=CallbackResolver()))
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+
+        while True:
+            delivery.attempts += 1
+            async with self._semaphore:
+                try:
+                    async with self.session.post(delivery.url, data=delivery.body, headers=delivery_headers(delivery),
+                                                 allow_redirects=False) as response:
+                        ok = 200 <= response.status < 300
+                        retry = not ok and should_retry(response.status)
+                        error = None if ok else f"HTTP {response.status}"
+                except aiohttp.ClientConnectorError as e:
+                    ok = False
+                    retry = not isinstance(e.os_error, CallbackAddressError)
+                    error = str(e.os_error) or type(e).__name__
+                except UPSTREAM_ERRORS as e:
+                    ok = False
+                    retry = True
+                    error = str(e) or type(e).__name__
+
+            if ok:
+                self.delivered += 1
+                return
+            logger.warning(f"Webhook delivery {delivery.id} to {delivery.url} failed (attempt {delivery.attempts}): {error}")
+            if not retry or delivery.attempts >= WEBHOOK_MAX_ATTEMPTS:
+                self.failed += 1
+                return
+            self.retried += 1
+            await asyncio.sleep(retry_delay(delivery.attempts))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending_tasks": self._tracking,
+            "queued": self._queued,
+            "queue_size": self.queue_size,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dropped": self.dropped
+        }
+
+
+webhooks = AsyncWebhookDispatcher()
+
+
+def get_client_ip(request: web.Request) -> str:
+    """获取客户端真实IP"""
+    # 检查代理头
+    if request.headers.get('X-Forwarded-For'):
+        return request.headers.get('X-Forwarded-For').split(',')[0].strip()
+    elif request.headers.get('X-Real-IP'):
+        return request.headers.get('X-Real-IP')
+    else:
+        return request.remote
+
+
+def extract_images(task_data: Dict) -> list:
+    """从任务数据中取出图片URL"""
+    result_url = task_data.get('resultUrl')
+    return [result_url] if result_url else task_data.get('resultUrls', [])
+
+
+@web.middleware
+async def cors_middleware(request: web.Request, handler):
+    """与 flask_cors 的 CORS(app) 等效：这里只应答预检请求，响应头由 add_cors_headers 添加"""
+    if request.method == 'OPTIONS':
+        return web.Response(status=200, headers=CORS_HEADERS)
+    return await handler(request)
+
+
+async def add_cors_headers(request: web.Request, response: web.StreamResponse):
+    """
+    on_response_prepare 信号：在响应头发出之前添加 CORS 头。
+    流式响应（SSE、NDJSON、WebSocket）在处理函数返回前就已 prepare，中间件返回后再加就晚了
+    """
+    response.headers.update(CORS_HEADERS)
+
+
+async def chat_completions(request: web.Request) -> web.Response:
+    """
+    OpenAI-compatible chat completions endpoint that forwards requests to Z-Image API
+    """
+    client_ip = get_client_ip(request)
+    task_uuid = None
+    start_time = time.time()
+    prompt = "Unknown"
+    model = "unknown"
+
+    try:
+        # 检查频率限制
+        allowed, limit_message = await run_blocking(check_rate_limit, client_ip)
+        if not allowed:
+            logger.warning(f"Rate limit exceeded for IP {client_ip}: {limit_message}")
+            return web.json_response({
+                "error": "Rate limit exceeded",
+                "message": limit_message,
+                "retry_after": RATE_LIMIT_WINDOW
+            }, status=429)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.json_response({"error": "Invalid JSON in request body"}, status=400)
+
+        model = data.get('model', 'zimage-turbo')
+
+        # Extract prompt from messages (OpenAI format)
+        messages = data.get('messages', [])
+        if not messages:
+            return web.json_response({"error": "No messages provided"}, status=400)
+
+        prompt = messages[0].get('content')
+        if not prompt or not isinstance(prompt, str):
+            return web.json_response({"error": "Prompt is required and must be a string"}, status=400)
+
+        # Extract parameters from extra_body or use defaults
+        extra_body = data.get('extra_body', {})
+
+        # 可选的完成回调地址，提交前校验（含 DNS 解析，放到线程池避免阻塞事件循环）
+        callback_url = extra_body.get('callback_url')
+        if callback_url is not None:
+            callback_error = await run_blocking(validate_callback_url, callback_url)
+            if callback_error:
+                return web.json_response({"error": callback_error}, status=400)
+
+        # Translate to Z-Image payload format
+        zimage_payload = {
+            "prompt": prompt,
+            "negative_prompt": extra_body.get('negative_prompt', ''),
+            "model": "turbo" if "turbo" in model else "base",
+            "batch_size": extra_body.get('batch_size', 1),
+            "width": extra_body.get('width', 1024),
+            "height": extra_body.get('height', 1024),
+            "steps": extra_body.get('steps', 8),
+            "cfg_scale": extra_body.get('cfg_scale', 7)
+        }
+
+        # 结果缓存 → 进行中任务去重 → 准入排队 → 微批提交（开启微批时与同时到达的相同请求合并提交）
+        cache_mode = request_cache_mode(request.headers)
+        submission = await submit_generation_async(zimage_payload, client_ip, cache_mode, callback_url=callback_url)
+        if not submission.ok:
+            if submission.upstream_error:
+                await run_blocking(log_usage, client_ip, prompt, None, model, zimage_payload, False,
+                                   submission.upstream_error)
+            return web.json_response(submission.body, status=submission.status_code, headers=submission.headers)
+        task_uuid = submission.uuid
+        cached = submission.cached
+        logger.info(f"[{client_ip}] Task {task_uuid} ready (took {time.time() - start_time:.2f}s)")
+
+        if callback_url:
+            webhooks.register(task_uuid, callback_url, zimage_payload)
+
+        # 记录成功的使用情况
+        await run_blocking(log_usage, client_ip, prompt, task_uuid, model, zimage_payload, True)
+
+        if data.get('stream'):
+            # 流式响应：同一个连接内推送进度，最后一块是图片，客户端不必再轮询
+            headers = {CACHE_HEADER: cache_status(cache_mode, cached)} if generation_cache.enabled else {}
+            extra = {"cached": cached, "deduplicated": submission.deduplicated, "queue": submission.queue}
+            return await stream_chat_completion(request, task_uuid, model, extra, headers)
+
+        # Return OpenAI-compatible response
+        rate_status = await run_blocking(get_rate_limit_status, client_ip)
+        response = web.json_response({
+            "id": f"chatcmpl-{task_uuid}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": task_uuid,
+                    "task_uuid": task_uuid
+                },
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0
+            },
+            "rate_limit": {
+                "remaining": rate_status["rate_limit_remaining"],
+                "reset_time": int(start_time + RATE_LIMIT_WINDOW),
+                "daily_remaining": rate_status["daily_limit_remaining"]
+            },
+            "cached": cached,  # 复用了参数相同的已完成任务
+            "deduplicated": submission.deduplicated,  # 挂到了参数相同、正在生成的任务上
+            "queue": submission.queue  # 等待上游生成名额的排队情况
+        })
+        if generation_cache.enabled:
+            response.headers[CACHE_HEADER] = cache_status(cache_mode, cached)
+        return response
+
+    except UPSTREAM_ERRORS as e:
+        error_msg = f"Network error: {str(e)}"
+        logger.error(f"[{client_ip}] {error_msg}")
+        await run_blocking(log_usage, client_ip, prompt, task_uuid, model, {}, False, error_msg)
+        return web.json_response({"error": error_msg}, status=500)
+    except Exception as e:
+        error_msg = f"Internal server error: {str(e)}"
+        logger.error(f"[{client_ip}] Unexpected error: {str(e)}")
+        await run_blocking(log_usage, client_ip, prompt, task_uuid, model, {}, False, error_msg)
+        return web.json_response({"error": error_msg}, status=500)
+
+
+async def stream_chat_completion(request: web.Request, uuid: str, model: str, extra: Dict[str, Any],
+                                 headers: Dict[str, str]) -> web.StreamResponse:
+    """
+    stream=true 的 chat completions：由订阅中心的状态增量驱动（与其他订阅者共用一个监视协程），
+    进度变化推送空 delta 块，结束时推送图片 markdown 块和 [DONE]
+    """
+    response = web.StreamResponse(headers={**SSE_HEADERS, **headers, 'Content-Type': 'text/event-stream'})
+    await response.prepare(request)
+    await response.write(chat_chunk(uuid, model, {"role": "assistant", "content": ""},
+                                    task=dict({"uuid": uuid, "status": "queued", "progress": 0}, **extra)).encode())
+
+    queue = asyncio.Queue()
+    subscription_hub.subscribe(queue, uuid)
+    deadline = time.time() + SSE_MAX_SECONDS
+    state: Dict[str, Any] = {}
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                content = chat_final_content(uuid, 'timeout', [])
+                await response.write(chat_chunk(uuid, model, {"content": content}, 'stop',
+                                                task={"uuid": uuid, "status": "timeout"}).encode())
+                break
+            try:
+                delta = await asyncio.wait_for(queue.get(), min(SSE_HEARTBEAT_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                await response.write(b": keep-alive\n\n")
+                continue
+
+            state.update(delta)
+            task = {"uuid": uuid, "status": state.get('s'), "progress": state.get('p', 0)}
+            if state.get('s') in WS_FINAL_STATUSES:
+                image_urls = state.get('u', []) if state['s'] == 'completed' else []
+                content = chat_final_content(uuid, state['s'], image_urls, state.get('e'))
+                await response.write(chat_chunk(uuid, model, {"content": content}, 'stop',
+                                                task=dict(task, image_urls=image_urls)).encode())
+                break
+            await response.write(chat_chunk(uuid, model, {}, task=task).encode())
+        await response.write(CHAT_STREAM_DONE.encode())
+    finally:
+        subscription_hub.unsubscribe(queue, uuid)
+    return response
+
+
+async def get_task_status(request: web.Request) -> web.Response:
+    """
+    Get the status of a Z-Image generation task
+    """
+    uuid = request.match_info['uuid']
+    try:
+        # 长轮询：?wait=秒&since=状态，由订阅中心的状态增量唤醒，结束后返回最新状态
+        wait = parse_wait(request.query.get('wait'))
+        if wait:
+            client_ip = get_client_ip(request)
+            if not long_poll_limiter.acquire(client_ip):
+                return web.json_response(long_poll_rejected_response(), status=429)
+            try:
+                await subscription_hub.wait_for_change(uuid, wait, request.query.get('since'))
+            finally:
+                long_poll_limiter.release(client_ip)
+
+        result = await task_status.get(uuid, timeout=30)
+        logger.info(f"Task status for {uuid}: {result}")
+        return web.json_response(result)
+
+    except UPSTREAM_ERRORS as e:
+        logger.error(f"Network error when checking task status: {str(e)}")
+        return web.json_response({"error": f"Network error: {str(e)}"}, status=500)
+    except Exception as e:
+        logger.error(f"Unexpected error when checking task status: {str(e)}")
+        return web.json_response({"error": f"Internal server error: {str(e)}"}, status=500)
+
+
+async def batch_task_status(request: web.Request) -> web.Response:
+    """
+    批量查询任务状态：请求体 {"uuids": [...], "timeout": 10}
+    """
+    started = time.time()
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    uuids, timeout, error = parse_batch_request(payload)
+    if error:
+        return web.json_response({"error": error}, status=400)
+
+    results, errors, counts = await task_status.get_many(uuids, timeout)
+    return web.json_response(batch_response(results, errors, counts, started))
+
+
+async def task_events(request: web.Request) -> web.StreamResponse:
+    """
+    任务进度事件流 (SSE)：订阅订阅中心的状态增量（同一任务的所有连接、WebSocket 和长轮询共用一个监视协程），
+    状态/进度变化时推送，完成后推送图片URL并关闭
+    """
+    uuid = request.match_info['uuid']
+    response = web.StreamResponse(headers={**SSE_HEADERS, 'Content-Type': 'text/event-stream'})
+    await response.prepare(request)
+    await response.write(f"retry: {SSE_RETRY_MS}\n\n".encode())
+
+    deadline = time.time() + SSE_MAX_SECONDS
+    queue = asyncio.Queue()
+    subscription_hub.subscribe(queue, uuid)
+    state: Dict[str, Any] = {}
+    event_id = 0
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                delta = await asyncio.wait_for(queue.get(), min(SSE_HEARTBEAT_SECONDS, remaining))
+            except asyncio.TimeoutError:
+                await response.write(b": keep-alive\n\n")
+                continue
+
+            state.update(delta)
+            status = state.get('s', 'pending')
+            event_id += 1
+            if status == 'error':
+                # 上游拒绝了该任务（如 UUID 不存在）
+                await response.write(format_sse('task_error', {"uuid": uuid, "error": state.get('e')}, event_id).encode())
+                return response
+            if status == 'timeout':
+                break
+
+            task_data = {"taskStatus": status, "progress": state.get('p', 0)}
+            if status in ('completed', 'failed'):
+                # 终态结果已写入结果缓存，这里不会再访问上游
+                result = await task_status.get(uuid, timeout=15)
+                task_data = result.get('data', {}).get('task', {}) or task_data
+            event, data = task_event(uuid, status, task_data.get('progress', 0), task_data, task_data.get('errorMessage'))
+            await response.write(format_sse(event, data, event_id).encode())
+            if event in ('completed', 'failed'):
+                return response
+    except UPSTREAM_ERRORS as e:
+        await response.write(format_sse('task_error', {"uuid": uuid, "error": str(e)}, event_id + 1).encode())
+        return response
+    finally:
+        subscription_hub.unsubscribe(queue, uuid)
+
+    await response.write(format_sse('timeout', {"uuid": uuid, "message": f"No result after {SSE_MAX_SECONDS} seconds"}).encode())
+    return response
+
+
+async def _ws_sender(ws: web.WebSocketResponse, queue: asyncio.Queue, subscribed: set):
+    """把短时间内的多条增量合并成一帧发送"""
+    while True:
+        batch = [await queue.get()]
+        await asyncio.sleep(WS_FLUSH_INTERVAL)
+        while not queue.empty():
+            batch.append(queue.get_nowait())
+        for delta in batch:
+            if delta.get('s') in WS_FINAL_STATUSES:
+                subscribed.discard(delta['t'])
+        await ws.send_json({"op": "delta", "d": batch})
+
+
+async def tasks_ws(request: web.Request) -> web.WebSocketResponse:
+    """
+    多任务订阅 WebSocket，一个连接跟踪任意多个任务：
+    客户端发送 {"op": "subscribe" | "unsubscribe", "tasks": [uuid, ...]} 或 {"op": "ping"}，
+    服务端推送 {"op": "delta", "d": [{"t": uuid, "s": 状态, "p": 进度, "u": [图片URL]}, ...]}，
+    任务结束（completed / failed / error / timeout）后自动取消订阅
+    """
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+
+    queue = asyncio.Queue()
+    subscribed = set()
+    sender = asyncio.ensure_future(_ws_sender(ws, queue, subscribed))
+
+    try:
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            try:
+                message = msg.json()
+            except ValueError:
+                await ws.send_json({"op": "error", "error": "Invalid JSON"})
+                continue
+
+            op = message.get('op') if isinstance(message, dict) else None
+            tasks = message.get('tasks', []) if isinstance(message, dict) else []
+            if not isinstance(tasks, list):
+                await ws.send_json({"op": "error", "error": "tasks must be a list of task UUIDs"})
+                continue
+
+            if op == 'subscribe':
+                accepted, rejected = [], []
+                for uuid in tasks:
+                    if not isinstance(uuid, str) or not uuid or uuid in subscribed:
+                        continue
+                    if len(subscribed) >= WS_MAX_SUBSCRIPTIONS:
+                        rejected.append(uuid)
+                        continue
+                    subscribed.add(uuid)
+                    subscription_hub.subscribe(queue, uuid)
+                    accepted.append(uuid)
+                reply = {"op": "subscribed", "tasks": accepted, "count": len(subscribed)}
+                if rejected:
+                    reply["rejected"] = rejected
+                    reply["error"] = f"Max {WS_MAX_SUBSCRIPTIONS} subscriptions per connection"
+                await ws.send_json(reply)
+
+            elif op == 'unsubscribe':
+                for uuid in tasks:
+                    if uuid in subscribed:
+                        subscribed.discard(uuid)
+                        subscription_hub.unsubscribe(queue, uuid)
+                await ws.send_json({"op": "unsubscribed", "tasks": tasks, "count": len(subscribed)})
+
+            elif op == 'ping':
+                await ws.send_json({"op": "pong", "count": len(subscribed)})
+
+            else:
+                await ws.send_json({"op": "error", "error": f"Unknown op: {op}"})
+    finally:
+        sender.cancel()
+        for uuid in subscribed:
+            subscription_hub.unsubscribe(queue, uuid)
+
+    return ws
+
+
+async def get_image_results(request: web.Request) -> web.Response:
+    """
+    Get completed image URLs for a task (polls until completion)
+    """
+    uuid = request.match_info['uuid']
+
+    # 检查 UUID 是否为空或无效
+    if not uuid or uuid.lower() == 'null' or uuid == 'None':
+        return web.json_response({
+            "error": "Invalid task UUID",
+            "message": "UUID cannot be null or empty"
+        }, status=400)
+
+    try:
+        # 经订阅中心等待任务结束（与 SSE / WebSocket 共用一个监视协程），不自己轮询
+        await subscription_hub.wait_for_change(uuid, IMAGE_RESULTS_WAIT)
+        result = await task_status.get(uuid, timeout=30)
+
+        task_data = result.get('data', {}).get('task', {})
+        status = task_data.get('taskStatus') if result.get('success') else None
+
+        if status == 'completed':
+            image_urls = extract_images(task_data)
+            logger.info(f"Task {uuid} completed with {len(image_urls)} images")
+
+            return web.json_response({
+                "uuid": uuid,
+                "status": "completed",
+                "image_urls": image_urls,
+                "task_info": task_data
+            })
+
+        # If task failed
+        if status == 'failed':
+            logger.error(f"Task {uuid} failed")
+            return web.json_response({
+                "uuid": uuid,
+                "status": "failed",
+                "error": "Task failed to complete"
+            }, status=500)
+
+        # Timeout reached
+        logger.error(f"Task {uuid} timed out after {IMAGE_RESULTS_WAIT} seconds")
+        return web.json_response({
+            "uuid": uuid,
+            "status": "timeout",
+            "error": "Task took too long to complete"
+        }, status=408)
+
+    except UPSTREAM_ERRORS as e:
+        logger.error(f"Network error when polling for images: {str(e)}")
+        return web.json_response({"error": f"Network error: {str(e)}"}, status=500)
+    except Exception as e:
+        logger.error(f"Unexpected error when polling for images: {str(e)}")
+        return web.json_response({"error": f"Internal server error: {str(e)}"}, status=500)
+
+
+async def fast_generate(request: web.Request) -> web.Response:
+    """
+    极速生成端点：最小参数，最快速度
+    """
+    try:
+        data = await request.json()
+        prompt = data.get('prompt')
+
+        if not prompt:
+            return web.json_response({"error": "Prompt is required"}, status=400)
+        wait = parse_deadline(data.get('timeout'))
+
+        # 极速参数
+        fast_payload = {
+            "prompt": prompt,
+            "negative_prompt": "",
+            "model": "turbo",
+            "batch_size": 1,
+            "width": 512,
+            "height": 512,
+            "steps": 4,
+            "cfg_scale": 5
+        }
+
+        # 与 Flask 版本相同的提交流程：结果缓存、进行中任务去重（相同提示词正在生成时等同一个任务）、准入排队、微批
+        cache_mode = request_cache_mode(request.headers)
+        submission = await submit_generation_async(fast_payload, get_client_ip(request), cache_mode)
+        if submission.upstream_error:
+            return web.json_response({"error": submission.upstream_error}, status=500)
+        if not submission.ok:
+            return web.json_response(submission.body, status=submission.status_code, headers=submission.headers)
+        uuid = submission.uuid
+
+        # 相同提示词已生成过：直接返回图片
+        if submission.cached:
+            task_data = (await cached_result(uuid) or {}).get('data', {}).get('task', {})
+            return web.json_response({
+                "uuid": uuid,
+                "status": "completed",
+                "image_urls": extract_images(task_data),
+                "fast_mode": True,
+                "cached": True
+            }, headers={CACHE_HEADER: cache_status(cache_mode, True)})
+
+        # 等待订阅中心的完成通知（与其他订阅者共用一个监视协程），完成后立即返回；
+        # 超过客户端给定的等待时间（请求体 timeout，默认 10 秒）则返回任务 UUID 由客户端继续查询
+        await subscription_hub.wait_for_change(uuid, wait)
+        task_data = (await task_status.get(uuid, timeout=5)).get('data', {}).get('task', {})
+        if task_data.get('taskStatus') == 'completed':
+            return web.json_response({
+                "uuid": uuid,
+                "status": "completed",
+                "image_urls": extract_images(task_data),
+                "fast_mode": True
+            })
+        if task_data.get('taskStatus') == 'failed':
+            return web.json_response({"uuid": uuid, "status": "failed", "error": "Task failed to complete"}, status=500)
+
+        return web.json_response({"uuid": uuid, "status": "processing", "message": "Check back in 2-3 seconds"})
+
+    except Exception as e:
+        return web.json_response({"error": str(e)}, status=500)
+
+
+async def images_generations(request: web.Request) -> web.StreamResponse:
+    """
+    OpenAI Images API 兼容端点：提交后等待订阅中心的完成通知，返回图片 URL 或 base64
+    """
+    client_ip = get_client_ip(request)
+    task_uuid = None
+    start_time = time.time()
+
+    try:
+        allowed, limit_message = await run_blocking(check_rate_limit, client_ip)
+        if not allowed:
+            logger.warning(f"Rate limit exceeded for IP {client_ip}: {limit_message}")
+            return web.json_response({
+                "error": "Rate limit exceeded",
+                "message": limit_message,
+                "retry_after": RATE_LIMIT_WINDOW
+            }, status=429)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.json_response({"error": "Invalid JSON in request body"}, status=400)
+        zimage_payload, error = images_payload(data)
+        if error:
+            return web.json_response({"error": error}, status=400)
+        model = data.get('model', 'zimage-turbo')
+        wait = parse_deadline(data.get('timeout'), IMAGES_WAIT)
+
+        # 与 chat completions 相同的提交流程：结果缓存、进行中任务去重、准入排队、微批
+        cache_mode = request_cache_mode(request.headers)
+        submission = await submit_generation_async(zimage_payload, client_ip, cache_mode)
+        if not submission.ok:
+            if submission.upstream_error:
+                await run_blocking(log_usage, client_ip, zimage_payload['prompt'], None, model, zimage_payload,
+                                   False, submission.upstream_error)
+            return web.json_response(submission.body, status=submission.status_code, headers=submission.headers)
+        task_uuid = submission.uuid
+        cached = submission.cached
+
+        await run_blocking(log_usage, client_ip, zimage_payload['prompt'], task_uuid, model, zimage_payload, True)
+
+        task_data = (await task_status.get(task_uuid, timeout=5)).get('data', {}).get('task', {})
+        if task_data.get('taskStatus') not in ('completed', 'failed'):
+            await subscription_hub.wait_for_change(task_uuid, wait)
+            task_data = (await task_status.get(task_uuid, timeout=5)).get('data', {}).get('task', {})
+        if task_data.get('taskStatus') == 'failed':
+            return web.json_response({"uuid": task_uuid, "error": task_data.get('errorMessage') or "Task failed to complete"},
+                                     status=500)
+        if task_data.get('taskStatus') != 'completed':
+            return web.json_response(processing_response(task_uuid), status=202)
+
+        headers = {CACHE_HEADER: cache_status(cache_mode, cached)} if generation_cache.enabled else {}
+        created = int(time.time())
+        if data.get('response_format') == 'b64_json':
+            response = await stream_b64_images(request, created, extract_images(task_data), headers)
+        else:
+            response = web.json_response(url_response(created, extract_images(task_data)), headers=headers)
+        logger.info(f"[{client_ip}] Images for {task_uuid} returned (took {time.time() - start_time:.2f}s)")
+        return response
+
+    except UPSTREAM_ERRORS as e:
+        error_msg = f"Network error: {str(e)}"
+        logger.error(f"[{client_ip}] {error_msg}")
+        return web.json_response({"error": error_msg}, status=502 if task_uuid else 500)
+    except Exception as e:
+        error_msg = f"Internal server error: {str(e)}"
+        logger.error(f"[{client_ip}] Unexpected error: {str(e)}")
+        return web.json_response({"error": error_msg}, status=500)
+
+
+async def stream_b64_images(request: web.Request, created: int, image_urls: list,
+                            headers: Dict[str, str]) -> web.StreamResponse:
+    """
+    b64_json 响应：先打开所有图片连接（失败时还能返回 502），
+    再逐块读取、编码、写出，内存中只保留当前一块
+    """
+    timeout = aiohttp.ClientTimeout(sock_connect=IMAGE_FETCH_TIMEOUT, sock_read=IMAGE_FETCH_TIMEOUT)
+    images = []
+    try:
+        for url in image_urls:
+            image = await upstream.session.get(url, timeout=timeout)
+            images.append(image)
+            image.raise_for_status()
+
+        response = web.StreamResponse(headers={**headers, 'Content-Type': 'application/json'})
+        await response.prepare(request)
+        await response.write(b64_json_head(created))
+        for index, image in enumerate(images):
+            await response.write(b64_item_start(index))
+            encoder = Base64Stream()
+            async for chunk in image.content.iter_chunked(B64_CHUNK_SIZE):
+                encoded = encoder.feed(chunk)
+                if encoded:
+                    await response.write(encoded)
+            await response.write(encoder.flush() + B64_ITEM_END)
+            image.release()
+        await response.write(B64_JSON_TAIL)
+        await response.write_eof()
+        return response
+    finally:
+        for image in images:
+            image.release()
+
+
+async def create_batch(request: web.Request) -> web.StreamResponse:
+    """
+    批量生成作业：请求体为 NDJSON（每行一组参数），边读边提交，
+    响应为 NDJSON 结果流（任务结束一条输出一条），最后一行是作业汇总
+    """
+    client_ip = get_client_ip(request)
+    # 只检查是否还有额度，不计数：每一行提交时再各自计入频率限制
+    allowed, limit_message = await run_blocking(peek_rate_limit, client_ip)
+    if not allowed:
+        logger.warning(f"Rate limit exceeded for IP {client_ip}: {limit_message}")
+        return web.json_response({
+            "error": "Rate limit exceeded",
+            "message": limit_message,
+            "retry_after": RATE_LIMIT_WINDOW
+        }, status=429)
+
+    job = batch_store.create()
+    if job is None:
+        return web.json_response({"error": "Too many batches in progress, please retry later"}, status=503)
+
+    # 逐行读取请求体，不把整个请求体读进内存；解析出的参数立即交给作业的工作协程
+    runner = AsyncBatchRunner(job, client_ip=client_ip)
+    try:
+        async for line in request.content:
+            if not runner.add(line):
+                logger.warning(f"Batch {job.id} reached the item limit, remaining lines ignored")
+                break
+    finally:
+        runner.close()
+    logger.info(f"Batch {job.id} accepted {job.total} items")
+
+    return await stream_batch_results(request, job, 0, {'Location': f"/v1/batches/{job.id}"})
+
+
+async def create_sweep(request: web.Request) -> web.StreamResponse:
+    """
+    参数扫描：一个提示词 × 参数网格的笛卡尔积并发生成（并发数受 concurrency 限制），
+    响应为 NDJSON 结果流（每行带格子参数），最后一行的 grid 是按格子顺序的完整网格；
+    作业 ID 与批量作业共用，可用 /v1/batches/<batch_id> 续传
+    """
+    client_ip = get_client_ip(request)
+    # 只检查是否还有额度，不计数：每个格子提交时再各自计入频率限制
+    allowed, limit_message = await run_blocking(peek_rate_limit, client_ip)
+    if not allowed:
+        logger.warning(f"Rate limit exceeded for IP {client_ip}: {limit_message}")
+        return web.json_response({
+            "error": "Rate limit exceeded",
+            "message": limit_message,
+            "retry_after": RATE_LIMIT_WINDOW
+        }, status=429)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.json_response({"error": "Invalid JSON in request body"}, status=400)
+    cells, error = expand_sweep(data)
+    if error:
+        return web.json_response({"error": error}, status=400)
+    job = batch_store.create()
+    if job is None:
+        return web.json_response({"error": "Too many batches in progress, please retry later"}, status=503)
+
+    job.cells = [params for params, _ in cells]
+    runner = AsyncBatchRunner(job, concurrency=sweep_concurrency(data.get('concurrency')), client_ip=client_ip)
+    for _, payload in cells:
+        runner.add_item(None, payload)
+    runner.close()
+    logger.info(f"Sweep {job.id} started with {len(cells)} combinations")
+
+    return await stream_batch_results(request, job, 0, {'Location': f"/v1/batches/{job.id}"})
+
+
+async def batch_results(request: web.Request) -> web.StreamResponse:
+    """
+    续传批量作业的结果：?after=<最后收到的 seq>，作业未结束时继续跟随新结果
+    """
+    job = batch_store.get(request.match_info['batch_id'])
+    if job is None:
+        return web.json_response({"error": "Batch not found or expired"}, status=404)
+    return await stream_batch_results(request, job, parse_after(request.query.get('after')), {})
+
+
+async def stream_batch_results(request: web.Request, job: BatchJob, after: int,
+                               headers: Dict[str, str]) -> web.StreamResponse:
+    """zimage_batches.batch_result_lines 的协程版本：作业有新结果时由回调唤醒"""
+    response = web.StreamResponse(headers={**headers, BATCH_ID_HEADER: job.id,
+                                           'Content-Type': NDJSON_MIMETYPE})
+    await response.prepare(request)
+    changed = asyncio.Event()
+    job.add_listener(changed.set)
+    try:
+        while True:
+            changed.clear()
+            results, done = job.results_after(after)
+            for result in results:
+                await response.write((json.dumps(result, ensure_ascii=False) + '\n').encode())
+                after = result['seq']
+            if done and not results:
+                await response.write((json.dumps(job.summary(), ensure_ascii=False) + '\n').encode())
+                break
+            if not results:
+                await changed.wait()
+    finally:
+        job.remove_listener(changed.set)
+    await response.write_eof()
+    return response
+
+
+async def queue_status(request: web.Request) -> web.Response:
+    """
+    准入队列：上游生成中的任务数、排队数和新请求的预计等待
+    """
+    return web.json_response(admission.queue_status())
+
+
+async def health_check(request: web.Request) -> web.Response:
+    """
+    Health check endpoint
+    """
+    return web.json_response({
+        "status": "healthy",
+        "service": "zimage-proxy-async",
+        "timestamp": int(time.time()),
+        "upstream": upstream.stats(),
+        "task_status": task_status.stats(),
+        "subscriptions": subscription_hub.stats(),
+        "long_poll": long_poll_limiter.stats(),
+        "webhooks": webhooks.stats(),
+        "result_cache": result_cache.stats(),
+        "generation_cache": generation_cache.stats(),
+        "dedup": submission_dedup.stats(),
+        "microbatch": micro_batcher.stats(),
+        "admission": admission.stats(),
+        "batches": batch_store.stats(),
+        "journal": task_journal.stats(),
+        "schedule": completion_history.stats()
+    })
+
+
+API_ENDPOINTS = {
+    "chat_completions": "/v1/chat/completions (POST)",
+    "task_status": "/v1/tasks/<uuid> (GET)",
+    "task_events": "/v1/tasks/<uuid>/events (GET, SSE)",
+    "task_batch": "/v1/tasks:batch (POST)",
+    "task_subscriptions": "/v1/ws/tasks (WebSocket)",
+    "image_results": "/v1/images/<uuid> (GET)",
+    "image_generations": "/v1/images/generations (POST, OpenAI Images API)",
+    "batches": "/v1/batches (POST, NDJSON)",
+    "sweeps": "/v1/sweeps (POST, NDJSON)",
+    "fast_generate": "/v1/fast-generate (POST)",
+    "health": "/health (GET)",
+    "api_info": "/api",
+    "web_interface": "/"
+}
+
+
+async def index(request: web.Request) -> web.StreamResponse:
+    """
+    Root endpoint - serve optimized web interface
+    """
+    index_path = os.path.join(WEB_DIR, 'index_optimized.html')
+    if os.path.exists(index_path):
+        return web.FileResponse(index_path)
+
+    # Fallback to API info if optimized frontend not found
+    return web.json_response({
+        "service": "Z-Image Proxy Server (asyncio)",
+        "version": "1.0.0",
+        "description": "OpenAI-compatible proxy for Z-Image generation API",
+        "endpoints": API_ENDPOINTS,
+        "usage": "Send OpenAI-compatible chat completion requests to /v1/chat/completions"
+    })
+
+
+async def api_info(request: web.Request) -> web.Response:
+    """
+    API information endpoint
+    """
+    return web.json_response({
+        "service": "Z-Image Proxy Server (asyncio)",
+        "version": "1.0.0",
+        "description": "OpenAI-compatible proxy for Z-Image generation API",
+        "endpoints": API_ENDPOINTS,
+        "presets": {
+            "fast": {"batch_size": 1, "width": 512, "height": 512, "steps": 4, "time": "2-3s"},
+            "balanced": {"batch_size": 2, "width": 768, "height": 768, "steps": 6, "time": "4-6s"},
+            "quality": {"batch_size": 4, "width": 1024, "height": 1024, "steps": 8, "time": "8-12s"}
+        }
+    })
+
+
+def query_int(request: web.Request, name: str, default: int) -> int:
+    """读取整数查询参数，格式错误时使用默认值（与 Flask 的 type=int 行为一致）"""
+    try:
+        return int(request.query.get(name, default))
+    except ValueError:
+        return default
+
+
+async def admin_stats(request: web.Request) -> web.Response:
+    """
+    管理员统计接口 - 获取详细的使用统计
+    """
+    try:
+        stats = await run_blocking(get_usage_stats)
+
+        client_ip = get_client_ip(request)
+        stats['current_user'] = {"ip": client_ip, **(await run_blocking(get_rate_limit_status, client_ip))}
+        stats['system'] = {
+            **(await run_blocking(get_system_stats)),
+            "rate_limits_enabled": True
+        }
+
+        return web.json_response(stats)
+
+    except Exception as e:
+        logger.error(f"Error getting admin stats: {str(e)}")
+        return web.json_response({"error": "Failed to get statistics"}, status=500)
+
+
+async def admin_logs(request: web.Request) -> web.Response:
+    """
+    管理员日志接口 - 获取最近的请求日志
+    """
+    try:
+        limit = query_int(request, 'limit', 50)
+        offset = query_int(request, 'offset', 0)
+        success_only = request.query.get('success_only', 'false').lower() == 'true'
+
+        # 验证参数
+        if limit > 1000:
+            limit = 1000
+        if limit < 1:
+            limit = 50
+
+        result = await run_blocking(get_usage_logs, limit, offset, success_only)
+        result["filters"] = {
+            "success_only": success_only
+        }
+
+        return web.json_response(result)
+
+    except Exception as e:
+        logger.error(f"Error getting admin logs: {str(e)}")
+        return web.json_response({"error": "Failed to get logs"}, status=500)
+
+
+async def admin_prompts(request: web.Request) -> web.Response:
+    """
+    管理员提示词分析接口 - 获取热门提示词统计
+    """
+    try:
+        min_count = query_int(request, 'min_count', 1)
+        limit = query_int(request, 'limit', 20)
+
+        result = await run_blocking(get_prompt_stats, min_count, limit)
+        result["filters"] = {
+            "min_count": min_count,
+            "limit": limit
+        }
+
+        return web.json_response(result)
+
+    except Exception as e:
+        logger.error(f"Error getting prompt stats: {str(e)}")
+        return web.json_response({"error": "Failed to get prompt statistics"}, status=500)
+
+
+async def admin_upstream(request: web.Request) -> web.Response:
+    """
+    管理员上游连接池接口
+    """
+    return web.json_response(upstream.stats())
+
+
+async def admin_results(request: web.Request) -> web.Response:
+    """
+    管理员终态结果缓存接口 - GET 查看统计和最近条目（?uuid= 查看单个任务的完整结果），
+    DELETE 清空缓存（?uuid= 只移除单个任务）
+    """
+    uuid = request.query.get('uuid')
+    if request.method == 'DELETE':
+        if uuid:
+            return web.json_response({"uuid": uuid, "removed": result_cache.remove(uuid)})
+        return web.json_response({"removed": result_cache.clear()})
+
+    if uuid:
+        result = await cached_result(uuid)
+        if result is None:
+            return web.json_response({"error": "Task not in result cache", "uuid": uuid}, status=404)
+        return web.json_response({"uuid": uuid, "result": result})
+
+    return web.json_response({
+        "stats": result_cache.stats(),
+        "entries": result_cache.entries(query_int(request, 'limit', 50))
+    })
+
+
+async def admin_clear_cache(request: web.Request) -> web.Response:
+    """
+    管理员清理缓存接口 - 清理旧的统计数据
+    """
+    try:
+        days = query_int(request, 'days', 7)
+        result = await run_blocking(clear_old_usage, days)
+
+        return web.json_response({
+            "message": "Cache cleared successfully",
+            "removed_logs": result["removed_logs"],
+            "remaining_logs": result["remaining_logs"],
+            "cutoff_days": days
+        })
+
+    except Exception as e:
+        logger.error(f"Error clearing cache: {str(e)}")
+        return web.json_response({"error": "Failed to clear cache"}, status=500)
+
+
+async def recover_journal(app: web.Application):
+    """
+    启动时从任务日志恢复未结束任务的完成回调；
+    本版本没有常驻轮询，其他未结束任务在被查询时按需跟踪
+    """
+    tasks = task_journal.in_flight()
+    for task in tasks:
+        completion_history.register(task['uuid'], task['params'], task['submitted_at'])
+        if task['callback_url']:
+            webhooks.register(task['uuid'], task['callback_url'], task['params'], submitted_at=task['submitted_at'])
+    if tasks:
+        logger.info(f"Recovered {len(tasks)} in-flight tasks from journal {task_journal.path}")
+
+
+async def close_journal(app: web.Application):
+    task_journal.flush()
+
+
+def create_app() -> web.Application:
+    """创建 aiohttp 应用"""
+    app = web.Application(middlewares=[cors_middleware])
+    app.on_response_prepare.append(add_cors_headers)
+    app.on_startup.append(upstream.start)
+    app.on_cleanup.append(upstream.close)
+    app.on_startup.append(recover_journal)
+    app.on_cleanup.append(webhooks.close)
+    app.on_cleanup.append(close_journal)
+
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    app.router.add_post('/v1/tasks:batch', batch_task_status)
+    app.router.add_get('/v1/tasks/{uuid}', get_task_status)
+    app.router.add_get('/v1/tasks/{uuid}/events', task_events)
+    app.router.add_get('/v1/ws/tasks', tasks_ws)
+    app.router.add_get('/v1/images/{uuid}', get_image_results)
+    app.router.add_post('/v1/images/generations', images_generations)
+    app.router.add_post('/v1/batches', create_batch)
+    app.router.add_get('/v1/batches/{batch_id}', batch_results)
+    app.router.add_post('/v1/sweeps', create_sweep)
+    app.router.add_post('/v1/fast-generate', fast_generate)
+    app.router.add_get('/v1/queue', queue_status)
+    app.router.add_get('/health', health_check)
+    app.router.add_get('/api', api_info)
+    app.router.add_get('/admin/stats', admin_stats)
+    app.router.add_get('/admin/logs', admin_logs)
+    app.router.add_get('/admin/prompts', admin_prompts)
+    app.router.add_get('/admin/upstream', admin_upstream)
+    app.router.add_get('/admin/results', admin_results)
+    app.router.add_delete('/admin/results', admin_results)
+    app.router.add_post('/admin/clear-cache', admin_clear_cache)
+    app.router.add_get('/', index)
+
+    # 前端静态文件
+    if os.path.isdir(WEB_DIR):
+        app.router.add_static('/', WEB_DIR)
+
+    return app
+
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 8004))
+    logger.info(f"Starting asyncio Z-Image Proxy Server on port {port}")
+    logger.info(f"Rate limits: {RATE_LIMIT_REQUESTS} requests per {RATE_LIMIT_WINDOW}s, {DAILY_REQUEST_LIMIT} per day")
+    web.run_app(create_app(), host='0.0.0.0', port=port)
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import requests
 import time
@@ -6,26 +6,38 @@ import logging
 import asyncio
 import threading
 from typing import Dict, Any, Optional
-from concurrent.futures import ThreadPoolExecutor
 import queue
 
+from zimage_upstream import upstream
+from zimage_poller import task_poller
+from zimage_results import result_cache
+from zimage_journal import task_journal, recover_in_flight_tasks
+from zimage_registry import task_registry
+from zimage_webhooks import webhooks, validate_callback_url
+from zimage_gencache import CACHE_HEADER, generation_cache, request_cache_mode, cache_status
+from zimage_dedup import submission_dedup
+from zimage_batcher import micro_batcher
+from zimage_admission import admission
+from zimage_submit import submit_generation
+from zimage_batches import (
+    BATCH_ID_HEADER, NDJSON_MIMETYPE, BatchRunner, batch_result_lines, batch_store, parse_after
+)
+from zimage_presets import PRESETS
+from zimage_sweeps import expand_sweep, sweep_concurrency
+from zimage_images import IMAGES_WAIT, b64_json_body, images_payload, open_images, processing_response, url_response
+from zimage_coalesce import task_status, handle_batch_request
+from zimage_events import (
+    SSE_HEADERS, chat_completion_stream, extract_image_urls, parse_deadline, parse_last_event_id, task_event_stream,
+    parse_wait, long_poll_task, long_poll_limiter, long_poll_rejected_response
+)
+
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=[CACHE_HEADER, BATCH_ID_HEADER])
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Z-Image API endpoints
-ZIMAGE_GENERATE = "https://zimage.run/api/z-image/generate"
-ZIMAGE_TASK = "https://zimage.run/api/z-image/task"
-
-# Thread pool for concurrent requests
-executor = ThreadPoolExecutor(max_workers=10)
-
-# Cache for task results
-task_cache = {}
-cache_lock = threading.Lock()
 
 @app.route('/v1/chat/completions', methods=['POST'])
 def chat_completions():
@@ -37,38 +49,17 @@ def chat_completions():
 
         # 提取预设模式
         preset = data.get('preset', 'balanced')  # fast, balanced, quality
-        custom_params = data.get('extra_body', {})
-
-        # 根据预设设置参数
-        preset_configs = {
-            'fast': {
-                'batch_size': 1,
-                'width': 512,
-                'height': 512,
-                'steps': 4,
-                'cfg_scale': 5,
-                'negative_prompt': ''
-            },
-            'balanced': {
-                'batch_size': 2,
-                'width': 768,
-                'height': 768,
-                'steps': 6,
-                'cfg_scale': 7,
-                'negative_prompt': 'low quality, blurry'
-            },
-            'quality': {
-                'batch_size': 4,
-                'width': 1024,
-                'height': 1024,
-                'steps': 8,
-                'cfg_scale': 8,
-                'negative_prompt': 'low quality, blurry, deformed'
-            }
-        }
+        custom_params = dict(data.get('extra_body', {}))
+
+        # 可选的完成回调地址，不属于生成参数
+        callback_url = custom_params.pop('callback_url', None)
+        if callback_url is not None:
+            callback_error = validate_callback_url(callback_url)
+            if callback_error:
+                return jsonify({"error": callback_error}), 400
 
         # 合并预设和自定义参数
-        config = preset_configs.get(preset, preset_configs['balanced'])
+        config = dict(PRESETS.get(preset, PRESETS['balanced']))
         config.update(custom_params)
 
         # 提取prompt
@@ -92,30 +83,31 @@ def chat_completions():
             "cfg_scale": config.get('cfg_scale', 6)
         }
 
-        logger.info(f"Fast submit with preset '{preset}': {zimage_payload}")
-
-        # 提交到Z-Image
-        response = requests.post(ZIMAGE_GENERATE, json=zimage_payload, timeout=30)
-        response.raise_for_status()
-
-        result = response.json()
-        if not result.get('success'):
-            error_msg = result.get('error', 'Unknown error from Z-Image')
-            logger.error(f"Z-Image API error: {error_msg}")
-            return jsonify({"error": error_msg}), response.status_code
-
-        uuid = result['data']['uuid']
-
-        # 缓存任务信息
-        with cache_lock:
-            task_cache[uuid] = {
-                'created_at': time.time(),
-                'status': 'pending',
-                'preset': preset
-            }
+        # 结果缓存 → 进行中任务去重 → 准入排队 → 微批提交；缓存命中不占用登记表容量
+        client_ip = request.headers.get('X-Forwarded-For', request.remote_addr or '').split(',')[0].strip()
+        cache_mode = request_cache_mode(request.headers)
+        logger.info(f"Chat completion with preset '{preset}': {zimage_payload}")
+        submission = submit_generation(zimage_payload, client_ip, cache_mode, callback_url=callback_url,
+                                       register=True, tag=preset)
+        if not submission.ok:
+            return jsonify(submission.body), submission.status_code, submission.headers
+        uuid = submission.uuid
+        cached = submission.cached
+
+        if callback_url:
+            webhooks.register(uuid, callback_url, zimage_payload)
+
+        if data.get('stream'):
+            # 流式响应：同一个连接内推送进度，最后一块是图片，客户端不必再轮询
+            extra = {"cached": cached, "deduplicated": submission.deduplicated, "queue": submission.queue}
+            response = Response(chat_completion_stream(uuid, data.get('model', 'zimage-turbo'), extra),
+                                mimetype='text/event-stream', headers=SSE_HEADERS)
+            if generation_cache.enabled:
+                response.headers[CACHE_HEADER] = cache_status(cache_mode, cached)
+            return response
 
         # 返回优化的响应
-        return jsonify({
+        response = jsonify({
             "id": f"chatcmpl-{uuid}",
             "object": "chat.completion",
             "created": int(time.time()),
@@ -127,61 +119,182 @@ def chat_completions():
                     "content": uuid,
                     "task_uuid": uuid,
                     "preset": preset,
-                    "estimated_time": f"{2 + config.get('batch_size', 1) * config.get('steps', 4) // 2}s"
+                    "estimated_time": "0s" if cached else f"{2 + config.get('batch_size', 1) * config.get('steps', 4) // 2}s"
                 },
                 "finish_reason": "stop"
             }],
-            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            "cached": cached,  # 复用了参数相同的已完成任务
+            "deduplicated": submission.deduplicated,  # 挂到了参数相同、正在生成的任务上
+            "queue": submission.queue  # 等待上游生成名额的排队情况
         })
+        if generation_cache.enabled:
+            response.headers[CACHE_HEADER] = cache_status(cache_mode, cached)
+        return response
 
     except Exception as e:
         logger.error(f"Error in chat_completions: {str(e)}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
+@app.route('/v1/images/generations', methods=['POST'])
+def images_generations():
+    """
+    OpenAI Images API 兼容端点：提交后等待集中式轮询器的完成通知，返回图片 URL 或 base64
+    """
+    uuid = None
+    try:
+        data = request.get_json(silent=True) or {}
+        zimage_payload, error = images_payload(data)
+        if error:
+            return jsonify({"error": error}), 400
+        wait = parse_deadline(data.get('timeout'), IMAGES_WAIT)
+
+        # 与 chat completions 相同的提交流程：结果缓存、进行中任务去重、准入排队、微批
+        client_ip = request.headers.get('X-Forwarded-For', request.remote_addr or '').split(',')[0].strip()
+        cache_mode = request_cache_mode(request.headers)
+        submission = submit_generation(zimage_payload, client_ip, cache_mode, register=True, tag='images')
+        if not submission.ok:
+            return jsonify(submission.body), submission.status_code, submission.headers
+        uuid = submission.uuid
+        cached = submission.cached
+
+        snapshot = task_poller.wait_for_completion(uuid, timeout=wait)
+        if snapshot['status'] == 'failed':
+            return jsonify({"uuid": uuid, "error": snapshot.get('error') or "Task failed to complete"}), 500
+        if snapshot['status'] != 'completed':
+            return jsonify(processing_response(uuid)), 202
+
+        image_urls = extract_image_urls(snapshot['task'])
+        created = int(time.time())
+        if data.get('response_format') == 'b64_json':
+            # 逐块读取上游图片并编码输出，不在内存中保留整张图片
+            response = Response(b64_json_body(created, open_images(image_urls)), mimetype='application/json')
+        else:
+            response = jsonify(url_response(created, image_urls))
+        if generation_cache.enabled:
+            response.headers[CACHE_HEADER] = cache_status(cache_mode, cached)
+        return response
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error in images_generations: {str(e)}")
+        return jsonify({"error": f"Network error: {str(e)}"}), 502 if uuid else 500
+    except Exception as e:
+        logger.error(f"Error in images_generations: {str(e)}")
+        return jsonify({"error": f"Internal server error: {str(e)}"}), 500
+
+@app.route('/v1/batches', methods=['POST'])
+def create_batch():
+    """
+    批量生成作业：请求体为 NDJSON（每行一组参数），边读边提交，
+    响应为 NDJSON 结果流（任务结束一条输出一条），最后一行是作业汇总
+    """
+    job = batch_store.create()
+    if job is None:
+        return jsonify({"error": "Too many batches in progress, please retry later"}), 503
+
+    # 逐行读取请求体，不把整个请求体读进内存；解析出的参数立即交给作业的工作线程
+    runner = BatchRunner(job)
+    try:
+        for line in request.stream:
+            if not runner.add(line):
+                logger.warning(f"Batch {job.id} reached the item limit, remaining lines ignored")
+                break
+    finally:
+        runner.close()
+    logger.info(f"Batch {job.id} accepted {job.total} items")
+
+    return Response(batch_result_lines(job), mimetype=NDJSON_MIMETYPE,
+                    headers={BATCH_ID_HEADER: job.id, 'Location': f"/v1/batches/{job.id}"})
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+def batch_results(batch_id: str):
+    """
+    续传批量作业的结果：?after=<最后收到的 seq>，作业未结束时继续跟随新结果
+    """
+    job = batch_store.get(batch_id)
+    if job is None:
+        return jsonify({"error": "Batch not found or expired"}), 404
+    return Response(batch_result_lines(job, parse_after(request.args.get('after'))), mimetype=NDJSON_MIMETYPE,
+                    headers={BATCH_ID_HEADER: job.id})
+
+@app.route('/v1/sweeps', methods=['POST'])
+def create_sweep():
+    """
+    参数扫描：一个提示词 × 参数网格的笛卡尔积并发生成（并发数受 concurrency 限制），
+    响应为 NDJSON 结果流（每行带格子参数），最后一行的 grid 是按格子顺序的完整网格；
+    作业 ID 与批量作业共用，可用 /v1/batches/<batch_id> 续传
+    """
+    data = request.get_json(silent=True) or {}
+    cells, error = expand_sweep(data)
+    if error:
+        return jsonify({"error": error}), 400
+    job = batch_store.create()
+    if job is None:
+        return jsonify({"error": "Too many batches in progress, please retry later"}), 503
+
+    job.cells = [params for params, _ in cells]
+    runner = BatchRunner(job, concurrency=sweep_concurrency(data.get('concurrency')))
+    for _, payload in cells:
+        runner.add_item(None, payload)
+    runner.close()
+    logger.info(f"Sweep {job.id} started with {len(cells)} combinations")
+
+    return Response(batch_result_lines(job), mimetype=NDJSON_MIMETYPE,
+                    headers={BATCH_ID_HEADER: job.id, 'Location': f"/v1/batches/{job.id}"})
+
+@app.route('/v1/tasks:batch', methods=['POST'])
+def batch_task_status():
+    """
+    批量查询任务状态：请求体 {"uuids": [...], "timeout": 10}
+    """
+    body, status_code = handle_batch_request(request.get_json(silent=True))
+    return jsonify(body), status_code
+
 @app.route('/v1/tasks/<uuid>', methods=['GET'])
 def get_task_status(uuid: str):
     """
     优化版本：支持缓存和更快的检查
     """
     try:
-        # 先检查缓存
-        with cache_lock:
-            if uuid in task_cache:
-                cached_info = task_cache[uuid]
-                # 如果缓存时间很短，直接返回缓存状态
-                if time.time() - cached_info['created_at'] < 2:
-                    return jsonify({
-                        "uuid": uuid,
-                        "status": cached_info['status'],
-                        "cached": True
-                    })
-
-        # 调用实际API
+        # 长轮询：?wait=秒&since=状态，挂起到状态变化或超时
+        wait = parse_wait(request.args.get('wait'))
+        if wait:
+            client_ip = request.headers.get('X-Forwarded-For', request.remote_addr or '').split(',')[0].strip()
+            allowed, result = long_poll_task(uuid, client_ip, wait, request.args.get('since'))
+            if not allowed:
+                return jsonify(long_poll_rejected_response()), 429
+            if result is not None:
+                return jsonify(result)
+
+        # 先检查登记表
+        record = task_registry.get(uuid)
+        if record is not None and time.time() - record.created_at < 2:
+            # 如果任务刚创建，直接返回登记的状态
+            return jsonify({
+                "uuid": uuid,
+                "status": record.status,
+                "cached": True
+            })
+
+        # 调用实际API（并发查询合并为一次上游请求）
         try:
-            response = requests.get(f"{ZIMAGE_TASK}/{uuid}", timeout=10)
-            response.raise_for_status()
-            result = response.json()
-
-            # 更新缓存
-            with cache_lock:
-                if uuid in task_cache:
-                    task_cache[uuid].update({
-                        'status': result.get('data', {}).get('task', {}).get('taskStatus', 'unknown'),
-                        'last_checked': time.time()
-                    })
+            result = task_status.get(uuid, timeout=10)
+
+            # 更新登记表
+            task_data = result.get('data', {}).get('task', {})
+            task_registry.update(uuid, task_data.get('taskStatus', 'unknown'), task_data.get('progress'))
 
             return jsonify(result)
         except requests.exceptions.Timeout:
-            # 超时时不返回500，而是返回缓存状态
-            with cache_lock:
-                if uuid in task_cache:
-                    cached_info = task_cache[uuid]
-                    return jsonify({
-                        "uuid": uuid,
-                        "status": cached_info.get('status', 'processing'),
-                        "timeout": True,
-                        "message": "Request timed out, returning cached status"
-                    })
+            # 超时时不返回500，而是返回登记的状态
+            record = task_registry.get(uuid)
+            if record is not None:
+                return jsonify({
+                    "uuid": uuid,
+                    "status": record.status,
+                    "timeout": True,
+                    "message": "Request timed out, returning cached status"
+                })
             # 如果没有缓存，返回处理中状态
             return jsonify({
                 "uuid": uuid,
@@ -192,18 +305,25 @@ def get_task_status(uuid: str):
 
     except Exception as e:
         logger.error(f"Error checking task status: {str(e)}")
-        # 检查是否有缓存可用
-        with cache_lock:
-            if uuid in task_cache:
-                cached_info = task_cache[uuid]
-                return jsonify({
-                    "uuid": uuid,
-                    "status": cached_info.get('status', 'unknown'),
-                    "error": f"Network error: {str(e)}",
-                    "cached": True
-                })
+        # 检查是否有登记的状态可用
+        record = task_registry.get(uuid)
+        if record is not None:
+            return jsonify({
+                "uuid": uuid,
+                "status": record.status,
+                "error": f"Network error: {str(e)}",
+                "cached": True
+            })
         return jsonify({"error": f"Network error: {str(e)}"}), 500
 
+@app.route('/v1/tasks/<uuid>/events', methods=['GET'])
+def task_events(uuid):
+    """
+    任务进度事件流 (SSE)：推送状态/进度变化，完成后推送图片URL并关闭
+    """
+    since_version = parse_last_event_id(request.headers.get('Last-Event-ID'))
+    return Response(task_event_stream(uuid, since_version), mimetype='text/event-stream', headers=SSE_HEADERS)
+
 @app.route('/v1/images/<uuid>', methods=['GET'])
 def get_image_results_optimized(uuid: str):
     """
@@ -213,82 +333,56 @@ def get_image_results_optimized(uuid: str):
         return jsonify({"error": "Invalid task UUID"}), 400
 
     try:
-        max_attempts = 30  # 减少最大尝试次数
-        base_interval = 2  # 减少基础间隔时间
-        attempt = 0
-
-        while attempt < max_attempts:
-            try:
-                response = requests.get(f"{ZIMAGE_TASK}/{uuid}", timeout=10)
-                response.raise_for_status()
-            except requests.exceptions.Timeout:
-                logger.warning(f"Timeout checking task {uuid}, attempt {attempt}/{max_attempts}")
-                # 不立即失败，继续尝试
-                if attempt < max_attempts - 1:
-                    time.sleep(base_interval)
-                    attempt += 1
-                    continue
-                else:
-                    # 最后一次尝试，检查缓存
-                    with cache_lock:
-                        if uuid in task_cache and task_cache[uuid].get('status') == 'completed':
-                            logger.info(f"Returning cached completion for task {uuid}")
-                            return jsonify({
-                                "uuid": uuid,
-                                "status": "completed",
-                                "cached": True
-                            })
-                    raise
-
-            result = response.json()
-
-            if result.get('success'):
-                task_data = result.get('data', {}).get('task', {})
-                status = task_data.get('taskStatus')
-
-                if status == 'completed':
-                    result_url = task_data.get('resultUrl')
-                    image_urls = [result_url] if result_url else task_data.get('resultUrls', [])
-
-                    # 清理缓存
-                    with cache_lock:
-                        if uuid in task_cache:
-                            del task_cache[uuid]
-
-                    logger.info(f"Task {uuid} completed with {len(image_urls)} images")
-
-                    return jsonify({
-                        "success": True,
-                        "data": {
-                            "images": image_urls
-                        },
-                        "uuid": uuid,
-                        "status": "completed",
-                        "task_info": task_data,
-                        "total_time": attempt * base_interval
-                    })
-
-                elif status == 'failed':
-                    logger.error(f"Task {uuid} failed")
-                    return jsonify({
-                        "uuid": uuid,
-                        "status": "failed",
-                        "error": "Task failed to complete"
-                    }), 500
-
-            # 智能等待：前期更频繁，后期减少频率
-            if attempt < 5:
-                time.sleep(1)  # 前5次每秒检查
-            elif attempt < 15:
-                time.sleep(2)  # 中期每2秒检查
-            else:
-                time.sleep(3)  # 后期每3秒检查
-
-            attempt += 1
-            logger.info(f"Task {uuid} still processing, attempt {attempt}/{max_attempts}")
+        # 集中式轮询器负责上游查询，这里只等待完成通知
+        start_time = time.time()
+        snapshot = task_poller.wait_for_completion(uuid, timeout=70)
+        task_data = snapshot['task']
+        status = snapshot['status']
+
+        if status == 'completed':
+            result_url = task_data.get('resultUrl')
+            image_urls = [result_url] if result_url else task_data.get('resultUrls', [])
+
+            # 任务已结束，移出登记表
+            task_registry.remove(uuid)
+
+            logger.info(f"Task {uuid} completed with {len(image_urls)} images")
+
+            return jsonify({
+                "success": True,
+                "data": {
+                    "images": image_urls
+                },
+                "uuid": uuid,
+                "status": "completed",
+                "task_info": task_data,
+                "total_time": int(time.time() - start_time)
+            })
+
+        elif status == 'failed':
+            logger.error(f"Task {uuid} failed")
+            return jsonify({
+                "uuid": uuid,
+                "status": "failed",
+                "error": "Task failed to complete"
+            }), 500
+
+        # 等待超时，检查登记表
+        record = task_registry.get(uuid)
+        if record is not None and record.status == 'completed':
+            logger.info(f"Returning cached completion for task {uuid}")
+            return jsonify({
+                "uuid": uuid,
+                "status": "completed",
+                "cached": True
+            })
+
+        if snapshot['error']:
+            logger.error(f"Error polling for images: {snapshot['error']}")
+            return jsonify({"error": f"Internal server error: {snapshot['error']}"}), 500
 
         # 超时处理
-        logger.error(f"Task {uuid} timed out after {max_attempts} attempts")
+        logger.error(f"Task {uuid} timed out waiting for completion")
         return jsonify({
             "uuid": uuid,
             "status": "timeout",
@@ -310,6 +404,7 @@ def fast_generate():
 
         if not prompt:
             return jsonify({"error": "Prompt is required"}), 400
+        wait = parse_deadline(data.get('timeout'))
 
         # 极速参数
         fast_payload = {
@@ -323,42 +418,75 @@ def fast_generate():
             "cfg_scale": 5
         }
 
-        response = requests.post(ZIMAGE_GENERATE, json=fast_payload, timeout=30)
-        response.raise_for_status()
-
-        result = response.json()
-        if not result.get('success'):
-            return jsonify({"error": result.get('error', 'Generation failed')}), 500
-
-        uuid = result['data']['uuid']
+        # 与 chat completions 相同的提交流程：结果缓存、进行中任务去重（相同提示词正在生成时等同一个任务）、
+        # 准入排队、微批（窗口只有几毫秒，默认关闭）、任务日志和登记表
+        client_ip = request.headers.get('X-Forwarded-For', request.remote_addr or '').split(',')[0].strip()
+        cache_mode = request_cache_mode(request.headers)
+        submission = submit_generation(fast_payload, client_ip, cache_mode, register=True, tag='fast')
+        if submission.upstream_error:
+            return jsonify({"error": submission.upstream_error}), 500
+        if not submission.ok:
+            return jsonify(submission.body), submission.status_code, submission.headers
+        uuid = submission.uuid
+
+        # 相同提示词已生成过：直接返回图片
+        if submission.cached:
+            task_data = (generation_cache.result(uuid) or {}).get('data', {}).get('task', {})
+            response = jsonify({
+                "uuid": uuid,
+                "status": "completed",
+                "image_urls": extract_image_urls(task_data),
+                "fast_mode": True,
+                "cached": True
+            })
+            response.headers[CACHE_HEADER] = cache_status(cache_mode, True)
+            return response
 
-        # 直接等待完成（简化版本）
-        for i in range(10):  # 最多等待10秒
-            time.sleep(1)
-            status_resp = requests.get(f"{ZIMAGE_TASK}/{uuid}", timeout=5)
-            if status_resp.json().get('data', {}).get('task', {}).get('taskStatus') == 'completed':
-                task_data = status_resp.json()['data']['task']
-                result_url = task_data.get('resultUrl')
-                image_urls = [result_url] if result_url else task_data.get('resultUrls', [])
-                return jsonify({
-                    "uuid": uuid,
-                    "status": "completed",
-                    "image_urls": image_urls,
-                    "fast_mode": True
-                })
+        # 等待集中式轮询器的完成通知：极速任务的前几次查询是亚秒级的，完成后立即返回；
+        # 超过客户端给定的等待时间（请求体 timeout，默认 10 秒）则返回任务 UUID 由客户端继续查询
+        snapshot = task_poller.wait_for_completion(uuid, timeout=wait)
+        if snapshot['status'] == 'completed':
+            return jsonify({
+                "uuid": uuid,
+                "status": "completed",
+                "image_urls": extract_image_urls(snapshot['task']),
+                "fast_mode": True
+            })
+        if snapshot['status'] == 'failed':
+            return jsonify({"uuid": uuid, "status": "failed", "error": "Task failed to complete"}), 500
 
         return jsonify({"uuid": uuid, "status": "processing", "message": "Check back in 2-3 seconds"})
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/v1/queue', methods=['GET'])
+def queue_status():
+    """
+    准入队列：上游生成中的任务数、排队数和新请求的预计等待
+    """
+    return jsonify(admission.queue_status())
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({
         "status": "healthy",
         "service": "zimage-proxy-optimized",
         "version": "2.0.0",
-        "features": ["fast_presets", "smart_polling", "task_caching"]
+        "features": ["fast_presets", "smart_polling", "task_caching", "upstream_pooling", "shared_polling"],
+        "upstream": upstream.stats(),
+        "poller": task_poller.stats(),
+        "task_status": task_status.stats(),
+        "long_poll": long_poll_limiter.stats(),
+        "webhooks": webhooks.stats(),
+        "result_cache": result_cache.stats(),
+        "journal": task_journal.stats(),
+        "task_registry": task_registry.stats(),
+        "generation_cache": generation_cache.stats(),
+        "dedup": submission_dedup.stats(),
+        "microbatch": micro_batcher.stats(),
+        "admission": admission.stats(),
+        "batches": batch_store.stats()
     })
 
 @app.route('/', methods=['GET'])
@@ -371,7 +499,12 @@ def index():
             "chat_completions": "/v1/chat/completions (POST) - 支持预设模式",
             "fast_generate": "/v1/fast-generate (POST) - 极速生成",
             "task_status": "/v1/tasks/<uuid> (GET) - 任务状态（支持缓存）",
+            "task_events": "/v1/tasks/<uuid>/events (GET) - 任务进度事件流 (SSE)",
+            "task_batch": "/v1/tasks:batch (POST) - 批量查询任务状态",
             "image_results": "/v1/images/<uuid> (GET) - 智能轮询",
+            "image_generations": "/v1/images/generations (POST) - OpenAI Images API 兼容",
+            "batches": "/v1/batches (POST) - NDJSON 批量生成，/v1/batches/<batch_id> 续传",
+            "sweeps": "/v1/sweeps (POST) - 参数网格扫描",
             "health": "/health (GET)"
         },
         "presets": {
@@ -384,4 +517,8 @@ def index():
 if __name__ == '__main__':
     port = 8002
     logger.info(f"Starting Optimized Z-Image Proxy Server on port {port}")
+    upstream.warm()
+
+    # 从任务日志恢复重启前未结束的任务
+    recover_in_flight_tasks()
     app.run(host='0.0.0.0', port=port, debug=True, threaded=True)
\ No newline at end of file
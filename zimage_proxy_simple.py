@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import requests
 import time
@@ -8,20 +8,30 @@ import threading
 import os
 import re
 
+from zimage_upstream import upstream
+from zimage_poller import task_poller
+from zimage_results import result_cache
+from zimage_journal import task_journal, recover_in_flight_tasks
+from zimage_registry import task_registry
+from zimage_webhooks import webhooks, validate_callback_url
+from zimage_gencache import CACHE_HEADER, generation_cache, request_cache_mode, cache_status
+from zimage_dedup import submission_dedup
+from zimage_batcher import member_id, micro_batcher, split_member_id
+from zimage_admission import admission
+from zimage_submit import submit_generation
+from zimage_coalesce import task_status, handle_batch_request
+from zimage_events import (
+    SSE_HEADERS, chat_completion_stream, parse_last_event_id, task_event_stream,
+    parse_wait, long_poll_task, long_poll_limiter, long_poll_rejected_response
+)
+
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=[CACHE_HEADER])
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Z-Image API endpoints
-ZIMAGE_GENERATE = "https://zimage.run/api/z-image/generate"
-ZIMAGE_TASK = "https://zimage.run/api/z-image/task"
-
-# 任务缓存
-task_cache = {}
-
 def is_valid_uuid(uuid_str):
     """验证UUID格式"""
     if not uuid_str:
@@ -35,7 +45,12 @@ def is_valid_uuid(uuid_str):
     return bool(uuid_pattern.match(uuid_str))
 
 def extract_task_id(text):
-    """从文本中提取任务ID"""
+    """从文本中提取任务ID；微批成员 ID（<UUID>~<序号>）保留序号，查询时只返回该成员的图片"""
+    member = split_member_id(text)
+    if member is not None:
+        parent = extract_task_id(member[0])
+        return member_id(parent, member[1]) if parent else None
+
     # 如果是有效UUID，直接返回
     if is_valid_uuid(text):
         return text
@@ -91,15 +106,36 @@ def home():
             "health": "/health",
             "completions": "/v1/chat/completions",
             "task": "/v1/tasks/<taskId>",
+            "task_events": "/v1/tasks/<taskId>/events",
+            "task_batch": "/v1/tasks:batch",
             "image": "/v1/images/<taskId>"
         }
     })
 
+@app.route('/v1/queue', methods=['GET'])
+def queue_status():
+    """
+    准入队列：上游生成中的任务数、排队数和新请求的预计等待
+    """
+    return jsonify(admission.queue_status())
+
 @app.route('/health')
 def health():
     return jsonify({
         "status": "healthy",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now().isoformat(),
+        "upstream": upstream.stats(),
+        "poller": task_poller.stats(),
+        "task_status": task_status.stats(),
+        "long_poll": long_poll_limiter.stats(),
+        "webhooks": webhooks.stats(),
+        "result_cache": result_cache.stats(),
+        "journal": task_journal.stats(),
+        "task_registry": task_registry.stats(),
+        "generation_cache": generation_cache.stats(),
+        "dedup": submission_dedup.stats(),
+        "microbatch": micro_batcher.stats(),
+        "admission": admission.stats()
     })
 
 @app.route('/v1/chat/completions', methods=['POST', 'OPTIONS'])
@@ -118,6 +154,13 @@ def chat_completions():
         if not prompt:
             return jsonify({"error": "Prompt is required"}), 400
 
+        # 可选的完成回调地址
+        callback_url = (data.get('extra_body') or {}).get('callback_url')
+        if callback_url is not None:
+            callback_error = validate_callback_url(callback_url)
+            if callback_error:
+                return jsonify({"error": callback_error}), 400
+
         # 构建简化的请求
         payload = {
             "prompt": prompt,
@@ -128,46 +171,58 @@ def chat_completions():
             "cfg_scale": 6
         }
 
+        # 结果缓存 → 进行中任务去重 → 准入排队 → 微批提交；缓存命中不占用登记表容量
+        client_ip = request.headers.get('X-Forwarded-For', request.remote_addr or '').split(',')[0].strip()
+        cache_mode = request_cache_mode(request.headers)
         logger.info(f"Submitting generation request: {prompt[:50]}...")
-
-        # 提交生成请求（增加超时时间）
-        response = requests.post(ZIMAGE_GENERATE, json=payload, timeout=60)
-        response.raise_for_status()
-
-        result = response.json()
-        if result.get('success'):
-            uuid = result.get('data', {}).get('uuid')
-            if uuid:
-                # 缓存任务信息
-                task_cache[uuid] = {
-                    'created_at': time.time(),
-                    'prompt': prompt
-                }
-                logger.info(f"Task created: {uuid}")
-
-                # 返回OpenAI格式的响应
-                return jsonify({
-                    "id": f"chatcmpl-{uuid}",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": "zimage",
-                    "choices": [{
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": f"图片生成任务已提交，任务ID: {uuid}"
-                        },
-                        "finish_reason": "stop"
-                    }],
-                    "usage": {
-                        "prompt_tokens": len(prompt),
-                        "completion_tokens": 10,
-                        "total_tokens": len(prompt) + 10
-                    },
-                    "task_id": uuid  # 添加任务ID
-                })
-
-        return jsonify({"error": "Failed to create generation task"}), 500
+        submission = submit_generation(payload, client_ip, cache_mode, callback_url=callback_url, register=True,
+                                       timeout=60)
+        if submission.upstream_error:
+            return jsonify({"error": "Failed to create generation task"}), 500
+        if not submission.ok:
+            return jsonify(submission.body), submission.status_code, submission.headers
+        uuid = submission.uuid
+        cached = submission.cached
+
+        if callback_url:
+            webhooks.register(uuid, callback_url, payload)
+
+        if data.get('stream'):
+            # 流式响应：同一个连接内推送进度，最后一块是图片，客户端不必再轮询
+            extra = {"cached": cached, "deduplicated": submission.deduplicated, "queue": submission.queue}
+            response = Response(chat_completion_stream(uuid, 'zimage', extra),
+                                mimetype='text/event-stream', headers=SSE_HEADERS)
+            if generation_cache.enabled:
+                response.headers[CACHE_HEADER] = cache_status(cache_mode, cached)
+            return response
+
+        # 返回OpenAI格式的响应
+        response = jsonify({
+            "id": f"chatcmpl-{uuid}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "zimage",
+            "choices": [{
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": f"图片生成任务已提交，任务ID: {uuid}"
+                },
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": len(prompt),
+                "completion_tokens": 10,
+                "total_tokens": len(prompt) + 10
+            },
+            "task_id": uuid,  # 添加任务ID
+            "cached": cached,  # 复用了参数相同的已完成任务
+            "deduplicated": submission.deduplicated,  # 挂到了参数相同、正在生成的任务上
+            "queue": submission.queue  # 等待上游生成名额的排队情况
+        })
+        if generation_cache.enabled:
+            response.headers[CACHE_HEADER] = cache_status(cache_mode, cached)
+        return response
 
     except requests.exceptions.Timeout:
         logger.error("Timeout creating generation task")
@@ -176,6 +231,14 @@ def chat_completions():
         logger.error(f"Error creating task: {str(e)}")
         return jsonify({"error": f"创建任务失败: {str(e)}"}), 500
 
+@app.route('/v1/tasks:batch', methods=['POST'])
+def batch_task_status():
+    """
+    批量查询任务状态：请求体 {"uuids": [...], "timeout": 10}
+    """
+    body, status_code = handle_batch_request(request.get_json(silent=True))
+    return jsonify(body), status_code
+
 @app.route('/v1/tasks/<path:uuid>', methods=['GET'])
 def get_task_status(uuid):
     """获取任务状态"""
@@ -189,11 +252,21 @@ def get_task_status(uuid):
         }), 400
 
     try:
-        # 先检查缓存
-        if task_id in task_cache:
-            cache_info = task_cache[task_id]
+        # 长轮询：?wait=秒&since=状态，挂起到状态变化或超时
+        wait = parse_wait(request.args.get('wait'))
+        if wait:
+            client_ip = request.headers.get('X-Forwarded-For', request.remote_addr or '').split(',')[0].strip()
+            allowed, result = long_poll_task(task_id, client_ip, wait, request.args.get('since'))
+            if not allowed:
+                return jsonify(long_poll_rejected_response()), 429
+            if result is not None:
+                return jsonify(result)
+
+        # 先检查登记表
+        record = task_registry.get(task_id)
+        if record is not None:
             # 如果任务刚创建不久，直接返回缓存状态
-            if time.time() - cache_info['created_at'] < 5:
+            if time.time() - record.created_at < 5:
                 return jsonify({
                     "success": True,
                     "data": {
@@ -205,28 +278,25 @@ def get_task_status(uuid):
                 })
 
         # 查询实际状态（增加超时时间）
-        response = requests.get(f"{ZIMAGE_TASK}/{task_id}", timeout=15)
-        response.raise_for_status()
+        result = task_status.get(task_id, timeout=15)
 
-        result = response.json()
-
-        # 更新缓存
-        if task_id in task_cache and result.get('success'):
+        # 更新登记表
+        if result.get('success'):
             task_data = result.get('data', {}).get('task', {})
-            task_cache[task_id]['status'] = task_data.get('taskStatus', 'unknown')
-            task_cache[task_id]['last_checked'] = time.time()
+            task_registry.update(task_id, task_data.get('taskStatus', 'unknown'), task_data.get('progress'))
 
         return jsonify(result)
 
     except requests.exceptions.Timeout:
-        # 超时返回缓存或处理中状态
-        if task_id in task_cache:
+        # 超时返回登记的状态或处理中状态
+        record = task_registry.get(task_id)
+        if record is not None:
             return jsonify({
                 "success": True,
                 "data": {
                     "task": {
-                        "taskStatus": task_cache[task_id].get('status', 'processing'),
-                        "progress": task_cache[task_id].get('progress', 50)
+                        "taskStatus": record.status if record.last_checked else 'processing',
+                        "progress": record.progress if record.last_checked else 50
                     }
                 },
                 "timeout": True
@@ -247,12 +317,26 @@ def get_task_status(uuid):
             "success": True,  # 即使失败也返回success，避免前端错误
             "data": {
                 "task": {
-                    "taskStatus": "processing" if task_id in task_cache else "unknown",
+                    "taskStatus": "processing" if task_id in task_registry else "unknown",
                     "errorMessage": str(e)
                 }
             }
         })
 
+@app.route('/v1/tasks/<path:uuid>/events', methods=['GET'])
+def task_events(uuid):
+    """任务进度事件流 (SSE)：推送状态/进度变化，完成后推送图片URL并关闭"""
+    task_id = extract_task_id(uuid)
+    if not task_id:
+        return jsonify({
+            "error": "Invalid task ID format",
+            "message": "任务ID格式无效，请提供有效的UUID",
+            "received": uuid[:100] if uuid else None
+        }), 400
+
+    since_version = parse_last_event_id(request.headers.get('Last-Event-ID'))
+    return Response(task_event_stream(task_id, since_version), mimetype='text/event-stream', headers=SSE_HEADERS)
+
 @app.route('/v1/images/<path:uuid>', methods=['GET'])
 def get_image_results(uuid):
     """获取图片结果（简化版）"""
@@ -266,78 +350,55 @@ def get_image_results(uuid):
         }), 400
 
     try:
-        max_attempts = 40  # 增加最大尝试次数
-        attempt = 0
-
-        while attempt < max_attempts:
-            try:
-                response = requests.get(f"{ZIMAGE_TASK}/{task_id}", timeout=15)
-                response.raise_for_status()
-
-                result = response.json()
-
-                if result.get('success'):
-                    task_data = result.get('data', {}).get('task', {})
-                    status = task_data.get('taskStatus')
-
-                    if status == 'completed':
-                        result_url = task_data.get('resultUrl')
-                        result_urls = task_data.get('resultUrls', [])
-
-                        images = []
-                        if result_url:
-                            images = [result_url]
-                        elif result_urls:
-                            images = result_urls
-
-                        # 清理缓存
-                        if uuid in task_cache:
-                            del task_cache[uuid]
-
-                        logger.info(f"Task {uuid} completed with {len(images)} images")
-
-                        return jsonify({
-                            "success": True,
-                            "data": {
-                                "images": images
-                            }
-                        })
-
-                    elif status == 'failed':
-                        error_msg = task_data.get('errorMessage', 'Task failed')
-                        logger.error(f"Task {uuid} failed: {error_msg}")
-                        return jsonify({
-                            "success": False,
-                            "error": error_msg
-                        }), 500
-
-                # 等待并重试
-                if attempt < 10:
-                    time.sleep(2)  # 前10次每2秒检查
-                elif attempt < 20:
-                    time.sleep(3)  # 中期每3秒检查
-                else:
-                    time.sleep(5)  # 后期每5秒检查
-
-                attempt += 1
-                if attempt % 5 == 0:
-                    logger.info(f"Task {task_id} still processing, attempt {attempt}/{max_attempts}")
-
-            except requests.exceptions.Timeout:
-                logger.warning(f"Timeout checking task {task_id}, attempt {attempt}")
-                # 继续尝试
-                if attempt < max_attempts - 1:
-                    time.sleep(5)
-                    attempt += 1
-                    continue
-                else:
-                    break
+        # 集中式轮询器负责上游查询，同一任务的多个等待者共享结果
+        max_wait = 150  # 图片生成通常需要1-3分钟
+        snapshot = task_poller.wait_for_completion(task_id, timeout=max_wait)
+        task_data = snapshot['task']
+        status = snapshot['status']
+
+        if status == 'completed':
+            result_url = task_data.get('resultUrl')
+            result_urls = task_data.get('resultUrls', [])
+
+            images = []
+            if result_url:
+                images = [result_url]
+            elif result_urls:
+                images = result_urls
+
+            # 任务已结束，移出登记表
+            task_registry.remove(task_id)
+
+            logger.info(f"Task {task_id} completed with {len(images)} images")
+
+            return jsonify({
+                "success": True,
+                "data": {
+                    "images": images
+                }
+            })
+
+        elif status == 'failed':
+            error_msg = task_data.get('errorMessage', 'Task failed')
+            logger.error(f"Task {task_id} failed: {error_msg}")
+            return jsonify({
+                "success": False,
+                "error": error_msg
+            }), 500
+
+        # 上游拒绝查询（如任务不存在）或一直不可用
+        if snapshot['error']:
+            logger.error(f"Error getting images for task {task_id}: {snapshot['error']}")
+            return jsonify({
+                "success": False,
+                "error": f"获取图片失败: {snapshot['error']}"
+            }), 500
 
         # 超时处理
-        logger.error(f"Task {task_id} timed out after {max_attempts} attempts")
+        logger.error(f"Task {task_id} timed out after {max_wait}s")
         return jsonify({
             "success": False,
-            "error": f"任务超时，已尝试 {max_attempts} 次。图片生成通常需要1-3分钟，请稍后再试。"
+            "error": f"任务超时，已等待 {max_wait} 秒。图片生成通常需要1-3分钟，请稍后再试。"
         }), 408
 
     except Exception as e:
@@ -359,6 +420,12 @@ if __name__ == '__main__':
     # 启动keep-alive
     start_keep_alive()
 
+    # 预热上游连接池
+    upstream.warm()
+
+    # 从任务日志恢复重启前未结束的任务
+    recover_in_flight_tasks()
+
     # 根据环境变量决定是否使用多线程
     use_threading = os.environ.get('FLASK_THREADED', 'true').lower() == 'true'
     use_processes = int(os.environ.get('FLASK_PROCESSES', '1'))
@@ -4,7 +4,7 @@ Z-Image 统一服务 - 同时提供 API 和静态文件服务
 适用于 Render 免费部署
 """
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
 import requests
 import time
@@ -14,23 +14,33 @@ import threading
 from datetime import datetime
 from pathlib import Path
 
+from zimage_upstream import upstream
+from zimage_poller import task_poller
+from zimage_results import result_cache
+from zimage_journal import task_journal, recover_in_flight_tasks
+from zimage_registry import task_registry
+from zimage_webhooks import webhooks, validate_callback_url
+from zimage_gencache import CACHE_HEADER, generation_cache, request_cache_mode, cache_status
+from zimage_dedup import submission_dedup
+from zimage_batcher import micro_batcher
+from zimage_admission import admission
+from zimage_submit import submit_generation
+from zimage_coalesce import task_status, handle_batch_request
+from zimage_events import (
+    SSE_HEADERS, chat_completion_stream, parse_last_event_id, task_event_stream,
+    parse_wait, long_poll_task, long_poll_limiter, long_poll_rejected_response
+)
+
 # 创建 Flask 应用
 app = Flask(__name__, static_folder='web', static_url_path='')
 
 # 配置 CORS - 允许所有来源
-CORS(app)
+CORS(app, expose_headers=[CACHE_HEADER])
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Z-Image API endpoints
-ZIMAGE_GENERATE = "https://zimage.run/api/z-image/generate"
-ZIMAGE_TASK = "https://zimage.run/api/z-image/task"
-
-# 任务缓存
-task_cache = {}
-
 # Keep-alive 功能
 def start_keep_alive():
     """启动keep-alive后台线程"""
@@ -69,6 +79,8 @@ def index():
                 "health": "/health",
                 "completions": "/v1/chat/completions",
                 "task": "/v1/tasks/<taskId>",
+                "task_events": "/v1/tasks/<taskId>/events",
+                "task_batch": "/v1/tasks:batch",
                 "image": "/v1/images/<taskId>"
             }
         })
@@ -88,13 +100,32 @@ def static_files(path):
         return jsonify({"error": "File not found"}), 404
 
 # API 路由
+@app.route('/v1/queue', methods=['GET'])
+def queue_status():
+    """
+    准入队列：上游生成中的任务数、排队数和新请求的预计等待
+    """
+    return jsonify(admission.queue_status())
+
 @app.route('/health')
 def health():
     """健康检查"""
     return jsonify({
         "status": "healthy",
         "service": "z-image-unified",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now().isoformat(),
+        "upstream": upstream.stats(),
+        "poller": task_poller.stats(),
+        "task_status": task_status.stats(),
+        "long_poll": long_poll_limiter.stats(),
+        "webhooks": webhooks.stats(),
+        "result_cache": result_cache.stats(),
+        "journal": task_journal.stats(),
+        "task_registry": task_registry.stats(),
+        "generation_cache": generation_cache.stats(),
+        "dedup": submission_dedup.stats(),
+        "microbatch": micro_batcher.stats(),
+        "admission": admission.stats()
     })
 
 @app.route('/v1/chat/completions', methods=['POST', 'OPTIONS'])
@@ -113,6 +144,13 @@ def chat_completions():
         if not prompt:
             return jsonify({"error": "Prompt is required"}), 400
 
+        # 可选的完成回调地址
+        callback_url = (data.get('extra_body') or {}).get('callback_url')
+        if callback_url is not None:
+            callback_error = validate_callback_url(callback_url)
+            if callback_error:
+                return jsonify({"error": callback_error}), 400
+
         # 构建请求
         payload = {
             "prompt": prompt,
@@ -123,44 +161,57 @@ def chat_completions():
             "cfg_scale": 6
         }
 
+        # 结果缓存 → 进行中任务去重 → 准入排队 → 微批提交；缓存命中不占用登记表容量
+        client_ip = request.headers.get('X-Forwarded-For', request.remote_addr or '').split(',')[0].strip()
+        cache_mode = request_cache_mode(request.headers)
         logger.info(f"Submitting generation request: {prompt[:50]}...")
-
-        # 提交生成请求
-        response = requests.post(ZIMAGE_GENERATE, json=payload, timeout=60)
-        response.raise_for_status()
-
-        result = response.json()
-        if result.get('success'):
-            uuid = result.get('data', {}).get('uuid')
-            if uuid:
-                task_cache[uuid] = {
-                    'created_at': time.time(),
-                    'prompt': prompt
-                }
-                logger.info(f"Task created: {uuid}")
-
-                return jsonify({
-                    "id": f"chatcmpl-{uuid}",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": "zimage",
-                    "choices": [{
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": f"图片生成任务已提交，任务ID: {uuid}"
-                        },
-                        "finish_reason": "stop"
-                    }],
-                    "usage": {
-                        "prompt_tokens": len(prompt),
-                        "completion_tokens": 10,
-                        "total_tokens": len(prompt) + 10
-                    },
-                    "task_id": uuid
-                })
-
-        return jsonify({"error": "Failed to create generation task"}), 500
+        submission = submit_generation(payload, client_ip, cache_mode, callback_url=callback_url, register=True,
+                                       timeout=60)
+        if submission.upstream_error:
+            return jsonify({"error": "Failed to create generation task"}), 500
+        if not submission.ok:
+            return jsonify(submission.body), submission.status_code, submission.headers
+        uuid = submission.uuid
+        cached = submission.cached
+
+        if callback_url:
+            webhooks.register(uuid, callback_url, payload)
+
+        if data.get('stream'):
+            # 流式响应：同一个连接内推送进度，最后一块是图片，客户端不必再轮询
+            extra = {"cached": cached, "deduplicated": submission.deduplicated, "queue": submission.queue}
+            response = Response(chat_completion_stream(uuid, 'zimage', extra),
+                                mimetype='text/event-stream', headers=SSE_HEADERS)
+            if generation_cache.enabled:
+                response.headers[CACHE_HEADER] = cache_status(cache_mode, cached)
+            return response
+
+        response = jsonify({
+            "id": f"chatcmpl-{uuid}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "zimage",
+            "choices": [{
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": f"图片生成任务已提交，任务ID: {uuid}"
+                },
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": len(prompt),
+                "completion_tokens": 10,
+                "total_tokens": len(prompt) + 10
+            },
+            "task_id": uuid,
+            "cached": cached,  # 复用了参数相同的已完成任务
+            "deduplicated": submission.deduplicated,  # 挂到了参数相同、正在生成的任务上
+            "queue": submission.queue  # 等待上游生成名额的排队情况
+        })
+        if generation_cache.enabled:
+            response.headers[CACHE_HEADER] = cache_status(cache_mode, cached)
+        return response
 
     except requests.exceptions.Timeout:
         logger.error("Timeout creating generation task")
@@ -169,13 +220,31 @@ def chat_completions():
         logger.error(f"Error creating task: {str(e)}")
         return jsonify({"error": f"创建任务失败: {str(e)}"}), 500
 
+@app.route('/v1/tasks:batch', methods=['POST'])
+def batch_task_status():
+    """
+    批量查询任务状态：请求体 {"uuids": [...], "timeout": 10}
+    """
+    body, status_code = handle_batch_request(request.get_json(silent=True))
+    return jsonify(body), status_code
+
 @app.route('/v1/tasks/<uuid>', methods=['GET'])
 def get_task_status(uuid):
     """获取任务状态"""
     try:
-        if uuid in task_cache:
-            cache_info = task_cache[uuid]
-            if time.time() - cache_info['created_at'] < 5:
+        # 长轮询：?wait=秒&since=状态，挂起到状态变化或超时
+        wait = parse_wait(request.args.get('wait'))
+        if wait:
+            client_ip = request.headers.get('X-Forwarded-For', request.remote_addr or '').split(',')[0].strip()
+            allowed, result = long_poll_task(uuid, client_ip, wait, request.args.get('since'))
+            if not allowed:
+                return jsonify(long_poll_rejected_response()), 429
+            if result is not None:
+                return jsonify(result)
+
+        record = task_registry.get(uuid)
+        if record is not None:
+            if time.time() - record.created_at < 5:
                 return jsonify({
                     "success": True,
                     "data": {
@@ -186,25 +255,23 @@ def get_task_status(uuid):
                     }
                 })
 
-        response = requests.get(f"{ZIMAGE_TASK}/{uuid}", timeout=15)
-        response.raise_for_status()
+        # 同一 UUID 的并发查询合并为一次上游请求
+        result = task_status.get(uuid, timeout=15)
 
-        result = response.json()
-
-        if uuid in task_cache and result.get('success'):
+        if result.get('success'):
             task_data = result.get('data', {}).get('task', {})
-            task_cache[uuid]['status'] = task_data.get('taskStatus', 'unknown')
-            task_cache[uuid]['last_checked'] = time.time()
+            task_registry.update(uuid, task_data.get('taskStatus', 'unknown'), task_data.get('progress'))
 
         return jsonify(result)
 
     except requests.exceptions.Timeout:
-        if uuid in task_cache:
+        record = task_registry.get(uuid)
+        if record is not None:
             return jsonify({
                 "success": True,
                 "data": {
                     "task": {
-                        "taskStatus": task_cache[uuid].get('status', 'processing'),
+                        "taskStatus": record.status if record.last_checked else 'processing',
                         "progress": 50
                     }
                 },
@@ -226,12 +293,20 @@ def get_task_status(uuid):
             "success": True,
             "data": {
                 "task": {
-                    "taskStatus": "processing" if uuid in task_cache else "unknown",
+                    "taskStatus": "processing" if uuid in task_registry else "unknown",
                     "errorMessage": str(e)
                 }
             }
         })
 
+@app.route('/v1/tasks/<uuid>/events', methods=['GET'])
+def task_events(uuid):
+    """
+    任务进度事件流 (SSE)：推送状态/进度变化，完成后推送图片URL并关闭
+    """
+    since_version = parse_last_event_id(request.headers.get('Last-Event-ID'))
+    return Response(task_event_stream(uuid, since_version), mimetype='text/event-stream', headers=SSE_HEADERS)
+
 @app.route('/v1/images/<uuid>', methods=['GET'])
 def get_image_results(uuid):
     """获取图片结果"""
@@ -239,74 +314,55 @@ def get_image_results(uuid):
         return jsonify({"error": "No task ID provided"}), 400
 
     try:
-        max_attempts = 40
-        attempt = 0
-
-        while attempt < max_attempts:
-            try:
-                response = requests.get(f"{ZIMAGE_TASK}/{uuid}", timeout=15)
-                response.raise_for_status()
-
-                result = response.json()
-
-                if result.get('success'):
-                    task_data = result.get('data', {}).get('task', {})
-                    status = task_data.get('taskStatus')
-
-                    if status == 'completed':
-                        result_url = task_data.get('resultUrl')
-                        result_urls = task_data.get('resultUrls', [])
-
-                        images = []
-                        if result_url:
-                            images = [result_url]
-                        elif result_urls:
-                            images = result_urls
-
-                        if uuid in task_cache:
-                            del task_cache[uuid]
-
-                        logger.info(f"Task {uuid} completed with {len(images)} images")
-
-                        return jsonify({
-                            "success": True,
-                            "data": {
-                                "images": images
-                            }
-                        })
-
-                    elif status == 'failed':
-                        error_msg = task_data.get('errorMessage', 'Task failed')
-                        logger.error(f"Task {uuid} failed: {error_msg}")
-                        return jsonify({
-                            "success": False,
-                            "error": error_msg
-                        }), 500
-
-                if attempt < 10:
-                    time.sleep(2)
-                elif attempt < 20:
-                    time.sleep(3)
-                else:
-                    time.sleep(5)
-
-                attempt += 1
-                if attempt % 5 == 0:
-                    logger.info(f"Task {uuid} still processing, attempt {attempt}/{max_attempts}")
-
-            except requests.exceptions.Timeout:
-                logger.warning(f"Timeout checking task {uuid}, attempt {attempt}")
-                if attempt < max_attempts - 1:
-                    time.sleep(5)
-                    attempt += 1
-                    continue
-                else:
-                    break
-
-        logger.error(f"Task {uuid} timed out after {max_attempts} attempts")
+        # 集中式轮询器负责上游查询，同一任务的多个等待者共享结果
+        max_wait = 150  # 图片生成通常需要1-3分钟
+        snapshot = task_poller.wait_for_completion(uuid, timeout=max_wait)
+        task_data = snapshot['task']
+        status = snapshot['status']
+
+        if status == 'completed':
+            result_url = task_data.get('resultUrl')
+            result_urls = task_data.get('resultUrls', [])
+
+            images = []
+            if result_url:
+                images = [result_url]
+            elif result_urls:
+                images = result_urls
+
+            # 任务已结束，移出登记表
+            task_registry.remove(uuid)
+
+            logger.info(f"Task {uuid} completed with {len(images)} images")
+
+            return jsonify({
+                "success": True,
+                "data": {
+                    "images": images
+                }
+            })
+
+        elif status == 'failed':
+            error_msg = task_data.get('errorMessage', 'Task failed')
+            logger.error(f"Task {uuid} failed: {error_msg}")
+            return jsonify({
+                "success": False,
+                "error": error_msg
+            }), 500
+
+        # 上游拒绝查询（如任务不存在）或一直不可用
+        if snapshot['error']:
+            logger.error(f"Error getting images for task {uuid}: {snapshot['error']}")
+            return jsonify({
+                "success": False,
+                "error": f"获取图片失败: {snapshot['error']}"
+            }), 500
+
+        # 超时处理
+        logger.error(f"Task {uuid} timed out after {max_wait}s")
         return jsonify({
             "success": False,
-            "error": f"任务超时，已尝试 {max_attempts} 次。图片生成通常需要1-3分钟，请稍后再试。"
+            "error": f"任务超时，已等待 {max_wait} 秒。图片生成通常需要1-3分钟，请稍后再试。"
         }), 408
 
     except Exception as e:
@@ -328,6 +384,12 @@ if __name__ == '__main__':
     # 启动keep-alive
     start_keep_alive()
 
+    # 预热上游连接池
+    upstream.warm()
+
+    # 从任务日志恢复重启前未结束的任务
+    recover_in_flight_tasks()
+
     # 生产环境不要使用debug
     debug = os.environ.get('DEBUG', 'false').lower() == 'true'
     app.run(host='0.0.0.0', port=port, debug=debug)
\ No newline at end of file
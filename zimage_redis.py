@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Z-Image 最小 Redis (RESP2) 客户端
+只实现共享状态后端用到的部分：单条命令、流水线、EVALSHA 脚本（NOSCRIPT 时回退 EVAL）。
+不引入 redis-py 依赖；兼容任何实现 RESP 协议的服务器（Redis / Valkey / KeyDB / 测试用替身）
+"""
+
+import hashlib
+import os
+import socket
+import ssl
+import threading
+from typing import Any, List, Sequence
+from urllib.parse import unquote, urlparse
+
+
+class RedisError(Exception):
+    """连接失败或服务器返回错误"""
+
+
+class RedisReplyError(RedisError):
+    """服务器返回的 -ERR 等错误回复"""
+
+
+def encode_command(args: Sequence[Any]) -> bytes:
+    """编码为 RESP 数组"""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, bytes):
+            data = arg
+        elif isinstance(arg, float):
+            data = repr(arg).encode()
+        else:
+            data = str(arg).encode('utf-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+    return b''.join(parts)
+
+
+class RedisClient:
+    """每个线程一条连接，fork 后的子进程重新连接；连接出错时自动重连一次"""
+
+    def __init__(self, url: str, timeout: float = 1.0):
+        parsed = urlparse(url)
+        if parsed.scheme not in ('redis', 'rediss'):
+            raise ValueError(f"Unsupported Redis URL scheme: {parsed.scheme}")
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.tls = parsed.scheme == 'rediss'
+        self.timeout = timeout
+        self._local = threading.local()
+        self._scripts = {}  # sha1 -> 脚本源码
+
+        self.commands = 0
+        self.errors = 0
+        self.reconnects = 0
+
+    # ---- 命令 ----
+
+    def execute(self, *args) -> Any:
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands: List[Sequence[Any]]) -> List[Any]:
+        """一次写出所有命令再依次读取回复；任一命令出错时读完全部回复后抛出"""
+        payload = b''.join(encode_command(args) for args in commands)
+        for attempt in (0, 1):
+            conn = self._connection()
+            try:
+                conn.sendall(payload)
+                replies = [self._read_reply()]
+            except (OSError, RedisError) as e:
+                self._close()
+                if attempt or isinstance(e, socket.timeout):
+                    # 读超时时命令可能已经执行，不重试
+                    self.errors += 1
+                    raise RedisError(f"Redis request failed: {e}") from e
+                # 复用的连接可能已被服务器关闭（空闲超时），重连后重试一次
+                self.reconnects += 1
+                continue
+            break
+        try:
+            replies.extend(self._read_reply() for _ in commands[1:])
+        except (OSError, RedisError) as e:
+            self._close()
+            self.errors += 1
+            raise RedisError(f"Redis request failed: {e}") from e
+        self.commands += len(commands)
+        for reply in replies:
+            if isinstance(reply, RedisReplyError):
+                self.errors += 1
+                raise reply
+        return replies
+
+    def register_script(self, source: str) -> str:
+        sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        self._scripts[sha] = source
+        return sha
+
+    def evalsha(self, sha: str, keys: Sequence[Any], args: Sequence[Any]) -> Any:
+        """执行脚本；服务器还没有缓存该脚本时用 EVAL 发送源码"""
+        try:
+            return self.execute('EVALSHA', sha, len(keys), *keys, *args)
+        except RedisReplyError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+        return self.execute('EVAL', self._scripts[sha], len(keys), *keys, *args)
+
+    # ---- 连接 ----
+
+    def _connection(self) -> socket.socket:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        try:
+            conn = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.tls:
+                conn = ssl.create_default_context().wrap_socket(conn, server_hostname=self.host)
+        except OSError as e:
+            self.errors += 1
+            raise RedisError(f"Cannot connect to Redis at {self.host}:{self.port}: {e}") from e
+        self._local.conn = conn
+        self._local.reader = conn.makefile('rb')
+        self._local.pid = os.getpid()
+
+        handshake = []
+        if self.password:
+            handshake.append(('AUTH', self.username, self.password) if self.username else ('AUTH', self.password))
+        if self.db:
+            handshake.append(('SELECT', self.db))
+        if handshake:
+            conn.sendall(b''.join(encode_command(args) for args in handshake))
+            for _ in handshake:
+                reply = self._read_reply()
+                if isinstance(reply, RedisReplyError):
+                    self._close()
+                    raise reply
+        return conn
+
+    def _close(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None and self._local.pid == os.getpid():
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _read_reply(self) -> Any:
+        """解析一个 RESP2 回复；错误回复作为 RedisReplyError 实例返回，由调用方决定何时抛出"""
+        line = self._local.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise RedisError("Connection closed by Redis server")
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            return body.decode('utf-8')
+        if kind == b'-':
+            return RedisReplyError(body.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            length = int(body)
+            if length < 0:
+                return None
+            data = self._local.reader.read(length + 2)
+            if len(data) != length + 2:
+                raise RedisError("Connection closed by Redis server")
+            return data[:-2].decode('utf-8', 'replace')
+        if kind == b'*':
+            count = int(body)
+            if count < 0:
+                return None
+            return [self._read_reply() for _ in range(count)]
+        raise RedisError(f"Unexpected reply from Redis server: {line[:50]!r}")
+
+    def stats(self) -> dict:
+        return {
+            "host": self.host,
+            "port": self.port,
+            "db": self.db,
+            "commands": self.commands,
+            "errors": self.errors,
+            "reconnects": self.reconnects
+        }
+
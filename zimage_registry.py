@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Z-Image 进行中任务登记表
+替代各版本里无锁、不淘汰的 task_cache 字典：每个任务一条 __slots__ 记录，
+按创建时间顺序保存，超过 TTL 由后台线程清理，达到容量上限时按策略淘汰最旧的或拒绝新任务。
+使用共享状态后端 (ZIMAGE_STATE_BACKEND=redis) 时登记同时写入后端，其他副本 / 进程也能查到
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from zimage_state import StateBackendError, state_backend
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_CAPACITY = int(os.environ.get('ZIMAGE_TASK_REGISTRY_SIZE', '100000'))  # 最多登记的任务数
+REGISTRY_TTL = float(os.environ.get('ZIMAGE_TASK_REGISTRY_TTL', '900'))  # 登记保留时间（秒）
+REGISTRY_OVERFLOW = os.environ.get('ZIMAGE_TASK_REGISTRY_OVERFLOW', 'evict')  # evict: 淘汰最旧的; reject: 拒绝新任务
+SWEEP_INTERVAL = 30  # 后台清理间隔（秒）
+
+
+class TaskRecord:
+    """一个登记中的任务；状态字符串经 sys.intern 共享，记录本身大小固定"""
+
+    __slots__ = ('created_at', 'last_checked', 'status', 'progress', 'tag')
+
+    def __init__(self, created_at: float, tag: Optional[str] = None):
+        self.created_at = created_at
+        self.last_checked = 0.0
+        self.status = 'pending'
+        self.progress = 0
+        self.tag = tag
+
+
+class TaskRegistry:
+    """线程安全、有界、带 TTL 的任务登记表"""
+
+    def __init__(self, capacity: int = REGISTRY_CAPACITY, ttl: float = REGISTRY_TTL, overflow: str = REGISTRY_OVERFLOW,
+                 shared=None):
+        self.capacity = max(1, capacity)
+        self.ttl = ttl
+        self.overflow = overflow if overflow in ('evict', 'reject') else 'evict'
+        self._lock = threading.Lock()
+        # 插入顺序即创建顺序：过期和淘汰都从队首开始，O(1)
+        self._records: "OrderedDict[str, TaskRecord]" = OrderedDict()
+        self._sweeper = None
+        self._pid = None
+        self._shared = shared  # 共享状态后端；容量上限仍按本进程计算
+
+        self.added = 0
+        self.expired = 0
+        self.evicted = 0
+        self.rejected = 0
+        self.shared_hits = 0
+        self.shared_errors = 0
+
+    def add(self, uuid: str, tag: Optional[str] = None) -> bool:
+        """登记新任务；reject 策略下登记表已满时返回 False"""
+        self._ensure_sweeper()
+        now = time.time()
+        with self._lock:
+            self._records.pop(uuid, None)
+            self._expire(now)
+            if len(self._records) >= self.capacity:
+                if self.overflow == 'reject':
+                    self.rejected += 1
+                    return False
+                self._records.popitem(last=False)
+                self.evicted += 1
+            self._records[uuid] = TaskRecord(now, sys.intern(tag) if tag else None)
+            self.added += 1
+        self._share('put_task', uuid, {"created_at": now, "status": 'pending', "progress": 0, "tag": tag or ''}, now + self.ttl)
+        return True
+
+    def has_capacity(self) -> bool:
+        """reject 策略下，提交任务前检查是否还能登记"""
+        if self.overflow != 'reject':
+            return True
+        with self._lock:
+            self._expire(time.time())
+            if len(self._records) < self.capacity:
+                return True
+            self.rejected += 1
+            return False
+
+    def get(self, uuid: str) -> Optional[TaskRecord]:
+        with self._lock:
+            record = self._records.get(uuid)
+            if record is not None and time.time() - record.created_at > self.ttl:
+                del self._records[uuid]
+                self.expired += 1
+                return None
+        if record is None and self._shared is not None:
+            # 其他副本 / 进程登记的任务；不放入本地表，保持本地表的创建时间顺序
+            record = self._from_shared(self._share('get_task', uuid))
+        return record
+
+    def __contains__(self, uuid: str) -> bool:
+        return self.get(uuid) is not None
+
+    def update(self, uuid: str, status: Optional[str], progress: Optional[int] = None):
+        """记录最近一次查询到的状态"""
+        now = time.time()
+        with self._lock:
+            record = self._records.get(uuid)
+            if record is not None:
+                if status:
+                    record.status = sys.intern(status)
+                if progress is not None:
+                    record.progress = progress
+                record.last_checked = now
+        if self._shared is not None:
+            fields = {"last_checked": now}
+            if status:
+                fields["status"] = status
+            if progress is not None:
+                fields["progress"] = progress
+            self._share('update_task', uuid, fields)
+
+    def remove(self, uuid: str) -> bool:
+        with self._lock:
+            removed = self._records.pop(uuid, None) is not None
+        if self._shared is not None:
+            removed = bool(self._share('delete_task', uuid)) or removed
+        return removed
+
+    def _share(self, method: str, *args):
+        """写入 / 读取共享后端；后端不可用时只用本地表"""
+        if self._shared is None:
+            return None
+        try:
+            return getattr(self._shared, method)(*args)
+        except StateBackendError as e:
+            self.shared_errors += 1
+            logger.warning(f"Task registry shared backend error: {e}")
+            return None
+
+    def _from_shared(self, fields: Optional[Dict[str, str]]) -> Optional[TaskRecord]:
+        if not fields or 'created_at' not in fields:
+            return None
+        record = TaskRecord(float(fields['created_at']), fields.get('tag') or None)
+        if time.time() - record.created_at > self.ttl:
+            return None
+        record.status = sys.intern(fields.get('status') or 'pending')
+        record.progress = int(float(fields.get('progress') or 0))
+        record.last_checked = float(fields.get('last_checked') or 0)
+        self.shared_hits += 1
+        return record
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._records),
+                "capacity": self.capacity,
+                "ttl": self.ttl,
+                "overflow": self.overflow,
+                "added": self.added,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "rejected": self.rejected,
+                "shared": self._shared.name if self._shared is not None else None,
+                "shared_hits": self.shared_hits,
+                "shared_errors": self.shared_errors
+            }
+
+    def _expire(self, now: float):
+        """从队首移除过期记录；调用方需持有 self._lock"""
+        cutoff = now - self.ttl
+        while self._records:
+            uuid, record = next(iter(self._records.items()))
+            if record.created_at >= cutoff:
+                break
+            del self._records[uuid]
+            self.expired += 1
+
+    def _ensure_sweeper(self):
+        """懒启动清理线程；多进程模式下每个子进程各自启动"""
+        if self._sweeper and self._sweeper.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper and self._sweeper.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid is not None and self._pid != os.getpid():
+                self._records.clear()
+            self._pid = os.getpid()
+            self._sweeper = threading.Thread(target=self._sweep, name='zimage-registry-sweeper', daemon=True)
+            self._sweeper.start()
+
+    def _sweep(self):
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            try:
+                with self._lock:
+                    self._expire(time.time())
+            except Exception as e:
+                logger.error(f"Task registry sweep error: {e}")
+
+
+# 进程级共享实例
+task_registry = TaskRegistry(shared=state_backend if state_backend.shared else None)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Z-Image 终态结果缓存
+completed / failed 的任务结果不会再变化，缓存后 /v1/tasks、/v1/images 的重复查询
+（刷新页面、多个客户端、重试）直接本地返回，不再访问上游。按 LRU + TTL 淘汰
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+RESULT_CACHE_SIZE = int(os.environ.get('ZIMAGE_RESULT_CACHE_SIZE', '5000'))  # 最多缓存的任务数
+RESULT_CACHE_TTL = float(os.environ.get('ZIMAGE_RESULT_CACHE_TTL', '3600'))  # 结果保留时间（秒）
+
+TERMINAL_STATUSES = ('completed', 'failed')
+
+
+def result_status(result: Dict) -> Optional[str]:
+    return result.get('data', {}).get('task', {}).get('taskStatus')
+
+
+class TerminalResultCache:
+    """有界的终态任务结果缓存"""
+
+    def __init__(self, capacity: int = RESULT_CACHE_SIZE, ttl: float = RESULT_CACHE_TTL):
+        self.capacity = max(1, capacity)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()  # uuid -> (stored_at, result)
+        self._loader: Optional[Callable[[str], Optional[Dict]]] = None  # 未命中时的后备来源（如磁盘任务日志）
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evicted_lru = 0
+        self.evicted_ttl = 0
+        self.loaded = 0
+
+    def set_loader(self, loader: Optional[Callable[[str], Optional[Dict]]]):
+        self._loader = loader
+
+    @property
+    def has_loader(self) -> bool:
+        return self._loader is not None
+
+    def get(self, uuid: str, load: bool = True) -> Optional[Dict]:
+        """load=False 时只查内存，不访问后备来源（供事件循环内调用，未命中再到线程池里调用 load）"""
+        with self._lock:
+            entry = self._entries.get(uuid)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[uuid]
+                self.evicted_ttl += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(uuid)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        return self.load(uuid) if load else None
+
+    def load(self, uuid: str) -> Optional[Dict]:
+        """只查后备来源（可能读磁盘），找到时放入缓存"""
+        if self._loader is not None:
+            result = self._loader(uuid)
+            if result is not None and self.put(uuid, result):
+                with self._lock:
+                    self.loaded += 1
+                return result
+        return None
+
+    def put(self, uuid: str, result: Dict) -> bool:
+        """只缓存终态结果，返回是否已缓存"""
+        if result_status(result) not in TERMINAL_STATUSES:
+            return False
+        now = time.time()
+        with self._lock:
+            if uuid not in self._entries:
+                self.stores += 1
+            self._entries[uuid] = (now, result)
+            self._entries.move_to_end(uuid)
+            # 最旧的条目在队首：先淘汰过期的，再按容量淘汰
+            while self._entries:
+                oldest_uuid, (stored_at, _) = next(iter(self._entries.items()))
+                if now - stored_at > self.ttl:
+                    self.evicted_ttl += 1
+                elif len(self._entries) > self.capacity:
+                    self.evicted_lru += 1
+                else:
+                    break
+                del self._entries[oldest_uuid]
+        return True
+
+    def remove(self, uuid: str) -> bool:
+        with self._lock:
+            return self._entries.pop(uuid, None) is not None
+
+    def clear(self) -> int:
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            return count
+
+    def entries(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """最近使用的条目摘要，供管理接口查看"""
+        now = time.time()
+        with self._lock:
+            recent = list(self._entries.items())[-max(0, limit):] if limit > 0 else []
+        return [
+            {
+                "uuid": uuid,
+                "status": result_status(result),
+                "age_seconds": round(now - stored_at, 1),
+                "expires_in": round(max(0.0, self.ttl - (now - stored_at)), 1)
+            }
+            for uuid, (stored_at, result) in reversed(recent)
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "stores": self.stores,
+                "evicted_lru": self.evicted_lru,
+                "evicted_ttl": self.evicted_ttl,
+                "loaded": self.loaded
+            }
+
+
+# 进程级共享实例
+result_cache = TerminalResultCache()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Z-Image 自适应轮询节奏
+按 (model, 宽×高, steps, batch_size) 记录最近的任务完成耗时，
+根据预测的完成时间分位数安排轮询：预计完成前稀疏，接近完成时密集，超时后逐步放缓。
+没有足够历史时退回到固定节奏
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+HISTORY_SAMPLES = 200  # 每个参数组合保留的最近完成耗时样本数
+HISTORY_MIN_SAMPLES = 5  # 样本少于该数时使用更粗的分组或固定节奏
+HISTORY_MAX_PROFILES = 256  # 最多保留样本的参数分组数（尺寸、步数由客户端决定），超过时淘汰最久未更新的
+REGISTRY_TTL = 900  # 已提交任务的参数记录保留时间（秒）
+REGISTRY_MAX_TASKS = 10000
+
+MIN_INTERVAL = 0.5  # 预计完成窗口内的最短轮询间隔
+MAX_INTERVAL = 5  # 任意两次轮询的最长间隔，保证进度更新不至于太旧
+DENSE_POLLS = 8  # 在 p10~p90 窗口内大约轮询的次数
+MAX_SAMPLE_GAP = 2.0  # 完成时刻的不确定区间超过 max(该值, 耗时的25%) 时不记录样本
+EXPLORE_EVERY = 10  # 每个参数组合每 N 个任务有一个按固定节奏轮询，持续采集新样本
+
+# 极速预设（512px / 4 步 / 1 张）通常 2~3 秒完成，没有历史时也不必按秒轮询
+FAST_MAX_WORK = 512 * 512 * 4  # 像素数 × 步数 × 张数不超过该值的任务按极速节奏
+FAST_FIRST_DELAY = 1.0  # 提交后第一次查询前的等待（秒）
+FAST_INTERVAL = 0.3  # 前 FAST_POLLS 次查询的间隔（秒）
+FAST_POLLS = 10
+
+
+def task_profile(params: Dict[str, Any]) -> Tuple:
+    """任务的参数分组键"""
+    return (
+        params.get('model', 'turbo'),
+        int(params.get('width', 1024)) * int(params.get('height', 1024)),
+        int(params.get('steps', 8)),
+        int(params.get('batch_size', 1))
+    )
+
+
+def is_fast_profile(profile: Tuple) -> bool:
+    _, pixels, steps, batch_size = profile
+    return pixels * steps * batch_size <= FAST_MAX_WORK
+
+
+def fixed_interval(polls: int, fast: bool = False) -> float:
+    """没有历史数据时的固定节奏：前期频繁，后期放缓；极速任务前几次亚秒级"""
+    if fast and polls < FAST_POLLS:
+        return FAST_INTERVAL
+    if polls < 5:
+        return 1
+    if polls < 15:
+        return 2
+    return 3
+
+
+class CompletionHistory:
+    """任务完成耗时的历史分布，以及据此计算的下一次轮询间隔"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 同时按三个粒度记录：完整参数 / (model, 像素数) / (model,)，数据不足时逐级放宽
+        self._samples: "OrderedDict[Tuple, deque]" = OrderedDict()  # 按最近记录时间排序
+        # uuid -> (profile, submitted_at, explore)
+        # 按预测轮询的任务第一次查询时通常已完成，无法得到新样本；explore 任务按固定节奏轮询，
+        # 使历史能跟上上游速度的变化（包括变快）
+        self._tasks: "OrderedDict[str, Tuple[Tuple, float, bool]]" = OrderedDict()
+        self._registered: "OrderedDict[Tuple, int]" = OrderedDict()
+        self.recorded = 0
+        self.predicted_polls = 0
+        self.fixed_polls = 0
+
+    def register(self, uuid: str, params: Dict[str, Any], submitted_at: Optional[float] = None):
+        """任务提交成功后登记参数和提交时间"""
+        try:
+            profile = task_profile(params)
+        except (TypeError, ValueError):
+            return
+        now = time.time()
+        with self._lock:
+            count = self._registered.get(profile, 0)
+            self._registered[profile] = count + 1
+            self._registered.move_to_end(profile)
+            if len(self._registered) > HISTORY_MAX_PROFILES:
+                self._registered.popitem(last=False)
+            self._tasks[uuid] = (profile, submitted_at or now, count % EXPLORE_EVERY == 0)
+            self._tasks.move_to_end(uuid)
+            while self._tasks:
+                oldest_uuid, (_, oldest_at, _) = next(iter(self._tasks.items()))
+                if len(self._tasks) <= REGISTRY_MAX_TASKS and now - oldest_at <= REGISTRY_TTL:
+                    break
+                del self._tasks[oldest_uuid]
+
+    def record(self, uuid: str, last_running_at: Optional[float], completed_seen_at: float):
+        """
+        记录一次完成耗时。真实完成时刻在最后一次看到未完成和首次看到完成之间，取中点；
+        第一次轮询就已完成、或两次轮询间隔太大的任务耗时不准确，不记录
+        """
+        with self._lock:
+            entry = self._tasks.pop(uuid, None)
+            if entry is None or last_running_at is None:
+                return
+            profile, submitted_at, _ = entry
+            duration = max(0.0, (last_running_at + completed_seen_at) / 2 - submitted_at)
+            if completed_seen_at - last_running_at > max(MAX_SAMPLE_GAP, duration * 0.25):
+                return
+            for key in (profile, profile[:2], profile[:1]):
+                samples = self._samples.get(key)
+                if samples is None:
+                    samples = self._samples[key] = deque(maxlen=HISTORY_SAMPLES)
+                samples.append(duration)
+                self._samples.move_to_end(key)
+            while len(self._samples) > HISTORY_MAX_PROFILES:
+                self._samples.popitem(last=False)
+            self.recorded += 1
+
+    def forget(self, uuid: str):
+        """任务失败或放弃跟踪时移除登记"""
+        with self._lock:
+            self._tasks.pop(uuid, None)
+
+    def _quantiles(self, profile: Tuple) -> Optional[Tuple[float, float, float]]:
+        """(p10, p50, p90)，样本不足时返回 None；调用方需持有 self._lock"""
+        for key in (profile, profile[:2], profile[:1]):
+            samples = self._samples.get(key)
+            if samples and len(samples) >= HISTORY_MIN_SAMPLES:
+                ordered = sorted(samples)
+                last = len(ordered) - 1
+                return ordered[int(last * 0.1)], ordered[int(last * 0.5)], ordered[int(last * 0.9)]
+        return None
+
+    def first_delay(self, uuid: str, now: Optional[float] = None) -> float:
+        """
+        开始跟踪后第一次轮询前的等待时间：由本进程提交、且有历史数据的任务直接等到 p10，
+        没有历史的极速任务等到 FAST_FIRST_DELAY，其他任务（可能是无效的 UUID）立即查询
+        """
+        now = now or time.time()
+        with self._lock:
+            entry = self._tasks.get(uuid)
+            quantiles = self._quantiles(entry[0]) if entry and not entry[2] else None
+        if quantiles is None:
+            if entry and is_fast_profile(entry[0]):
+                return max(FAST_FIRST_DELAY - (now - entry[1]), 0.0)
+            return 0.0
+        return min(max(quantiles[0] - (now - entry[1]), 0.0), MAX_INTERVAL)
+
+    def next_interval(self, uuid: str, polls: int, errors: int, now: Optional[float] = None) -> float:
+        """下一次轮询距现在的秒数"""
+        if errors:
+            return min(2 ** errors, 10)
+
+        now = now or time.time()
+        with self._lock:
+            entry = self._tasks.get(uuid)
+            quantiles = self._quantiles(entry[0]) if entry and not entry[2] else None
+            if quantiles is None:
+                self.fixed_polls += 1
+            else:
+                self.predicted_polls += 1
+
+        if quantiles is None:
+            return fixed_interval(polls, bool(entry) and is_fast_profile(entry[0]))
+
+        p10, _, p90 = quantiles
+        elapsed = now - entry[1]
+        if elapsed < p10:
+            # 预计还远未完成：直接等到 p10
+            interval = p10 - elapsed
+        elif elapsed < p90:
+            # 大多数任务在这个窗口内完成：密集轮询
+            interval = (p90 - p10) / DENSE_POLLS
+        else:
+            # 已超过 p90：随超出时间逐步放缓
+            interval = MIN_INTERVAL + (elapsed - p90) / 2
+        return min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            profiles = {}
+            for key, samples in self._samples.items():
+                if len(key) != 4 or len(samples) < HISTORY_MIN_SAMPLES:
+                    continue
+                quantiles = self._quantiles(key)
+                model, pixels, steps, batch_size = key
+                profiles[f"{model}/{pixels}px/{steps}steps/x{batch_size}"] = {
+                    "samples": len(samples),
+                    "p10": round(quantiles[0], 2),
+                    "p50": round(quantiles[1], 2),
+                    "p90": round(quantiles[2], 2)
+                }
+            return {
+                "recorded": self.recorded,
+                "registered_tasks": len(self._tasks),
+                "predicted_polls": self.predicted_polls,
+                "fixed_polls": self.fixed_polls,
+                "profiles": profiles
+            }
+
+
+# 进程级共享实例
+completion_history = CompletionHistory()
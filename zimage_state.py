@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+Z-Image 共享状态后端
+频率限制、每日用量、提示词 / IP 统计和任务登记表的存储。
+- memory: 进程内字典（默认，单进程部署）
+- shm: 单机多进程共享一张内存映射的定长哈希表（频率限制和每日计数），不依赖外部服务
+- redis: 多个代理副本 / worker 共享同一份限额和统计；限额检查用 Lua 脚本原子完成，计数更新走流水线
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import socket
+import struct
+import tempfile
+import threading
+from collections import defaultdict, deque
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+
+from zimage_redis import RedisClient, RedisError
+
+logger = logging.getLogger(__name__)
+
+STATE_BACKEND = os.environ.get('ZIMAGE_STATE_BACKEND', 'memory')  # memory | redis | shm
+REDIS_URL = os.environ.get('ZIMAGE_REDIS_URL', 'redis://localhost:6379/0')
+REDIS_PREFIX = os.environ.get('ZIMAGE_REDIS_PREFIX', 'zimage:')
+REDIS_TIMEOUT = float(os.environ.get('ZIMAGE_REDIS_TIMEOUT', '1'))
+SHM_PATH = os.environ.get(
+    'ZIMAGE_SHM_PATH',
+    '/dev/shm/zimage-ratelimit' if os.path.isdir('/dev/shm') else os.path.join(tempfile.gettempdir(), 'zimage-ratelimit')
+)
+SHM_SLOTS = int(os.environ.get('ZIMAGE_SHM_SLOTS', '65536'))  # 哈希表槽位数（每个 IP 一个，32 字节），所有进程必须一致
+
+DAILY_KEY_TTL = 2 * 86400  # 每日计数键的保留时间（秒），过期由 Redis 清理
+TRACKED_IP_TTL = 86400  # 频率限制里统计“跟踪中 IP”的时间范围（秒）
+
+# acquire() 的返回值
+ALLOWED = 0
+RATE_LIMITED = 1
+DAILY_LIMITED = 2
+
+# 滑动窗口 + 每日限额，一次往返原子完成（与内存实现的判断顺序一致）
+# KEYS: 窗口 zset, 当日计数, 跟踪中 IP zset
+# ARGV: now, 窗口起点, 窗口长度, 窗口限额, 当日限额, 本次请求的成员名, IP, 每日键 TTL, 跟踪 IP 的起点
+ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[2])
+redis.call('ZADD', KEYS[3], ARGV[1], ARGV[7])
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', '(' .. ARGV[9])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    return 1
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[6])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+if tonumber(redis.call('GET', KEYS[2]) or '0') >= tonumber(ARGV[5]) then
+    return 2
+end
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[8])
+return 0
+"""
+
+# 只更新仍存在（未过期）的任务记录，避免写出没有 TTL 的键
+UPDATE_TASK_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV))
+return 1
+"""
+
+
+class StateBackendError(Exception):
+    """共享状态后端不可用"""
+
+
+class MemoryStateBackend:
+    """进程内实现；多进程 / 多副本部署时每个进程各自计数"""
+
+    name = 'memory'
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.user_requests = defaultdict(deque)  # 用于频率限制
+        self.daily_usage = defaultdict(int)  # 每日使用量
+        self.prompt_stats = defaultdict(int)  # 提示词统计
+        self.ip_stats = defaultdict(int)  # IP访问统计
+
+    def acquire(self, ip: str, now: float, day: str, window: int, limit: int, daily_limit: int) -> int:
+        """记录一次请求并检查频率和每日限额"""
+        with self._lock:
+            requests = self.user_requests[ip]
+            while requests and requests[0] < now - window:
+                requests.popleft()
+            if len(requests) >= limit:
+                return RATE_LIMITED
+            requests.append(now)
+
+            daily_key = f"{ip}:{day}"
+            if self.daily_usage[daily_key] >= daily_limit:
+                return DAILY_LIMITED
+            self.daily_usage[daily_key] += 1
+            return ALLOWED
+
+    def usage(self, ip: str, now: float, day: str, window: int) -> Tuple[int, int]:
+        """(当前窗口内请求数, 当日请求数)"""
+        with self._lock:
+            requests = self.user_requests.get(ip, ())
+            return len(requests), self.daily_usage.get(f"{ip}:{day}", 0)
+
+    def record_success(self, ip: str, prompt_key: str):
+        with self._lock:
+            self.prompt_stats[prompt_key] += 1
+            self.ip_stats[ip] += 1
+
+    def top_prompts(self, limit: int, min_count: int = 1) -> List[Tuple[str, int]]:
+        with self._lock:
+            ranked = sorted(self.prompt_stats.items(), key=lambda x: x[1], reverse=True)
+        return [(prompt, count) for prompt, count in ranked if count >= min_count][:limit]
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "unique_prompts": len(self.prompt_stats),
+                "active_users": len(self.ip_stats),
+                "tracked_ips": len(self.user_requests)
+            }
+
+    def clear_daily_before(self, day: str) -> int:
+        """删除早于 day 的每日计数，返回删除的键数"""
+        with self._lock:
+            old_keys = [key for key in self.daily_usage if key.rsplit(':', 1)[1] < day]
+            for key in old_keys:
+                del self.daily_usage[key]
+            return len(old_keys)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+
+class RedisStateBackend:
+    """Redis 实现；所有副本看到同一份限额、统计和任务登记"""
+
+    name = 'redis'
+    shared = True
+
+    def __init__(self, url: str = REDIS_URL, prefix: str = REDIS_PREFIX, timeout: float = REDIS_TIMEOUT):
+        self.client = RedisClient(url, timeout)
+        self.prefix = prefix
+        self._acquire_sha = self.client.register_script(ACQUIRE_SCRIPT)
+        self._update_task_sha = self.client.register_script(UPDATE_TASK_SCRIPT)
+        self._seq = 0
+        self._seq_lock = threading.Lock()
+        self._node = socket.gethostname()
+
+    def _key(self, *parts: str) -> str:
+        return self.prefix + ':'.join(parts)
+
+    def _member(self, now: float) -> str:
+        """窗口 zset 里每次请求的唯一成员名"""
+        with self._seq_lock:
+            self._seq += 1
+            seq = self._seq
+        return f"{now:.6f}:{self._node}:{os.getpid()}:{seq}"
+
+    def _call(self, fn, *args):
+        try:
+            return fn(*args)
+        except RedisError as e:
+            raise StateBackendError(str(e)) from e
+
+    # ---- 频率限制 ----
+
+    def acquire(self, ip: str, now: float, day: str, window: int, limit: int, daily_limit: int) -> int:
+        keys = [self._key('rl', ip), self._key('daily', day, ip), self._key('rl-ips')]
+        args = [now, now - window, window, limit, daily_limit, self._member(now), ip, DAILY_KEY_TTL, now - TRACKED_IP_TTL]
+        return int(self._call(self.client.evalsha, self._acquire_sha, keys, args))
+
+    def usage(self, ip: str, now: float, day: str, window: int) -> Tuple[int, int]:
+        current, daily = self._call(self.client.pipeline, [
+            ('ZCOUNT', self._key('rl', ip), now - window, '+inf'),
+            ('GET', self._key('daily', day, ip))
+        ])
+        return int(current), int(daily or 0)
+
+    # ---- 统计 ----
+
+    def record_success(self, ip: str, prompt_key: str):
+        self._call(self.client.pipeline, [
+            ('ZINCRBY', self._key('prompts'), 1, prompt_key),
+            ('ZINCRBY', self._key('ips'), 1, ip)
+        ])
+
+    def top_prompts(self, limit: int, min_count: int = 1) -> List[Tuple[str, int]]:
+        if limit <= 0:
+            return []
+        reply = self._call(
+            self.client.execute,
+            'ZREVRANGEBYSCORE', self._key('prompts'), '+inf', max(min_count, 1), 'WITHSCORES', 'LIMIT', 0, limit
+        )
+        return [(reply[i], int(float(reply[i + 1]))) for i in range(0, len(reply), 2)]
+
+    def counts(self) -> Dict[str, int]:
+        unique_prompts, active_users, tracked_ips = self._call(self.client.pipeline, [
+            ('ZCARD', self._key('prompts')),
+            ('ZCARD', self._key('ips')),
+            ('ZCARD', self._key('rl-ips'))
+        ])
+        return {"unique_prompts": unique_prompts, "active_users": active_users, "tracked_ips": tracked_ips}
+
+    def clear_daily_before(self, day: str) -> int:
+        # 每日计数键带 TTL，由 Redis 自动过期
+        return 0
+
+    # ---- 任务登记 ----
+
+    def put_task(self, uuid: str, fields: Dict[str, Any], expire_at: float):
+        key = self._key('task', uuid)
+        self._call(self.client.pipeline, [
+            ('DEL', key),
+            ('HSET', key, *[item for pair in fields.items() for item in pair]),
+            ('EXPIREAT', key, int(expire_at) + 1)
+        ])
+
+    def update_task(self, uuid: str, fields: Dict[str, Any]) -> bool:
+        args = [item for pair in fields.items() for item in pair]
+        return bool(self._call(self.client.evalsha, self._update_task_sha, [self._key('task', uuid)], args))
+
+    def get_task(self, uuid: str) -> Optional[Dict[str, str]]:
+        reply = self._call(self.client.execute, 'HGETALL', self._key('task', uuid))
+        if not reply:
+            return None
+        return dict(zip(reply[::2], reply[1::2]))
+
+    def delete_task(self, uuid: str) -> bool:
+        return bool(self._call(self.client.execute, 'DEL', self._key('task', uuid)))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "prefix": self.prefix, **self.client.stats()}
+
+
+class ShmStateBackend(MemoryStateBackend):
+    """
+    单机多进程共享的频率限制计数。
+    内存映射文件里的定长开放寻址哈希表，每个 IP 一个槽位：
+    窗口计数用“当前窗口 + 上一窗口按剩余比例加权”的滑动窗口近似（定长，不需要保存每次请求的时间）。
+    表分成若干条带，每个条带一把进程内锁 + 一段 fcntl 字节范围锁，不同 IP 的更新互不阻塞。
+    上一个自然日且窗口已过期的槽位视为空闲，换日后自动复用。
+    提示词 / IP 统计仍在进程内（继承自 MemoryStateBackend）
+    """
+
+    name = 'shm'
+    shared = False  # 任务登记表不经过此后端
+
+    MAGIC = b'ZIMGRL01'
+    HEADER = struct.Struct('<8sII')  # magic, 槽位数, 条带数
+    HEADER_SIZE = 64
+    # 键哈希, 日期序号, 当日计数, 窗口序号, 当前窗口计数, 上一窗口计数, 保留
+    SLOT = struct.Struct('<QIIIIII')
+    STRIPES = 64
+    MAX_PROBE = 32
+
+    def __init__(self, path: str = SHM_PATH, slots: int = SHM_SLOTS):
+        super().__init__()
+        import fcntl  # 仅 POSIX 可用，放在这里以免影响其他后端
+        self._fcntl = fcntl
+        self.path = path
+        self.per_stripe = max(self.MAX_PROBE, slots // self.STRIPES)
+        self.slots = self.per_stripe * self.STRIPES
+        self.size = self.HEADER_SIZE + self.slots * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._init_file()
+        except StateBackendError:
+            os.close(self._fd)
+            raise
+        self._map = mmap.mmap(self._fd, self.size)
+        self._pid = os.getpid()
+        self._stripe_locks = [threading.Lock() for _ in range(self.STRIPES)]
+        self.table_full = 0
+
+    def _init_file(self):
+        """
+        首个进程初始化空文件；文件头区域加锁，避免并发初始化。
+        已有文件的格式或槽位数不一致时报错而不是重建：其他进程可能正在使用它，重建会清空它们的计数
+        """
+        self._fcntl.lockf(self._fd, self._fcntl.LOCK_EX, self.HEADER_SIZE, 0)
+        try:
+            expected = self.HEADER.pack(self.MAGIC, self.slots, self.STRIPES)
+            size = os.fstat(self._fd).st_size
+            if size == 0:
+                logger.info(f"Initializing shared rate-limit table {self.path} ({self.slots} slots)")
+                os.ftruncate(self._fd, self.size)
+                os.pwrite(self._fd, expected, 0)
+                return
+            header = os.pread(self._fd, self.HEADER.size, 0)
+            if header != expected or size != self.size:
+                raise StateBackendError(
+                    f"Shared rate-limit table {self.path} has a different layout (expected {self.slots} slots); "
+                    f"remove the file or use the same ZIMAGE_SHM_SLOTS in every process"
+                )
+        finally:
+            self._fcntl.lockf(self._fd, self._fcntl.LOCK_UN, self.HEADER_SIZE, 0)
+
+    def _lock_stripe(self, stripe: int):
+        if self._pid != os.getpid():
+            # fork 时其他线程可能正持有进程内锁；fcntl 锁不会被子进程继承
+            self._stripe_locks = [threading.Lock() for _ in range(self.STRIPES)]
+            self._pid = os.getpid()
+        lock = self._stripe_locks[stripe]
+        lock.acquire()
+        try:
+            self._fcntl.lockf(self._fd, self._fcntl.LOCK_EX, self.per_stripe * self.SLOT.size, self._offset(stripe, 0))
+        except OSError:
+            lock.release()
+            raise
+        return lock
+
+    def _unlock_stripe(self, stripe: int, lock: threading.Lock):
+        try:
+            self._fcntl.lockf(self._fd, self._fcntl.LOCK_UN, self.per_stripe * self.SLOT.size, self._offset(stripe, 0))
+        finally:
+            lock.release()
+
+    def _offset(self, stripe: int, index: int) -> int:
+        return self.HEADER_SIZE + (stripe * self.per_stripe + index) * self.SLOT.size
+
+    @staticmethod
+    def _hash(ip: str) -> int:
+        # 0 表示空槽位
+        return int.from_bytes(hashlib.blake2b(ip.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+    def _find(self, key: int, stripe: int, day_no: int, win: int, create: bool) -> Tuple[Optional[int], Optional[list]]:
+        """在条带内线性探测 key 的槽位；create 时取第一个空闲或已过期的槽位。调用方需持有条带锁"""
+        start = (key >> 6) % self.per_stripe
+        free = None
+        for i in range(self.MAX_PROBE):
+            offset = self._offset(stripe, (start + i) % self.per_stripe)
+            slot = list(self.SLOT.unpack_from(self._map, offset))
+            if slot[0] == key:
+                return offset, slot
+            if free is None and (slot[0] == 0 or (slot[1] != day_no and slot[3] + 1 < win)):
+                free = offset
+        if not create or free is None:
+            return None, None
+        return free, [key, day_no, 0, win, 0, 0, 0]
+
+    @staticmethod
+    def _window_count(slot: list, now: float, win: int, window: int) -> float:
+        """滑动窗口内的估计请求数"""
+        if slot[3] == win:
+            current, previous = slot[4], slot[5]
+        elif slot[3] + 1 == win:
+            current, previous = 0, slot[4]
+        else:
+            current, previous = 0, 0
+        return previous * (1 - (now % window) / window) + current
+
+    def acquire(self, ip: str, now: float, day: str, window: int, limit: int, daily_limit: int) -> int:
+        key = self._hash(ip)
+        stripe = key % self.STRIPES
+        day_no = date.fromisoformat(day).toordinal()
+        win = int(now // window)
+        lock = self._lock_stripe(stripe)
+        try:
+            offset, slot = self._find(key, stripe, day_no, win, create=True)
+            if offset is None:
+                self.table_full += 1
+                raise StateBackendError(f"Shared rate-limit table full near {ip}, increase ZIMAGE_SHM_SLOTS")
+            estimate = self._window_count(slot, now, win, window)
+            if slot[3] != win:
+                slot[5] = slot[4] if slot[3] + 1 == win else 0
+                slot[3], slot[4] = win, 0
+            if slot[1] != day_no:
+                slot[1], slot[2] = day_no, 0
+
+            if estimate >= limit:
+                verdict = RATE_LIMITED
+            else:
+                slot[4] += 1
+                if slot[2] >= daily_limit:
+                    verdict = DAILY_LIMITED
+                else:
+                    slot[2] += 1
+                    verdict = ALLOWED
+            self.SLOT.pack_into(self._map, offset, *slot)
+            return verdict
+        finally:
+            self._unlock_stripe(stripe, lock)
+
+    def usage(self, ip: str, now: float, day: str, window: int) -> Tuple[int, int]:
+        key = self._hash(ip)
+        stripe = key % self.STRIPES
+        day_no = date.fromisoformat(day).toordinal()
+        win = int(now // window)
+        lock = self._lock_stripe(stripe)
+        try:
+            _, slot = self._find(key, stripe, day_no, win, create=False)
+        finally:
+            self._unlock_stripe(stripe, lock)
+        if slot is None:
+            return 0, 0
+        return round(self._window_count(slot, now, win, window)), slot[2] if slot[1] == day_no else 0
+
+    def counts(self) -> Dict[str, int]:
+        counts = super().counts()
+        # 无锁扫描，只用于统计展示
+        today_no = date.today().toordinal()
+        counts["tracked_ips"] = sum(
+            1 for slot in self.SLOT.iter_unpack(self._map[self.HEADER_SIZE:self.size])
+            if slot[0] and slot[1] == today_no
+        )
+        return counts
+
+    def clear_daily_before(self, day: str) -> int:
+        # 过期槽位在换日后由 acquire() 直接复用，不需要清理
+        return 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "path": self.path, "slots": self.slots, "table_full": self.table_full}
+
+
+def create_state_backend(kind: str = STATE_BACKEND):
+    if kind == 'shm':
+        try:
+            return ShmStateBackend()
+        except (ImportError, OSError, StateBackendError) as e:
+            logger.error(f"Cannot open shared rate-limit table {SHM_PATH}, using memory: {e}")
+            return MemoryStateBackend()
+    if kind == 'redis':
+        logger.info(f"Using Redis state backend at {REDIS_URL}")
+        return RedisStateBackend()
+    if kind != 'memory':
+        logger.warning(f"Unknown ZIMAGE_STATE_BACKEND '{kind}', using memory")
+    return MemoryStateBackend()
+
+
+# 进程级共享实例
+state_backend = create_state_backend()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Z-Image 生成任务的提交流程，各服务端点和批量作业共用：
+结果缓存 → 进行中任务去重 → 申请准入名额 → 微批提交 → 登记（去重结果、完成耗时历史、准入名额、任务日志、结果缓存、任务登记表）。
+zimage_proxy_async.submit_generation_async 是协程版本，提交成功后的登记同样经 record_submission 完成
+"""
+
+import logging
+from typing import Any, Dict, Optional
+
+from zimage_admission import AdmissionRejected, AdmissionTicket, admission, priority_for
+from zimage_batcher import SUBMIT_TIMEOUT, micro_batcher
+from zimage_dedup import DedupClaim, submission_dedup
+from zimage_gencache import generation_cache
+from zimage_journal import task_journal
+from zimage_registry import task_registry
+from zimage_schedule import completion_history
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_FULL_ERROR = "Too many tasks in progress, please retry later"
+
+
+class Submission:
+    """
+    一次提交的结果。ok 为 False 时 body / status_code / headers 即应返回给客户端的错误响应；
+    upstream_error 只在上游拒绝提交时设置（准入拒绝、登记表已满时为 None）
+    """
+
+    __slots__ = ('uuid', 'cached', 'deduplicated', 'queue', 'body', 'status_code', 'headers', 'rejected',
+                 'retry_after', 'upstream_error')
+
+    def __init__(self):
+        self.uuid: Optional[str] = None
+        self.cached = False  # 复用了参数相同的已完成任务
+        self.deduplicated = False  # 挂到了参数相同、正在生成的任务上
+        self.queue: Dict[str, Any] = {}  # 等待上游生成名额的排队情况（AdmissionTicket.info）
+        self.body: Optional[Dict[str, Any]] = None
+        self.status_code = 200
+        self.headers: Dict[str, str] = {}
+        self.rejected = False  # 准入排队满或超时
+        self.retry_after = 0
+        self.upstream_error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.body is None
+
+    def reject(self, ticket: AdmissionTicket):
+        self.rejected = True
+        self.retry_after = ticket.retry_after
+        self.fail(ticket.rejection(), 503)
+        self.headers = {'Retry-After': str(ticket.retry_after)}
+
+    def fail(self, body: Dict[str, Any], status_code: int):
+        self.body = body
+        self.status_code = status_code
+
+
+def record_submission(uuid: str, payload: Dict[str, Any], claim: DedupClaim, ticket: AdmissionTicket,
+                      callback_url: Optional[str] = None):
+    """上游接受提交后的登记（结果缓存和任务登记表除外）：不做阻塞 I/O，协程版本直接在事件循环中调用"""
+    claim.resolve(uuid)
+    completion_history.register(uuid, payload)
+    ticket.bind(uuid)
+    task_journal.record_submit(uuid, payload, callback_url)
+
+
+def submit_generation(payload: Dict[str, Any], client_ip: Optional[str] = None, cache_mode: str = 'use',
+                      priority: Optional[int] = None, callback_url: Optional[str] = None, register: bool = False,
+                      tag: Optional[str] = None, timeout: float = SUBMIT_TIMEOUT) -> Submission:
+    """
+    按统一流程提交一组生成参数，返回 Submission；priority 默认按工作量划分（priority_for）。
+    register=True 时提交前检查任务登记表容量、提交后登记（tag 为登记标签）。
+    上游网络错误照常抛出 requests 异常，由调用方处理
+    """
+    submission = Submission()
+    uuid = generation_cache.lookup(payload, cache_mode)
+    submission.cached = uuid is not None
+    # 相同参数的任务正在生成（重试、重复点击）时挂到该任务上，不再提交新任务
+    claim = DedupClaim() if submission.cached else submission_dedup.claim(payload, client_ip, cache_mode)
+    # 需要提交新任务时申请上游生成名额（提交时排队，名额用完时按优先级排队；微批合并的提交整批只占一个名额）
+    ticket = AdmissionTicket() if submission.cached or claim.attached \
+        else admission.ticket(priority_for(payload) if priority is None else priority)
+    with claim, ticket:
+        if submission.cached:
+            logger.info(f"[{client_ip}] Generation cache hit, reusing task {uuid}")
+        elif claim.attached:
+            uuid = claim.uuid
+            submission.deduplicated = True
+            logger.info(f"[{client_ip}] Identical submission in flight, attaching to task {uuid}")
+        else:
+            if register and not task_registry.has_capacity():
+                # reject 策略下登记表已满
+                submission.fail({"error": REGISTRY_FULL_ERROR}, 503)
+                return submission
+
+            logger.info(f"[{client_ip}] Forwarding request to Z-Image: {payload}")
+            # 开启微批时与同时到达的相同请求合并提交
+            try:
+                status_code, result = micro_batcher.submit(payload, ticket, timeout=timeout)
+            except AdmissionRejected:
+                # 上游生成名额已满且排队已满/超时：让客户端稍后重试
+                logger.warning(f"[{client_ip}] Admission rejected ({ticket.rejection()['message']})")
+                submission.reject(ticket)
+                return submission
+            uuid = result.get('data', {}).get('uuid') if result.get('success') else None
+            if not uuid:
+                submission.upstream_error = result.get('error', 'Unknown error from Z-Image')
+                logger.error(f"[{client_ip}] Z-Image API error: {submission.upstream_error}")
+                submission.fail({"error": submission.upstream_error}, status_code)
+                return submission
+
+            record_submission(uuid, payload, claim, ticket, callback_url)
+            generation_cache.store(payload, uuid, cache_mode)
+            if register:
+                # 登记任务信息（有界，过期自动清理）
+                task_registry.add(uuid, tag=tag)
+            logger.info(f"[{client_ip}] Task submitted successfully with UUID: {uuid}")
+
+    submission.uuid = uuid
+    submission.queue = ticket.info()
+    return submission
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Z-Image 参数扫描（POST /v1/sweeps）
+一个提示词 × 参数网格（预设、尺寸、步数、cfg_scale、模型）的笛卡尔积，每个格子生成一张图。
+格子作为批量作业 (zimage_batches) 的输入行执行：同时生成的格子数受 concurrency 限制并经过准入控制，
+结果按任务结束顺序流式返回并带上格子参数，整个网格的耗时接近最慢的几个格子而不是所有格子之和
+"""
+
+import itertools
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from zimage_images import numeric_param
+from zimage_presets import PRESETS
+
+# 参数扫描中每个格子固定只生成一张图，沿用预设时不带 batch_size
+SWEEP_PRESETS = {name: {key: value for key, value in preset.items() if key != 'batch_size'}
+                 for name, preset in PRESETS.items()}
+DEFAULT_CELL = {'width': 1024, 'height': 1024, 'steps': 8, 'cfg_scale': 7, 'negative_prompt': ''}  # 未指定预设时
+
+SWEEP_MAX_CELLS = int(os.environ.get('ZIMAGE_SWEEP_MAX_CELLS', '64'))  # 单次扫描最多的格子数
+SWEEP_CONCURRENCY = int(os.environ.get('ZIMAGE_SWEEP_CONCURRENCY', '8'))  # 单次扫描同时生成的格子数上限（请求可以更小）
+
+_SIZE_PATTERN = re.compile(r'^(\d+)x(\d+)$')
+
+
+def _axis(data: Dict[str, Any], name: str) -> List[Any]:
+    """单个值或列表；未指定时返回 [None]，表示沿用预设的值"""
+    if name not in data:
+        return [None]
+    value = data[name]
+    return value if isinstance(value, list) and value else [value]
+
+
+def _checked(field: str, value: Any) -> Any:
+    """按 NUMERIC_LIMITS 转换并检查一个轴上的值，None（沿用预设）原样返回；不合法时抛出 ValueError"""
+    if value is None:
+        return None
+    value, error = numeric_param(field, value)
+    if error:
+        raise ValueError(error)
+    return value
+
+
+def _parse_size(value: Any) -> Tuple[int, int]:
+    if isinstance(value, (list, tuple)) and len(value) == 2:
+        return _checked('width', value[0]), _checked('height', value[1])
+    match = _SIZE_PATTERN.match(str(value))
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    return _checked('width', match.group(1)), _checked('height', match.group(2))
+
+
+def _size_axis(data: Dict[str, Any]) -> List[Optional[Tuple[int, int]]]:
+    """sizes 为成对的尺寸（"768x1024" 或 [768, 1024]），否则 width 与 height 两个列表做笛卡尔积"""
+    if 'sizes' in data:
+        return [_parse_size(size) for size in _axis(data, 'sizes')]
+    widths, heights = _axis(data, 'width'), _axis(data, 'height')
+    if widths == [None] and heights == [None]:
+        return [None]
+    return [(_checked('width', width), _checked('height', height))
+            for width, height in itertools.product(widths, heights)]
+
+
+def expand_sweep(data: Dict[str, Any]) -> Tuple[List[Tuple[Dict[str, Any], Dict[str, Any]]], Optional[str]]:
+    """
+    请求体 -> ([(格子参数, 上游生成参数)], 错误信息)。
+    各轴的笛卡尔积：presets × 尺寸 × steps × cfg_scale × model，未指定的轴沿用预设（或默认值）
+    """
+    if not isinstance(data, dict):
+        return [], "Request body must be a JSON object"
+    prompt = data.get('prompt')
+    if not prompt or not isinstance(prompt, str):
+        return [], "Prompt is required and must be a string"
+
+    presets = _axis(data, 'presets') if 'presets' in data else _axis(data, 'preset')
+    unknown = [preset for preset in presets if preset is not None and (not isinstance(preset, str) or preset not in SWEEP_PRESETS)]
+    if unknown:
+        return [], f"Unknown preset: {unknown[0]} (available: {', '.join(SWEEP_PRESETS)})"
+    try:
+        sizes = _size_axis(data)
+        steps = [_checked('steps', value) for value in _axis(data, 'steps')]
+        cfg_scales = [_checked('cfg_scale', value) for value in _axis(data, 'cfg_scale')]
+    except (TypeError, ValueError) as e:
+        return [], str(e)
+    models = _axis(data, 'model') if 'model' in data else ['zimage-turbo']
+
+    count = len(presets) * len(sizes) * len(steps) * len(cfg_scales) * len(models)
+    if count > SWEEP_MAX_CELLS:
+        return [], f"Sweep expands to {count} combinations, the limit is {SWEEP_MAX_CELLS}"
+
+    cells = []
+    for preset, size, step, cfg_scale, model in itertools.product(presets, sizes, steps, cfg_scales, models):
+        base = SWEEP_PRESETS[preset] if preset else DEFAULT_CELL
+        width, height = size if size is not None else (None, None)
+        params = {
+            "preset": preset,
+            "width": width if width is not None else base['width'],
+            "height": height if height is not None else base['height'],
+            "steps": step if step is not None else base['steps'],
+            "cfg_scale": cfg_scale if cfg_scale is not None else base['cfg_scale'],
+            "model": str(model or 'zimage-turbo')
+        }
+        payload = {
+            "prompt": prompt,
+            "negative_prompt": data.get('negative_prompt', base['negative_prompt']),
+            "model": "turbo" if "turbo" in params['model'] else "base",
+            "batch_size": 1,
+            "width": params['width'],
+            "height": params['height'],
+            "steps": params['steps'],
+            "cfg_scale": params['cfg_scale']
+        }
+        cells.append((params, payload))
+    return cells, None
+
+
+def sweep_concurrency(value: Any) -> int:
+    """请求体中的 concurrency，限制在 1..SWEEP_CONCURRENCY，缺省或无效时取上限"""
+    try:
+        return min(max(int(value), 1), SWEEP_CONCURRENCY)
+    except (TypeError, ValueError):
+        return SWEEP_CONCURRENCY
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Z-Image 上游 HTTP 客户端
+所有代理变体共享的长连接池：keep-alive、TLS 连接复用、启动预热和连接池指标
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Z-Image API endpoints
+ZIMAGE_BASE = os.environ.get('ZIMAGE_API_HOST', "https://zimage.run").rstrip('/')
+ZIMAGE_GENERATE = f"{ZIMAGE_BASE}/api/z-image/generate"
+ZIMAGE_TASK = f"{ZIMAGE_BASE}/api/z-image/task"
+
+# 连接池配置
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', '20'))  # 每个主机最多保持的连接数
+UPSTREAM_WARM_CONNECTIONS = int(os.environ.get('UPSTREAM_WARM_CONNECTIONS', '2'))  # 启动时预热的连接数
+
+
+class UpstreamClient:
+    """线程安全的上游客户端，所有请求复用同一个 requests.Session 连接池"""
+
+    def __init__(self, base_url: str = ZIMAGE_BASE, pool_size: int = UPSTREAM_POOL_SIZE):
+        self.base_url = base_url
+        self.pool_size = max(1, pool_size)
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._reset_session()
+
+        self._requests = 0
+        self._errors = 0
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._total_time = 0.0
+        self._warmed_at = None
+
+    def _reset_session(self):
+        """创建新的 Session 和连接池"""
+        session = requests.Session()
+        # pool_block=False: 池满时临时新建连接而不是阻塞请求线程
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, pool_block=False)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'Connection': 'keep-alive'})
+        self.session = session
+        self.adapter = adapter
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        """多进程模式（FLASK_PROCESSES>1）下子进程不能复用父进程的 socket"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset_session()
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """发送请求，异常与 requests 保持一致"""
+        self._check_fork()
+        with self._lock:
+            self._requests += 1
+            self._in_flight += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+
+        start_time = time.time()
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self._errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._total_time += time.time() - start_time
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def warm(self, connections: int = UPSTREAM_WARM_CONNECTIONS):
+        """后台并发打开若干连接，让首批请求不必再做 TCP+TLS 握手"""
+        connections = min(max(0, connections), self.pool_size)
+        if connections == 0:
+            return
+
+        def open_connection():
+            try:
+                self.session.head(self.base_url, timeout=10)
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Upstream warm-up failed: {e}")
+
+        def warm_all():
+            # 并发发起请求才能真正建立多条连接，串行请求只会复用同一条
+            workers = [threading.Thread(target=open_connection, daemon=True) for _ in range(connections)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self._warmed_at = time.time()
+            logger.info(f"Upstream connection pool warmed ({connections} connections to {self.base_url})")
+
+        try:
+            threading.Thread(target=warm_all, daemon=True).start()
+        except RuntimeError as e:
+            # 线程受限的容器里跳过预热，首个请求会按需建立连接
+            logger.warning(f"Skipping upstream warm-up: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """连接池使用指标"""
+        pools = []
+        new_connections = 0
+        pooled_requests = 0
+
+        poolmanager = self.adapter.poolmanager
+        for key in list(poolmanager.pools.keys()):
+            pool = poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            new_connections += pool.num_connections
+            pooled_requests += pool.num_requests
+            pools.append({
+                "host": pool.host,
+                # 队列里预填了 None 占位，只统计真实的空闲连接
+                "idle_connections": sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0,
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests
+            })
+
+        with self._lock:
+            return {
+                "pool_size": self.pool_size,
+                "requests": self._requests,
+                "errors": self._errors,
+                "in_flight": self._in_flight,
+                "peak_in_flight": self._peak_in_flight,
+                "avg_latency_ms": round(self._total_time / self._requests * 1000, 1) if self._requests else 0,
+                "connections_opened": new_connections,
+                "connections_reused": max(0, pooled_requests - new_connections),
+                "warmed_at": int(self._warmed_at) if self._warmed_at else None,
+                "pools": pools
+            }
+
+
+# 进程级共享实例
+upstream = UpstreamClient()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Z-Image 使用统计与频率限制
+Flask 版 (zimage_proxy.py) 和 asyncio 版 (zimage_proxy_async.py) 共用
+频率限制、每日用量和提示词 / IP 统计存放在共享状态后端 (zimage_state)，详细日志只保存在本进程
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Tuple
+import logging
+import threading
+import time
+
+from zimage_state import (
+    ALLOWED, RATE_LIMITED, MemoryStateBackend, StateBackendError, state_backend
+)
+
+logger = logging.getLogger(__name__)
+
+# 配置参数
+RATE_LIMIT_REQUESTS = 10  # 每分钟最多请求数
+RATE_LIMIT_WINDOW = 60    # 时间窗口（秒）
+DAILY_REQUEST_LIMIT = 100  # 每日请求限制
+
+usage_logs = []  # 详细使用日志
+
+# 锁对象，用于线程安全
+stats_lock = threading.Lock()
+
+# 共享后端不可用时退回本进程计数（限额按进程生效，而不是放行所有请求）
+local_backend = state_backend if state_backend.name == 'memory' else MemoryStateBackend()
+backend_errors = 0
+
+def _state(method: str, *args):
+    """调用共享状态后端，失败时使用本进程后端"""
+    global backend_errors
+    try:
+        return getattr(state_backend, method)(*args)
+    except StateBackendError as e:
+        backend_errors += 1
+        logger.warning(f"State backend {state_backend.name} unavailable, using local state: {e}")
+        return getattr(local_backend, method)(*args)
+
+def check_rate_limit(ip: str) -> Tuple[bool, str]:
+    """检查频率限制"""
+    today = datetime.now().strftime('%Y-%m-%d')
+    verdict = _state('acquire', ip, time.time(), today, RATE_LIMIT_WINDOW, RATE_LIMIT_REQUESTS, DAILY_REQUEST_LIMIT)
+    if verdict == ALLOWED:
+        return True, ""
+    if verdict == RATE_LIMITED:
+        return False, f"Rate limit exceeded. Max {RATE_LIMIT_REQUESTS} requests per {RATE_LIMIT_WINDOW} seconds"
+    return False, f"Daily limit exceeded. Max {DAILY_REQUEST_LIMIT} requests per day"
+
+def peek_rate_limit(ip: str) -> Tuple[bool, str]:
+    """与 check_rate_limit 相同的判断，但不计数；批量作业开始前用，每一行提交时再各自计数"""
+    status = get_rate_limit_status(ip)
+    if status["daily_limit_remaining"] <= 0:
+        return False, f"Daily limit exceeded. Max {DAILY_REQUEST_LIMIT} requests per day"
+    if status["rate_limit_remaining"] <= 0:
+        return False, f"Rate limit exceeded. Max {RATE_LIMIT_REQUESTS} requests per {RATE_LIMIT_WINDOW} seconds"
+    return True, ""
+
+def get_rate_limit_status(ip: str) -> Dict[str, int]:
+    """获取某个IP当前窗口和当日的请求数"""
+    current_requests, daily_requests = _state(
+        'usage', ip, time.time(), datetime.now().strftime('%Y-%m-%d'), RATE_LIMIT_WINDOW
+    )
+
+    return {
+        "current_requests": current_requests,
+        "daily_requests": daily_requests,
+        "rate_limit_remaining": max(0, RATE_LIMIT_REQUESTS - current_requests),
+        "daily_limit_remaining": max(0, DAILY_REQUEST_LIMIT - daily_requests)
+    }
+
+def log_usage(ip: str, prompt: str, task_uuid: str, model: str, parameters: dict, success: bool = True, error: str = None):
+    """记录使用情况"""
+    with stats_lock:
+        # 记录到详细日志
+        log_entry = {
+            "timestamp": datetime.now().isoformat(),
+            "ip": ip,
+            "prompt": prompt[:100] + "..." if len(prompt) > 100 else prompt,  # 截断长提示
+            "task_uuid": task_uuid,
+            "model": model,
+            "parameters": parameters,
+            "success": success,
+            "error": error,
+            "date": datetime.now().strftime('%Y-%m-%d'),
+            "hour": datetime.now().hour
+        }
+        usage_logs.append(log_entry)
+
+        # 保持日志文件在合理大小（最多10000条记录）
+        if len(usage_logs) > 10000:
+            usage_logs[:] = usage_logs[-5000:]
+
+    # 更新统计信息
+    if success:
+        _state('record_success', ip, prompt[:50])  # 使用前50个字符作为统计键
+
+def get_usage_stats():
+    """获取使用统计"""
+    with stats_lock:
+        today = datetime.now().strftime('%Y-%m-%d')
+        today_requests = [log for log in usage_logs if log["date"] == today]
+
+        # 按小时统计
+        hourly_stats = defaultdict(int)
+        successful_requests = 0
+        failed_requests = 0
+
+        for log in today_requests:
+            hourly_stats[log["hour"]] += 1
+            if log["success"]:
+                successful_requests += 1
+            else:
+                failed_requests += 1
+
+    # 最受欢迎的提示词
+    top_prompts = _state('top_prompts', 5)
+
+    # 活跃IP统计
+    active_ips = _state('counts')['active_users']
+
+    return {
+        "today": {
+            "total_requests": len(today_requests),
+            "successful": successful_requests,
+            "failed": failed_requests,
+            "hourly_distribution": dict(hourly_stats)
+        },
+        "top_prompts": [{"prompt": k, "count": v} for k, v in top_prompts],
+        "active_users": active_ips,
+        "rate_limits": {
+            "requests_per_minute": RATE_LIMIT_REQUESTS,
+            "daily_limit": DAILY_REQUEST_LIMIT
+        }
+    }
+
+def get_system_stats() -> Dict[str, Any]:
+    """日志和频率限制数据的规模"""
+    with stats_lock:
+        total_logs = len(usage_logs)
+    return {
+        "total_logs": total_logs,
+        "active_ips_tracked": _state('counts')['tracked_ips'],
+        "state_backend": {**state_backend.stats(), "fallbacks": backend_errors}
+    }
+
+def get_usage_logs(limit: int, offset: int, success_only: bool) -> Dict[str, Any]:
+    """分页获取请求日志"""
+    with stats_lock:
+        # 过滤日志
+        filtered_logs = usage_logs
+        if success_only:
+            filtered_logs = [log for log in usage_logs if log.get('success', False)]
+
+        # 应用分页
+        total = len(filtered_logs)
+        paginated_logs = filtered_logs[offset:offset + limit]
+
+    return {
+        "logs": paginated_logs,
+        "pagination": {
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "has_more": offset + limit < total
+        }
+    }
+
+def get_prompt_stats(min_count: int, limit: int) -> Dict[str, Any]:
+    """热门提示词统计"""
+    # 按使用次数排序，过滤和限制
+    filtered_prompts = [
+        {"prompt": prompt, "count": count}
+        for prompt, count in _state('top_prompts', limit, min_count)
+    ]
+
+    return {
+        "top_prompts": filtered_prompts,
+        "total_unique_prompts": _state('counts')['unique_prompts']
+    }
+
+def clear_old_usage(days: int) -> Dict[str, int]:
+    """清理超过指定天数的日志和每日使用记录"""
+    cutoff_date = datetime.now() - timedelta(days=days)
+
+    with stats_lock:
+        # 清理旧的日志记录
+        original_count = len(usage_logs)
+        usage_logs[:] = [
+            log for log in usage_logs
+            if datetime.fromisoformat(log['timestamp'].replace('Z', '+00:00')) > cutoff_date
+        ]
+
+        removed_logs = original_count - len(usage_logs)
+        remaining_logs = len(usage_logs)
+
+    # 清理旧的每日使用记录
+    _state('clear_daily_before', cutoff_date.strftime('%Y-%m-%d'))
+
+    return {
+        "removed_logs": removed_logs,
+        "remaining_logs": remaining_logs
+    }
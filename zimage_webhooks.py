@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Z-Image 任务完成回调 (webhook)
+/v1/chat/completions 的 extra_body.callback_url 登记回调地址；共享轮询器发现任务完成或失败后，
+把最终结果 POST 到该地址，失败按指数退避重试。投递队列有上限，满了丢弃并计数
+"""
+
+import hashlib
+import heapq
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid as uuid_lib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+import urllib3
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+
+from zimage_poller import task_poller
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('ZIMAGE_WEBHOOK_QUEUE_SIZE', '1000'))  # 等待投递（含重试中）的回调上限
+WEBHOOK_WORKERS = int(os.environ.get('ZIMAGE_WEBHOOK_WORKERS', '2'))  # 并发投递线程数
+WEBHOOK_SECRET = os.environ.get('ZIMAGE_WEBHOOK_SECRET', '')  # 设置后用 HMAC-SHA256 签名请求体
+WEBHOOK_ALLOW_PRIVATE = os.environ.get('ZIMAGE_WEBHOOK_ALLOW_PRIVATE', 'false').lower() == 'true'  # 是否允许回调内网地址
+WEBHOOK_TIMEOUT = 10  # 单次投递超时（秒）
+WEBHOOK_MAX_ATTEMPTS = 5  # 最多投递次数，间隔 2/4/8/16 秒
+WEBHOOK_PENDING_TTL = 900  # 任务一直没有结束时，回调登记保留的时间
+WEBHOOK_PRUNE_INTERVAL = 60  # 投递线程清理过期回调登记的间隔（秒）
+
+
+class CallbackAddressError(OSError):
+    """回调主机无法解析，或解析到内网/本机地址"""
+
+
+def is_private_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    return ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved or ip.is_multicast
+
+
+def resolve_callback_host(host: str, port: int) -> List[str]:
+    """解析回调主机；不允许内网回调时，任一地址是内网/本机地址都抛出 CallbackAddressError"""
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        raise CallbackAddressError(f"callback_url host cannot be resolved: {host}")
+    addresses = list(dict.fromkeys(info[4][0] for info in infos))
+    if not WEBHOOK_ALLOW_PRIVATE and any(is_private_address(address) for address in addresses):
+        raise CallbackAddressError("callback_url must not point to a private or local address")
+    return addresses
+
+
+def default_port(parsed) -> int:
+    return parsed.port or (443 if parsed.scheme == 'https' else 80)
+
+
+def validate_callback_url(url: Any) -> Optional[str]:
+    """
+    检查回调地址，返回错误信息；默认拒绝解析到内网/本机的地址，防止被用来探测内部服务。
+    这里只是提前报错，投递时会重新解析并检查实际连接的地址（DNS 记录在此期间可能被改掉）
+    """
+    if not isinstance(url, str) or len(url) > 2048:
+        return "callback_url must be a URL string"
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return "callback_url must be an http(s) URL"
+    if WEBHOOK_ALLOW_PRIVATE:
+        return None
+
+    try:
+        resolve_callback_host(parsed.hostname, default_port(parsed))
+    except CallbackAddressError as e:
+        return str(e)
+    return None
+
+
+def build_webhook_payload(snapshot: Dict[str, Any], submitted_at: float, context: Dict[str, Any]) -> Dict[str, Any]:
+    """由任务结束快照构造回调请求体"""
+    task_data = snapshot.get('task') or {}
+    result_url = task_data.get('resultUrl')
+    finished_at = time.time()
+    payload = {
+        "event": f"task.{snapshot['status']}",
+        "task_uuid": snapshot['uuid'],
+        "status": snapshot['status'],
+        "image_urls": [result_url] if result_url else task_data.get('resultUrls', []),
+        "task": task_data,
+        "timings": {
+            "submitted_at": datetime.fromtimestamp(submitted_at).isoformat(),
+            "finished_at": datetime.fromtimestamp(finished_at).isoformat(),
+            "duration_seconds": round(finished_at - submitted_at, 2)
+        }
+    }
+    if snapshot['status'] == 'failed':
+        payload["error"] = task_data.get('errorMessage') or "Task failed to complete"
+    if context:
+        payload["request"] = context
+    return payload
+
+
+def sign_payload(body: bytes) -> Optional[str]:
+    """X-ZImage-Signature 头的值；接收方用同一密钥对原始请求体计算 HMAC-SHA256 校验"""
+    if not WEBHOOK_SECRET:
+        return None
+    return "sha256=" + hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+
+
+class WebhookDelivery:
+    """一次待投递的回调"""
+
+    __slots__ = ('id', 'url', 'event', 'body', 'attempts', 'due_at')
+
+    def __init__(self, url: str, payload: Dict[str, Any]):
+        self.id = uuid_lib.uuid4().hex
+        self.url = url
+        self.event = payload["event"]
+        self.body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.attempts = 0
+        self.due_at = time.time()
+
+
+def delivery_headers(delivery: WebhookDelivery) -> Dict[str, str]:
+    """投递请求头；同一回调的重试使用相同的 X-ZImage-Delivery，接收方可据此去重"""
+    headers = {
+        'Content-Type': 'application/json',
+        'User-Agent': 'zimage-proxy-webhook/1.0',
+        'X-ZImage-Event': delivery.event,
+        'X-ZImage-Delivery': delivery.id,
+        'X-ZImage-Attempt': str(delivery.attempts)
+    }
+    signature = sign_payload(delivery.body)
+    if signature:
+        headers['X-ZImage-Signature'] = signature
+    return headers
+
+
+def should_retry(status_code: int) -> bool:
+    """只有服务端错误和限流值得重试，其他 4xx 重试也不会成功"""
+    return status_code >= 500 or status_code == 429
+
+
+def retry_delay(attempts: int) -> float:
+    return 2 ** attempts
+
+
+class WebhookDispatcher:
+    """回调登记、排队与重试投递"""
+
+    def __init__(self, queue_size: int = WEBHOOK_QUEUE_SIZE, workers: int = WEBHOOK_WORKERS):
+        self.queue_size = max(1, queue_size)
+        self.workers = max(1, workers)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending: Dict[str, List[Dict[str, Any]]] = {}  # task uuid -> 回调登记（同一任务可有多个调用方）
+        self._schedule: List = []  # (due_at, seq, delivery) 小顶堆
+        self._seq = 0
+        self._in_flight = 0
+        self._thread = None
+        self._executor = None
+        self._pid = None
+        self._pool = None
+        self._listening = False
+        self._last_prune = 0.0
+
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def register(self, task_uuid: str, callback_url: str, context: Optional[Dict[str, Any]] = None,
+                 submitted_at: Optional[float] = None):
+        """任务提交成功后登记回调，并让共享轮询器开始在后台跟踪该任务"""
+        self._ensure_started()
+        now = time.time()
+        with self._lock:
+            self._prune_pending(now)
+            entries = self._pending.setdefault(task_uuid, [])
+            if all(entry['url'] != callback_url for entry in entries):
+                entries.append({"url": callback_url, "submitted_at": submitted_at or now, "context": context or {}})
+        snapshot = task_poller.watch(task_uuid)
+        if snapshot['status'] in ('completed', 'failed'):
+            # 任务已被其他请求跟踪到结束，监听器不会再触发
+            self._on_task_finished(snapshot)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "pending_tasks": len(self._pending),
+                "queued": len(self._schedule),
+                "in_flight": self._in_flight,
+                "queue_size": self.queue_size,
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "retried": self.retried,
+                "dropped": self.dropped
+            }
+
+    def _ensure_started(self):
+        """懒启动投递线程；多进程模式下每个子进程各自启动"""
+        if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                self._pending.clear()
+                self._schedule.clear()
+                self._in_flight = 0
+            self._pid = os.getpid()
+            self._pool = urllib3.PoolManager(cert_reqs='CERT_REQUIRED', ca_certs=DEFAULT_CA_BUNDLE_PATH)
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='zimage-webhook')
+            self._thread = threading.Thread(target=self._run, name='zimage-webhooks', daemon=True)
+            self._thread.start()
+            if not self._listening:
+                task_poller.add_listener(self._on_task_finished)
+                self._listening = True
+
+    def _on_task_finished(self, snapshot: Dict[str, Any]):
+        """轮询器回调（在轮询线程中执行）：只做入队"""
+        with self._lock:
+            for entry in self._pending.pop(snapshot['uuid'], []):
+                if len(self._schedule) + self._in_flight >= self.queue_size:
+                    self.dropped += 1
+                    logger.warning(f"Webhook queue full, dropping callback for task {snapshot['uuid']}")
+                    continue
+                delivery = WebhookDelivery(entry['url'], build_webhook_payload(snapshot, entry['submitted_at'], entry['context']))
+                self._push(delivery)
+
+    def _push(self, delivery: WebhookDelivery):
+        """调用方需持有 self._lock"""
+        self._seq += 1
+        heapq.heappush(self._schedule, (delivery.due_at, self._seq, delivery))
+        self._wakeup.notify()
+
+    def _prune_pending(self, now: float):
+        """移除一直没有结束的任务的回调登记；调用方需持有 self._lock"""
+        self._last_prune = now
+        expired = [key for key, entries in self._pending.items() if now - entries[0]['submitted_at'] > WEBHOOK_PENDING_TTL]
+        for key in expired:
+            del self._pending[key]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if time.time() - self._last_prune > WEBHOOK_PRUNE_INTERVAL:
+                    self._prune_pending(time.time())
+                if not self._schedule:
+                    self._wakeup.wait(1)
+                    continue
+                due_at = self._schedule[0][0]
+                now = time.time()
+                if due_at > now:
+                    self._wakeup.wait(min(due_at - now, 1))
+                    continue
+                _, _, delivery = heapq.heappop(self._schedule)
+                self._in_flight += 1
+            self._executor.submit(self._deliver, delivery)
+
+    def _post(self, delivery: WebhookDelivery) -> int:
+        """
+        投递时解析一次回调主机并检查地址，然后直接连接检查过的地址，
+        Host 头和 TLS 证书校验仍使用原主机名；不会被 DNS rebinding 引到内网地址
+        """
+        parsed = urlparse(delivery.url)
+        port = default_port(parsed)
+        address = resolve_callback_host(parsed.hostname, port)[0]
+        pool_kwargs = {'server_hostname': parsed.hostname, 'assert_hostname': parsed.hostname} if parsed.scheme == 'https' else {}
+        pool = self._pool.connection_from_host(address, port, parsed.scheme, pool_kwargs=pool_kwargs)
+        path = (parsed.path or '/') + (f"?{parsed.query}" if parsed.query else '')
+        headers = dict(delivery_headers(delivery), Host=parsed.netloc.rsplit('@', 1)[-1])
+        response = pool.urlopen('POST', path, body=delivery.body, headers=headers, timeout=WEBHOOK_TIMEOUT,
+                                retries=False, redirect=False, assert_same_host=False)
+        return response.status
+
+    def _deliver(self, delivery: WebhookDelivery):
+        delivery.attempts += 1
+        try:
+            status = self._post(delivery)
+            ok = 200 <= status < 300
+            retry = not ok and should_retry(status)
+            error = None if ok else f"HTTP {status}"
+        except CallbackAddressError as e:
+            ok = False
+            retry = False
+            error = str(e)
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            ok = False
+            retry = True
+            error = str(e)
+
+        with self._lock:
+            self._in_flight -= 1
+            if ok:
+                self.delivered += 1
+            elif retry and delivery.attempts < WEBHOOK_MAX_ATTEMPTS:
+                self.retried += 1
+                delivery.due_at = time.time() + retry_delay(delivery.attempts)
+                self._push(delivery)
+            else:
+                self.failed += 1
+
+        if not ok:
+            logger.warning(f"Webhook delivery {delivery.id} to {delivery.url} failed (attempt {delivery.attempts}): {error}")
+
+
+# 进程级共享实例
+webhooks = WebhookDispatcher()